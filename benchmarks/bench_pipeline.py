@@ -0,0 +1,103 @@
+"""Benchmark offline del pipeline de descargas con escenarios fijos para detectar regresiones de rendimiento.
+
+Uso: python benchmarks/bench_pipeline.py [singles|playlists|mixed|all] [--workers N] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import StubExtractor, StubTransport, PipelineHarness, load_node, format_report
+
+MB = 1024 * 1024
+
+SCENARIOS = {
+    'singles': {'jobs': 500, 'files': 1, 'size_mb': 2, 'latency': 0.05, 'single': True},
+    'playlists': {'jobs': 20, 'files': 40, 'size_mb': 1, 'latency': 0.5, 'single': False},
+    'mixed': {'jobs': 200, 'files': None, 'size_mb': 2, 'latency': 0.1, 'single': None},
+}
+
+def scenario_jobs(name, params, rng):
+    """Genera los trabajos del escenario; mixed combina videos, audios y playlists pequeñas"""
+    for index in range(params['jobs']):
+        single = params['single'] if params['single'] is not None else rng.random() < 0.8
+        files = params['files'] if params['files'] is not None else (1 if single else rng.randint(5, 15))
+        content_type = 'audio' if params['single'] is None and rng.random() < 0.3 else 'video'
+        yield {
+            'url': f"https://www.youtube.com/watch?v=bench{name}{index:05d}" if single else f"https://www.youtube.com/playlist?list=bench{name}{index:05d}",
+            'content_type': content_type,
+            'format_str': 'bestaudio/best' if content_type == 'audio' else 'best',
+            'single': single,
+            'files': files,
+            'size': int(params['size_mb'] * MB),
+            'latency': params['latency'] * rng.uniform(0.5, 1.5),
+            'user_id': rng.randint(1, 50),
+            'channel_id': rng.randint(1, 5),
+        }
+
+async def run_scenario(node, name, params, args):
+    extractor = StubExtractor(download_mbps=args.download_mbps)
+    transport = StubTransport(upload_mbps=args.upload_mbps, rtt=args.rtt)
+    harness = PipelineHarness(node, extractor, transport, redis=args.redis)
+    await harness.start()
+
+    try:
+        for job in scenario_jobs(name, params, random.Random(args.seed)):
+            await harness.submit(**job)
+        await harness.wait(timeout=args.timeout)
+    finally:
+        await harness.stop()
+
+    return harness.report()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de descargas")
+    parser.add_argument("scenario", nargs="?", default="all", choices=[*SCENARIOS, "all"])
+    parser.add_argument("--workers", type=int, default=4, help="MAX_DOWNLOADS del nodo")
+    parser.add_argument("--jobs", type=int, help="Sustituye el número de trabajos del escenario")
+    parser.add_argument("--size-mb", type=float, help="Sustituye el tamaño de cada archivo sintético")
+    parser.add_argument("--latency", type=float, help="Sustituye la latencia media de extracción en segundos")
+    parser.add_argument("--download-mbps", type=float, default=0, help="Ancho de banda simulado de descarga (0 = sin límite)")
+    parser.add_argument("--upload-mbps", type=float, default=200, help="Ancho de banda simulado de subida a Discord (0 = sin límite)")
+    parser.add_argument("--rtt", type=float, default=0.05, help="Latencia de cada envío a Discord en segundos")
+    parser.add_argument("--redis", choices=["memory", "fakeredis"], default="memory", help="Cola en memoria o RedisDownloadQueue sobre fakeredis")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=1800)
+    parser.add_argument("--json", action="store_true", help="Imprime los resultados como JSON")
+    parser.add_argument("--verbose", action="store_true", help="Muestra los logs del bot")
+    args = parser.parse_args()
+
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    results = {}
+
+    for name in names:
+        params = dict(SCENARIOS[name])
+        if args.jobs is not None:
+            params['jobs'] = args.jobs
+        if args.size_mb is not None:
+            params['size_mb'] = args.size_mb
+        if args.latency is not None:
+            params['latency'] = args.latency
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory(prefix="yadb-bench-") as workdir:
+            node = load_node(workers=args.workers, workdir=workdir, verbose=args.verbose)
+            try:
+                results[name] = asyncio.run(run_scenario(node, name, params, args))
+            finally:
+                os.chdir(cwd)
+                sys.modules.pop("bot", None)
+
+        if not args.json:
+            print(format_report(name, results[name]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
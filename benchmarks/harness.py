@@ -0,0 +1,358 @@
+"""Arnés offline del pipeline de descargas: yt-dlp y Discord simulados, sin red ni token.
+
+Importa bot.py dentro de un directorio temporal con MongoDB desactivado (los registros van al
+respaldo SQLite local) y DOWNLOAD_ISOLATION=thread, sustituye run_download por un extractor que
+escribe archivos sintéticos y resolve_channel por canales falsos que registran los envíos y
+simulan el tiempo de subida. Los trabajos pasan por la cola y los workers reales del bot.
+"""
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NOISE_BLOCK = os.urandom(1024 * 1024)
+
+def load_node(workers=4, workdir=None, result_cache=False, attachment_cache=False, verbose=False):
+    """Importa bot.py aislado en workdir con la configuración del benchmark y lo devuelve"""
+    workdir = workdir or tempfile.mkdtemp(prefix="yadb-bench-")
+    os.environ.update({
+        'MONGODB_ENABLED': 'false',
+        'DOWNLOAD_ISOLATION': 'thread',
+        'MAX_DOWNLOADS': str(workers),
+        'METRICS_ENABLED': 'false',
+        'LOOP_WATCHDOG_ENABLED': 'false',
+        'METADATA_CACHE_ENABLED': 'false',
+        'RESULT_CACHE_ENABLED': str(result_cache).lower(),
+        'ATTACHMENT_CACHE_ENABLED': str(attachment_cache).lower(),
+        'RECORDS_DB_FILE': os.path.join(workdir, "download_records.db"),
+    })
+    os.chdir(workdir)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+    import bot as node
+    import logging
+    logging.getLogger("DiscordBot").setLevel(logging.INFO if verbose else logging.WARNING)
+    return node
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def percentiles(values):
+    return {name: round(percentile(values, fraction), 3) for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}
+
+def current_rss():
+    """RSS actual del proceso en bytes (de /proc; fuera de Linux cae al pico de getrusage)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+def process_cpu():
+    times = os.times()
+    return times.user + times.system
+
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def fake_redis_client(poll_interval=0.02):
+    """Cliente de fakeredis en proceso; emula XREADGROUP BLOCK, al que fakeredis responde al instante"""
+    import fakeredis
+
+    class BlockingFakeRedis(fakeredis.FakeAsyncRedis):
+        async def xreadgroup(self, *args, block=None, **kwargs):
+            deadline = time.monotonic() + (block or 0) / 1000
+            while True:
+                response = await super().xreadgroup(*args, **kwargs)
+                if response or block is None or time.monotonic() >= deadline:
+                    return response
+                await asyncio.sleep(poll_interval)
+
+    return BlockingFakeRedis()
+
+class StubExtractor:
+    """Sustituto de ytdlp_runner.run_download que escribe archivos sintéticos tras una latencia"""
+
+    def __init__(self, download_mbps=0):
+        self.download_bps = download_mbps * 125000
+        self.specs = {}
+
+    def register(self, download_id, files=1, size=1024 * 1024, latency=0.0, error=None):
+        self.specs[download_id] = {'files': files, 'size': size, 'latency': latency, 'error': error}
+
+    def __call__(self, url, ydl_opts, info_file=None):
+        download_path = ydl_opts['paths']['home']
+        spec = self.specs.get(os.path.basename(download_path), {'files': 1, 'size': 1024 * 1024, 'latency': 0.0, 'error': None})
+        started = time.monotonic()
+
+        time.sleep(spec['latency'])
+        if spec['error']:
+            return False, spec['error'], {'download': time.monotonic() - started, 'postprocess': 0.0, 'bytes_downloaded': 0}
+
+        extension = 'mp3' if ydl_opts.get('postprocessors') else 'mp4'
+        written = 0
+        for index in range(spec['files']):
+            with open(os.path.join(download_path, f"item {index:03d}.{extension}"), "wb") as f:
+                remaining = spec['size']
+                while remaining > 0:
+                    chunk = NOISE_BLOCK[:min(remaining, len(NOISE_BLOCK))]
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            written += spec['size']
+            if self.download_bps:
+                time.sleep(spec['size'] / self.download_bps)
+
+        return True, None, {'download': time.monotonic() - started, 'postprocess': 0.0, 'bytes_downloaded': written}
+
+class StubMessage:
+    def __init__(self, channel, attachments):
+        self.id = uuid.uuid4().int >> 65
+        self.channel = channel
+        self.attachments = attachments
+
+class StubChannel:
+    """Canal de Discord falso: guarda cada envío y simula la subida de adjuntos"""
+
+    def __init__(self, channel_id, transport):
+        self.id = channel_id
+        self.transport = transport
+
+    async def send(self, content=None, embed=None, file=None, files=None, **kwargs):
+        return await self.transport.deliver(self, content, embed, [file] if file else list(files or []))
+
+    async def fetch_message(self, message_id):
+        return self.transport.messages[message_id]
+
+class StubTransport:
+    """Registro de todos los envíos a los canales falsos con ancho de banda y latencia simulados"""
+
+    def __init__(self, upload_mbps=0, rtt=0.0):
+        self.upload_bps = upload_mbps * 125000
+        self.rtt = rtt
+        self.channels = {}
+        self.messages = {}
+        self.sends = 0
+        self.uploads = 0
+        self.bytes_uploaded = 0
+
+    def channel(self, channel_id):
+        if channel_id not in self.channels:
+            self.channels[channel_id] = StubChannel(channel_id, self)
+        return self.channels[channel_id]
+
+    async def resolve_channel(self, channel_id):
+        return self.channel(channel_id)
+
+    async def deliver(self, channel, content, embed, files):
+        size = 0
+        attachments = []
+        for attachment in files:
+            size += os.fstat(attachment.fp.fileno()).st_size
+            attachments.append(SimpleNamespace(
+                filename=attachment.filename,
+                url=f"https://cdn.discordapp.invalid/attachments/{channel.id}/{uuid.uuid4().hex}/{attachment.filename}"
+            ))
+            attachment.close()
+
+        delay = self.rtt + (size / self.upload_bps if self.upload_bps else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        self.sends += 1
+        self.uploads += len(attachments)
+        self.bytes_uploaded += size
+
+        message = StubMessage(channel, attachments)
+        self.messages[message.id] = message
+        return message
+
+class PipelineHarness:
+    """Monta el nodo de descargas con los sustitutos y mide cada trabajo que lo atraviesa"""
+
+    def __init__(self, node, extractor, transport, redis="memory", sample_interval=0.25):
+        self.node = node
+        self.extractor = extractor
+        self.transport = transport
+        self.redis = redis
+        self.sample_interval = sample_interval
+        self.jobs = {}
+        self.submitted = {}
+        self.finished = {}
+        self.lags = []
+        self.timeline = []
+        self.idle = asyncio.Event()
+        self.sampler = None
+        self.started = None
+
+    async def start(self):
+        node = self.node
+        node.bot.loop = asyncio.get_running_loop()
+        node.bot._connection.user = SimpleNamespace(display_avatar=None)
+
+        node.run_download = self.extractor
+        node.resolve_channel = self.transport.resolve_channel
+
+        original_save = node.save_download_record
+
+        async def save_download_record(record_data):
+            await original_save(record_data)
+            download_id = record_data.get('download_id')
+            if download_id in self.jobs:
+                self.jobs[download_id] = record_data
+            if record_data.get('status') in node.TERMINAL_STATUSES and download_id in self.submitted and download_id not in self.finished:
+                self.finished[download_id] = time.monotonic()
+                if len(self.finished) == len(self.submitted):
+                    self.idle.set()
+
+        node.save_download_record = save_download_record
+
+        if self.redis == "fakeredis":
+            node.redis_client = fake_redis_client()
+            await node.setup_download_queue()
+
+        await node.record_sink.start()
+        node.start_download_workers()
+
+        self.started = time.monotonic()
+        self.sampler = asyncio.create_task(self.sample())
+
+    async def submit(self, url, format_str="best", content_type="video", single=True, files=1, size=1024 * 1024,
+                     latency=0.0, error=None, user_id=1, channel_id=1, duration=None, title=None):
+        """Encola un trabajo igual que DownloadView.queue_download y devuelve su download_id"""
+        node = self.node
+        download_id = str(uuid.uuid4())[:8]
+        self.extractor.register(download_id, files=files, size=size, latency=latency, error=error)
+
+        download_data = {
+            'url': url,
+            'format_str': format_str,
+            'content_type': content_type,
+            'user_id': user_id,
+            'user_name': f"bench-{user_id}",
+            'channel_id': channel_id,
+            'download_id': download_id,
+            'timestamp': time.time(),
+            'datetime': node.datetime.utcnow().isoformat(),
+            'title': title or f"bench {download_id}",
+            'duration': duration,
+            'single': single,
+            'is_playlist': not single,
+            'status': 'queued',
+            'server_id': None
+        }
+        download_data['canonical_url'] = node.canonicalize_url(url)
+        download_data['cache_key'] = node.result_cache_key(download_data)
+        download_data['delivery_key'] = node.delivery_key(download_data)
+
+        self.jobs[download_id] = download_data
+        self.submitted[download_id] = time.monotonic()
+        self.idle.clear()
+
+        if await node.serve_from_attachment_cache(download_data, self.transport.channel(channel_id)):
+            return download_id
+
+        await node.save_download_record(download_data)
+        if await node.download_queue.follow_or_register(download_data) is None:
+            await node.download_queue.put(download_data)
+        return download_id
+
+    async def wait(self, timeout=None):
+        if len(self.finished) < len(self.submitted):
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        while self.node.active_downloads:
+            await asyncio.sleep(0.05)
+
+    async def sample(self):
+        """Mide el retraso del event loop y guarda una serie temporal de cola, trabajos activos, CPU y RSS"""
+        cpu_mark = process_cpu()
+        while True:
+            expected = time.monotonic() + self.sample_interval
+            await asyncio.sleep(self.sample_interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0)
+            cpu, cpu_mark = process_cpu() - cpu_mark, process_cpu()
+            self.lags.append(lag)
+            self.timeline.append({
+                'elapsed': round(now - self.started, 3),
+                'submitted': len(self.submitted),
+                'queue_depth': await self.node.download_queue.qsize(),
+                'active': len(self.node.active_downloads),
+                'finished': len(self.finished),
+                'cpu_percent': round(100 * cpu / (self.sample_interval + lag), 1),
+                'rss': current_rss(),
+                'loop_lag': round(lag, 4),
+            })
+
+    async def stop(self):
+        node = self.node
+        if self.sampler:
+            self.sampler.cancel()
+        for task in list(node.download_workers.values()):
+            task.cancel()
+        await asyncio.gather(*node.download_workers.values(), return_exceptions=True)
+        await node.record_sink.close()
+        await node.record_store.close()
+        if node.redis_client:
+            await node.redis_client.aclose()
+        node.download_executor.shutdown(wait=False)
+
+    def report(self):
+        elapsed = max((max(self.finished.values()) if self.finished else time.monotonic()) - self.started, 1e-9)
+        statuses = {}
+        queue_waits = []
+        totals = []
+        for download_id, download_data in self.jobs.items():
+            statuses[download_data.get('status')] = statuses.get(download_data.get('status'), 0) + 1
+            if 'queue_wait' in download_data.get('timings', {}):
+                queue_waits.append(download_data['timings']['queue_wait'])
+            if download_id in self.finished:
+                totals.append(self.finished[download_id] - self.submitted[download_id])
+
+        return {
+            'jobs': len(self.jobs),
+            'statuses': statuses,
+            'elapsed': round(elapsed, 3),
+            'jobs_per_sec': round(len(self.finished) / elapsed, 3),
+            'queue_wait': percentiles(queue_waits),
+            'turnaround': percentiles(totals),
+            'peak_queue_depth': max((s['queue_depth'] for s in self.timeline), default=0),
+            'worker_utilization': round(
+                sum(s['active'] for s in self.timeline) / max(len(self.timeline) * self.node.MAX_DOWNLOADS, 1), 3
+            ),
+            'peak_cpu_percent': max((s['cpu_percent'] for s in self.timeline), default=0),
+            'peak_rss_mb': round(peak_rss() / (1024 * 1024), 1),
+            'loop_lag': {
+                'p50': round(percentile(self.lags, 0.5), 4),
+                'p99': round(percentile(self.lags, 0.99), 4),
+                'max': round(max(self.lags, default=0), 4),
+            },
+            'sends': self.transport.sends,
+            'uploads': self.transport.uploads,
+            'bytes_uploaded': self.transport.bytes_uploaded,
+            'records_written': self.node.record_sink.stats['written'],
+        }
+
+def format_report(name, report):
+    lines = [
+        f"== {name} ==",
+        f"Trabajos: {report['jobs']} {report['statuses']} en {report['elapsed']} s ({report['jobs_per_sec']} trabajos/s)",
+        f"Espera en cola: p50 {report['queue_wait']['p50']} s, p95 {report['queue_wait']['p95']} s, p99 {report['queue_wait']['p99']} s",
+        f"Tiempo total: p50 {report['turnaround']['p50']} s, p95 {report['turnaround']['p95']} s, p99 {report['turnaround']['p99']} s",
+        f"Cola máxima: {report['peak_queue_depth']} | Uso de workers: {report['worker_utilization']*100:.0f}% | "
+        f"CPU máxima: {report['peak_cpu_percent']}% | RSS máximo: {report['peak_rss_mb']} MB",
+        f"Retraso del event loop: p50 {report['loop_lag']['p50']*1000:.1f} ms, p99 {report['loop_lag']['p99']*1000:.1f} ms, máx {report['loop_lag']['max']*1000:.1f} ms",
+        f"Envíos: {report['sends']} ({report['uploads']} adjuntos, {report['bytes_uploaded']/(1024*1024):.1f} MB) | Registros escritos: {report['records_written']}",
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,217 @@
+"""Reproduce el historial de descargas real contra un nodo con red y Discord simulados.
+
+Lee los registros de download_records.json, de la base SQLite local o de la colección downloads de
+MongoDB, los vuelve a encolar respetando sus tiempos de llegada a 1x, 10x o 100x y muestra cómo
+evolucionan la cola, las esperas, el uso de workers, la CPU y la memoria. El coste de cada trabajo
+sale del propio registro (archivos, bytes y tiempo de yt-dlp) o, si falta, se estima por la duración.
+
+Uso: python benchmarks/replay_records.py download_records.db --speed 10 --workers 2,4,8
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import StubExtractor, StubTransport, PipelineHarness, load_node, format_report
+
+MB = 1024 * 1024
+
+ESTIMATED_BITRATES = {'video': 2_500_000, 'audio': 192_000}
+
+DEFAULT_DURATION = 240
+
+DEFAULT_PLAYLIST_FILES = 10
+
+def load_json_records(path):
+    with open(path, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    return list(records.values()) if isinstance(records, dict) else records
+
+def load_sqlite_records(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return [json.loads(data) for (data,) in conn.execute("SELECT data FROM downloads")]
+    finally:
+        conn.close()
+
+def load_mongo_records(uri, database):
+    from pymongo import MongoClient
+
+    client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+    try:
+        return list(client[database].downloads.find({}, {'_id': 0}))
+    finally:
+        client.close()
+
+def record_timestamp(record):
+    """Momento de llegada de la petición: timestamp, o created_at/datetime en registros antiguos"""
+    if isinstance(record.get('timestamp'), (int, float)):
+        return float(record['timestamp'])
+    for key in ('created_at', 'datetime'):
+        value = record.get(key)
+        if isinstance(value, datetime):
+            return value.timestamp()
+        if isinstance(value, str):
+            try:
+                return datetime.fromisoformat(value).timestamp()
+            except ValueError:
+                continue
+    return None
+
+def record_to_job(record, args):
+    """Traduce un registro histórico en los parámetros del trabajo sintético equivalente"""
+    content_type = record.get('content_type') or 'video'
+    single = record.get('single', True)
+    files = record.get('files_count') or (1 if single else DEFAULT_PLAYLIST_FILES)
+
+    sizes = [f.get('size') for f in record.get('files') or [] if f.get('size')]
+    if sizes:
+        size = int(sum(sizes) / len(sizes))
+    elif record.get('bytes_downloaded'):
+        size = int(record['bytes_downloaded'] / files)
+    else:
+        duration = record.get('duration') if isinstance(record.get('duration'), (int, float)) else None
+        duration = (duration / files if duration and not single else duration) or DEFAULT_DURATION
+        size = int(duration * ESTIMATED_BITRATES.get(content_type, ESTIMATED_BITRATES['video']) / 8)
+    size = min(size, int(args.max_file_mb * MB))
+
+    timings = record.get('timings') or {}
+    latency = timings.get('ytdlp')
+    if latency is None:
+        latency = args.extract_overhead + (size * files / (args.download_mbps * 125000) if args.download_mbps else 0)
+
+    return {
+        'url': record['url'],
+        'format_str': record.get('format_str') or 'best',
+        'content_type': content_type,
+        'single': single,
+        'files': files,
+        'size': size,
+        'latency': latency,
+        'error': (record.get('error') or 'Error reproducido') if record.get('status') == 'error' else None,
+        'user_id': record.get('user_id') or 0,
+        'channel_id': record.get('channel_id') or 0,
+        'duration': record.get('duration'),
+        'title': record.get('title'),
+    }
+
+def build_schedule(records, args):
+    """Ordena las peticiones por llegada y devuelve (segundo de reproducción, trabajo)"""
+    arrivals = []
+    for record in records:
+        timestamp = record_timestamp(record)
+        if timestamp is None or not record.get('url'):
+            continue
+        if args.since and timestamp < args.since:
+            continue
+        arrivals.append((timestamp, record))
+    arrivals.sort(key=lambda item: item[0])
+    if args.limit:
+        arrivals = arrivals[:args.limit]
+
+    schedule = []
+    offset = 0.0
+    previous = arrivals[0][0] if arrivals else 0
+    for timestamp, record in arrivals:
+        gap = (timestamp - previous) / args.speed
+        offset += min(gap, args.max_gap) if args.max_gap is not None else gap
+        previous = timestamp
+        schedule.append((offset, record_to_job(record, args)))
+    return schedule
+
+async def replay(node, schedule, args):
+    extractor = StubExtractor()
+    transport = StubTransport(upload_mbps=args.upload_mbps, rtt=args.rtt)
+    harness = PipelineHarness(node, extractor, transport, redis=args.redis, sample_interval=args.interval)
+    await harness.start()
+
+    try:
+        started = time.monotonic()
+        for offset, job in schedule:
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await harness.submit(**job)
+        await harness.wait(timeout=args.timeout)
+    finally:
+        await harness.stop()
+
+    return harness.report(), harness.timeline
+
+def format_timeline(timeline, every):
+    lines = [f"{'t (s)':>8} {'llegadas':>9} {'en cola':>8} {'activas':>8} {'hechas':>7} {'CPU %':>6} {'RSS MB':>7} {'lag ms':>7}"]
+    for sample in timeline[::max(every, 1)]:
+        lines.append(
+            f"{sample['elapsed']:>8.1f} {sample['submitted']:>9} {sample['queue_depth']:>8} {sample['active']:>8} "
+            f"{sample['finished']:>7} {sample['cpu_percent']:>6.1f} {sample['rss']/MB:>7.1f} {sample['loop_lag']*1000:>7.1f}"
+        )
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproduce el historial de descargas con red y Discord simulados")
+    parser.add_argument("source", nargs="?", help="download_records.json o base SQLite de registros")
+    parser.add_argument("--mongo-uri", help="Lee los registros de MongoDB en lugar de un archivo")
+    parser.add_argument("--mongo-db", default=os.getenv("MONGODB_DB", "mediadownloader"))
+    parser.add_argument("--speed", type=float, default=1, help="Factor de aceleración de las llegadas (1, 10, 100...)")
+    parser.add_argument("--max-gap", type=float, help="Recorta los huecos sin peticiones a este máximo de segundos reproducidos")
+    parser.add_argument("--since", type=float, help="Solo peticiones posteriores a este timestamp Unix")
+    parser.add_argument("--limit", type=int, help="Reproduce como máximo este número de peticiones")
+    parser.add_argument("--workers", default="4", help="MAX_DOWNLOADS a probar, separados por comas (p. ej. 2,4,8)")
+    parser.add_argument("--extract-overhead", type=float, default=2.0, help="Segundos de yt-dlp estimados para registros sin tiempos")
+    parser.add_argument("--download-mbps", type=float, default=50, help="Ancho de banda estimado para registros sin tiempos")
+    parser.add_argument("--max-file-mb", type=float, default=200, help="Tamaño máximo de cada archivo sintético")
+    parser.add_argument("--upload-mbps", type=float, default=50, help="Ancho de banda simulado de subida a Discord (0 = sin límite)")
+    parser.add_argument("--rtt", type=float, default=0.1, help="Latencia de cada envío a Discord en segundos")
+    parser.add_argument("--redis", choices=["memory", "fakeredis"], default="memory")
+    parser.add_argument("--interval", type=float, default=1.0, help="Segundos entre muestras de la serie temporal")
+    parser.add_argument("--every", type=int, default=10, help="Imprime una de cada N muestras")
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("--json", action="store_true", help="Imprime resumen y serie temporal como JSON")
+    parser.add_argument("--verbose", action="store_true", help="Muestra los logs del bot")
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        records = load_mongo_records(args.mongo_uri, args.mongo_db)
+    elif args.source and args.source.endswith(".json"):
+        records = load_json_records(args.source)
+    elif args.source:
+        records = load_sqlite_records(args.source)
+    else:
+        parser.error("indica un archivo de registros o --mongo-uri")
+
+    schedule = build_schedule(records, args)
+    if not schedule:
+        print("No hay peticiones reproducibles en los registros")
+        return
+
+    if not args.json:
+        print(f"Reproduciendo {len(schedule)} peticiones en {schedule[-1][0]:.1f} s (x{args.speed:g})")
+
+    results = {}
+    for workers in (int(w) for w in args.workers.split(",")):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory(prefix="yadb-replay-") as workdir:
+            node = load_node(workers=workers, workdir=workdir, verbose=args.verbose)
+            try:
+                report, timeline = asyncio.run(replay(node, schedule, args))
+            finally:
+                os.chdir(cwd)
+                sys.modules.pop("bot", None)
+
+        results[workers] = {'report': report, 'timeline': timeline}
+        if not args.json:
+            print(format_report(f"MAX_DOWNLOADS={workers}", report))
+            print(format_timeline(timeline, args.every))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,29 @@ import shutil
 import time
 import json
 import redis
+import redis.asyncio as aioredis
 import re
 import uuid
-from datetime import datetime
+import hashlib
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from datetime import datetime, timedelta
 import logging
 import aiohttp
+from aiohttp import web
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import ConnectionFailure
+from pymongo import UpdateOne, InsertOne
+from pymongo.errors import ConnectionFailure, OperationFailure
 from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import sqlite3
+import signal
 import sys
+import threading
+import traceback
+from ytdlp_runner import run_download, RESULT_PREFIX
 
 logging.basicConfig(
     level=logging.INFO,
@@ -30,7 +43,17 @@ BOT_VERSION = os.getenv("BOT_VERSION", "1.0.0")
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents)
+
+class DownloaderBot(commands.Bot):
+    async def close(self):
+        """Detiene los workers y vacía los registros pendientes antes de cerrar la conexión con Discord"""
+        await stop_download_workers()
+        stop_loop_watchdog()
+        await record_sink.close()
+        await record_store.close()
+        await super().close()
+
+bot = DownloaderBot(command_prefix=BOT_PREFIX, intents=intents)
 
 RPC_ENABLED = os.getenv("RPC_ENABLED", "true").lower() == "true"
 RPC_STATE = os.getenv("RPC_STATE", "Descargando contenido")
@@ -49,6 +72,27 @@ MONGODB_USER = os.getenv("MONGODB_USER", "")
 MONGODB_PASSWORD = os.getenv("MONGODB_PASSWORD", "")
 MONGODB_AUTH_SOURCE = os.getenv("MONGODB_AUTH_SOURCE", "admin")
 
+RECORD_FLUSH_INTERVAL = float(os.getenv("RECORD_FLUSH_INTERVAL", 2))
+RECORD_FLUSH_SIZE = int(os.getenv("RECORD_FLUSH_SIZE", 100))
+RECORD_BUFFER_MAX = int(os.getenv("RECORD_BUFFER_MAX", 10000))
+RECORD_JOURNAL_FILE = "download_records.journal"
+RECORDS_DB_FILE = os.getenv("RECORDS_DB_FILE", "download_records.db")
+LEGACY_RECORDS_FILE = "download_records.json"
+
+RECORD_RETENTION_DAYS = int(os.getenv("RECORD_RETENTION_DAYS", 0))
+
+TERMINAL_STATUSES = ('completed', 'error', 'cancelled')
+USAGE_HOURLY_RETENTION_DAYS = int(os.getenv("USAGE_HOURLY_RETENTION_DAYS", 30))
+USAGE_DURATION_BOUNDS = (5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+USAGE_PLATFORM_KEYS = {
+    "YouTube": "youtube",
+    "Twitter/X": "twitter",
+    "TikTok": "tiktok",
+    "Instagram": "instagram",
+    "Facebook": "facebook",
+    "Spotify": "spotify",
+}
+
 timeout_str = os.getenv("DOWNLOAD_TIMEOUT", "600")
 try:
     DOWNLOAD_TIMEOUT = int(timeout_str.split('#')[0].strip())
@@ -56,345 +100,2176 @@ except ValueError:
     DOWNLOAD_TIMEOUT = 600
     logger.warning(f"Valor inválido para DOWNLOAD_TIMEOUT: '{timeout_str}', usando valor predeterminado: 600")
 
+DOWNLOAD_ISOLATION = os.getenv("DOWNLOAD_ISOLATION", "process").lower()
+if DOWNLOAD_ISOLATION not in ("process", "thread"):
+    logger.warning(f"Valor inválido para DOWNLOAD_ISOLATION: '{DOWNLOAD_ISOLATION}', usando valor predeterminado: process")
+    DOWNLOAD_ISOLATION = "process"
+
+PROCESS_KILL_GRACE = 5
+
+UPLOAD_LIMIT = int(float(os.getenv("UPLOAD_LIMIT_MB", 25)) * 1024 * 1024)
+
+TRANSCODE_ENABLED = os.getenv("TRANSCODE_ENABLED", "true").lower() == "true"
+TRANSCODE_PRESET = os.getenv("TRANSCODE_PRESET", "veryfast")
+TRANSCODE_HEADROOM = 0.94
+TRANSCODE_ATTEMPTS = 3
+TRANSCODE_MIN_VIDEO_KBPS = 150
+TRANSCODE_MIN_AUDIO_KBPS = 32
+TRANSCODE_HEIGHTS = ((2500, 1080), (1200, 720), (600, 480), (300, 360), (0, 240))
+
+OVERSIZE_STRATEGY = os.getenv("OVERSIZE_STRATEGY", "auto").lower()
+if OVERSIZE_STRATEGY not in ("auto", "transcode", "split"):
+    logger.warning(f"Valor inválido para OVERSIZE_STRATEGY: '{OVERSIZE_STRATEGY}', usando valor predeterminado: auto")
+    OVERSIZE_STRATEGY = "auto"
+
+SPLIT_MAX_PARTS = int(os.getenv("SPLIT_MAX_PARTS", 20))
+SPLIT_HEADROOM = 0.9
+SPLIT_ATTEMPTS = 3
+
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 32))
+REDIS_SOCKET_TIMEOUT = 10
+REDIS_CONNECT_RETRIES = int(os.getenv("REDIS_CONNECT_RETRIES", 5))
+REDIS_RETRY_MAX_DELAY = 30
+
+DOWNLOAD_STREAM = os.getenv("DOWNLOAD_STREAM", "downloads:queue")
+DOWNLOAD_GROUP = os.getenv("DOWNLOAD_GROUP", "download-workers")
+QUEUE_CONSUMER = os.getenv("QUEUE_CONSUMER", "main")
+QUEUE_VISIBILITY_TIMEOUT = int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", 300))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", 3))
+QUEUE_DEAD_LETTER_MAXLEN = 10000
+QUEUE_CANCEL_POLL_INTERVAL = 5
+
+EMBEDDED_WORKERS = os.getenv("EMBEDDED_WORKERS", "true").lower() == "true"
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+LOOP_LAG_INTERVAL = 0.25
+
+LOOP_WATCHDOG_ENABLED = os.getenv("LOOP_WATCHDOG_ENABLED", "true").lower() == "true"
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.5))
+LOOP_STALL_LOG_INTERVAL = 10
+LOOP_STALL_STACK_DEPTH = 15
+
+ATTACHMENT_CACHE_ENABLED = os.getenv("ATTACHMENT_CACHE_ENABLED", "true").lower() == "true"
+ATTACHMENT_CACHE_TTL = int(os.getenv("ATTACHMENT_CACHE_TTL", 7 * 86400))
+ATTACHMENT_CACHE_SIZE = int(os.getenv("ATTACHMENT_CACHE_SIZE", 1024))
+
+MESSAGE_CONTENT_LIMIT = 2000
+
+METADATA_CACHE_ENABLED = os.getenv("METADATA_CACHE_ENABLED", "true").lower() == "true"
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", 256))
+METADATA_CACHE_DEFAULT_TTL = int(os.getenv("METADATA_CACHE_TTL", 600))
+METADATA_CACHE_TTLS = {
+    "YouTube": 3600,
+    "Twitter/X": 900,
+    "TikTok": 600,
+    "Instagram": 600,
+    "Facebook": 600,
+}
 
 DOWNLOAD_DIR = "./downloads"
 if not os.path.exists(DOWNLOAD_DIR):
     os.makedirs(DOWNLOAD_DIR)
 
-download_queue = asyncio.Queue()
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", 2048))
+RESULT_CACHE_DIR = os.path.join(DOWNLOAD_DIR, "cache")
+
+INFO_FILE_NAME = "info.json"
+
+INFO_SELECTION_KEYS = {'requested_formats', 'requested_downloads', 'requested_subtitles', 'filepath', '_filename', 'filename'}
 
 MAX_DOWNLOADS = int(os.getenv("MAX_DOWNLOADS", 4))
 
 active_downloads = []
 
+download_workers = {}
+
+running_jobs = {}
+
+cancel_requests = set()
+
+
+class ExecutorLoad:
+    """Cuenta los trabajos en espera y en curso de un pool de hilos sin leer sus atributos privados"""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.queued = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def submit(self, executor, fn, *args):
+        def call():
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        def done(future):
+            # Un trabajo cancelado antes de tomar un hilo nunca llega a call()
+            if future.cancelled():
+                with self.lock:
+                    self.queued -= 1
+
+        with self.lock:
+            self.queued += 1
+        future = executor.submit(call)
+        future.add_done_callback(done)
+        return future
+
+    async def run(self, executor, fn, *args):
+        return await asyncio.wrap_future(self.submit(executor, fn, *args))
+
 download_executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOADS)
 
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
-    redis_client.ping()
-    logger.info("Conexión a Redis establecida correctamente")
-except redis.ConnectionError as e:
-    logger.error(f"Error conectando a Redis: {e}")
-    redis_client = None
+download_executor_load = ExecutorLoad(MAX_DOWNLOADS)
 
-mongo_client = None
-db = None
+child_process_stats = {'running': 0, 'started': 0}
 
-async def setup_mongodb():
-    global mongo_client, db
+class MetricsRegistry:
+    """Registro mínimo de contadores, gauges e histogramas con exposición en formato de texto de Prometheus"""
 
-    if not MONGODB_ENABLED:
-        logger.info("MongoDB está deshabilitado en la configuración. Usando almacenamiento JSON.")
-        return
-        
-    try:
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.collectors = []
 
-        logger.info(f"Intentando conectar a MongoDB: {MONGODB_URI}")
+    def register(self, name, kind, help_text, buckets=None):
+        self.metrics[name] = {'kind': kind, 'help': help_text, 'buckets': buckets, 'values': {}}
 
-        mongo_client = AsyncIOMotorClient(
-            MONGODB_URI,
-            serverSelectionTimeoutMS=5000
-        )
+    def counter(self, name, help_text):
+        self.register(name, 'counter', help_text)
 
-        await mongo_client.admin.command('ping')
+    def gauge(self, name, help_text):
+        self.register(name, 'gauge', help_text)
 
-        db = mongo_client[MONGODB_DB]
-        logger.info(f"Conexión a MongoDB establecida correctamente. Base de datos: {MONGODB_DB}")
+    def histogram(self, name, help_text, buckets):
+        self.register(name, 'histogram', help_text, tuple(buckets))
 
-        if 'downloads' not in await db.list_collection_names():
-            logger.info("Creando colección 'downloads'")
+    def collector(self, fn):
+        """Registra una corrutina que actualiza gauges justo antes de cada lectura"""
+        self.collectors.append(fn)
+        return fn
 
-            await db.downloads.create_index("download_id", unique=True)
-            await db.downloads.create_index("user_id")
-            await db.downloads.create_index("status")
-            
-        logger.info("Configuración de MongoDB completada con éxito")
-    except Exception as e:
-        logger.error(f"Error configurando MongoDB: {e}")
-        mongo_client = None
-        db = None
+    def inc(self, name, value=1, **labels):
+        values = self.metrics[name]['values']
+        key = tuple(sorted(labels.items()))
+        values[key] = values.get(key, 0) + value
 
-async def save_download_record(record_data):
-    try:
+    def set(self, name, value, **labels):
+        self.metrics[name]['values'][tuple(sorted(labels.items()))] = value
 
-        if MONGODB_ENABLED and db is not None:
-            logger.info(f"Guardando registro en MongoDB: {record_data.get('download_id')}")
+    def observe(self, name, value, **labels):
+        metric = self.metrics[name]
+        key = tuple(sorted(labels.items()))
+        state = metric['values'].setdefault(key, [[0] * len(metric['buckets']), 0.0, 0])
+        for i, bound in enumerate(metric['buckets']):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
 
-            mongo_data = record_data.copy()
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
 
-            if '_id' in mongo_data:
-                del mongo_data['_id']
+    async def render(self):
+        for collect in self.collectors:
+            try:
+                await collect()
+            except Exception as e:
+                logger.warning(f"Error al recolectar métricas en {collect.__name__}: {e}")
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            for labels, value in metric['values'].items():
+                if metric['kind'] != 'histogram':
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(metric['buckets'], counts):
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {total}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics_registry = MetricsRegistry()
+metrics_registry.gauge("yadb_queue_depth", "Trabajos esperando en la cola de descargas")
+metrics_registry.gauge("yadb_active_downloads", "Descargas en curso en este nodo")
+metrics_registry.counter("yadb_jobs_total", "Trabajos terminados por plataforma y estado")
+metrics_registry.counter("yadb_job_errors_total", "Trabajos fallidos por categoría de error")
+metrics_registry.histogram(
+    "yadb_job_stage_seconds", "Duración de cada etapa de un trabajo por plataforma",
+    (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+metrics_registry.counter("yadb_bytes_downloaded_total", "Bytes descargados de las plataformas")
+metrics_registry.counter("yadb_bytes_uploaded_total", "Bytes subidos a Discord")
+metrics_registry.counter("yadb_cache_lookups_total", "Consultas a las cachés por resultado")
+metrics_registry.gauge("yadb_executor_running_tasks", "Tareas ejecutándose en cada pool de hilos")
+metrics_registry.gauge("yadb_executor_max_threads", "Tamaño máximo de cada pool de hilos")
+metrics_registry.gauge("yadb_executor_queued_tasks", "Tareas esperando un hilo libre en cada pool")
+metrics_registry.gauge("yadb_child_processes", "Procesos hijo (yt-dlp, ffmpeg, ffprobe) en ejecución")
+metrics_registry.counter("yadb_child_processes_started_total", "Procesos hijo lanzados")
+metrics_registry.histogram(
+    "yadb_event_loop_lag_seconds", "Retraso del event loop respecto a su planificación",
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+metrics_registry.histogram(
+    "yadb_event_loop_stall_seconds", "Bloqueos del event loop por encima de LOOP_STALL_THRESHOLD",
+    (0.5, 1, 2.5, 5, 10, 30, 60)
+)
 
-            download_id = mongo_data.get('download_id')
+redis_client = None
 
-            if download_id:
-                try:
+async def setup_redis():
+    """Conecta el cliente asíncrono de Redis sobre un pool compartido, reintentando con espera exponencial"""
+    global redis_client
 
-                    result = await db.downloads.update_one(
-                        {"download_id": download_id},
-                        {"$set": mongo_data},
-                        upsert=True
-                    )
-                    if result.upserted_id:
-                        logger.info(f"Nuevo registro creado en MongoDB: {download_id}")
-                    else:
-                        logger.info(f"Registro actualizado en MongoDB: {download_id}")
-                except Exception as mongo_error:
-                    logger.error(f"Error al guardar en MongoDB: {mongo_error}")
-
-                    await save_to_json(record_data)
-            else:
+    if redis_client:
+        return redis_client
 
-                try:
-                    result = await db.downloads.insert_one(mongo_data)
-                    logger.info("Registro creado en MongoDB (sin download_id)")
-                except Exception as mongo_error:
-                    logger.error(f"Error al crear registro en MongoDB: {mongo_error}")
+    pool = aioredis.BlockingConnectionPool(
+        host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+        max_connections=max(REDIS_MAX_CONNECTIONS, MAX_DOWNLOADS + 4),
+        timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        health_check_interval=30
+    )
+    client = aioredis.Redis(connection_pool=pool)
 
-                    await save_to_json(record_data)
-        else:
+    delay = 1
+    for attempt in range(1, REDIS_CONNECT_RETRIES + 1):
+        try:
+            await client.ping()
+            redis_client = client
+            logger.info("Conexión a Redis establecida correctamente")
+            return redis_client
+        except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+            logger.error(f"Error conectando a Redis (intento {attempt}/{REDIS_CONNECT_RETRIES}): {e}")
+            if attempt < REDIS_CONNECT_RETRIES:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, REDIS_RETRY_MAX_DELAY)
+
+    await pool.disconnect()
+    return None
+
+class MemoryDownloadQueue:
+    """Cola en memoria usada cuando Redis no está disponible; no sobrevive a reinicios"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.pending = {}
+        self.inflight = {}
+        self.followers = {}
+        self.cancelled = set()
+
+    async def put(self, download_data):
+        self.pending[download_data['download_id']] = download_data
+        await self.queue.put(download_data)
+
+    async def get(self):
+        download_data = await self.queue.get()
+        self.pending.pop(download_data['download_id'], None)
+        return download_data
+
+    async def ack(self, download_data):
+        self.queue.task_done()
+
+    def release(self, download_data):
+        self.queue.task_done()
+
+    def attempts(self, download_data):
+        return 1
+
+    async def dead_letter(self, download_data, reason):
+        pass
+
+    async def qsize(self):
+        return self.queue.qsize()
+
+    async def active_count(self):
+        return len(active_downloads)
+
+    async def recover(self, consume=True):
+        return []
+
+    async def lookup(self, download_id):
+        return self.pending.get(download_id)
+
+    async def follow_or_register(self, download_data):
+        primary = self.inflight.get(delivery_key(download_data))
+        if primary is not None:
+            self.followers.setdefault(primary['download_id'], []).append(download_data)
+            self.pending[download_data['download_id']] = download_data
+            return primary['download_id']
+
+        self.inflight[delivery_key(download_data)] = download_data
+        return None
+
+    async def finish(self, download_data):
+        key = delivery_key(download_data)
+        if key and self.inflight.get(key) is download_data:
+            del self.inflight[key]
+
+        followers = self.followers.pop(download_data['download_id'], [])
+        for follower in followers:
+            self.pending.pop(follower['download_id'], None)
+        return followers
+
+    async def request_cancel(self, download_id):
+        self.cancelled.add(download_id)
+
+    async def consume_cancel(self, download_id):
+        if download_id in self.cancelled:
+            self.cancelled.discard(download_id)
+            return True
+        return False
+
+    async def pending_cancellations(self, download_ids):
+        return []
+
+    async def remember_counted(self, download_data):
+        pass
+
+    async def counted_status(self, download_id):
+        return None
+
+class RedisDownloadQueue:
+    """Cola persistente sobre un stream de Redis con grupo de consumidores.
+
+    Cada trabajo entregado queda en la lista de pendientes del grupo hasta que se confirma con
+    ack(), así que un reinicio o un fallo no lo pierde: recover() vuelve a entregar los trabajos
+    propios sin confirmar y reclama los de consumidores que llevan más de
+    QUEUE_VISIBILITY_TIMEOUT segundos sin renovar su concesión. El registro single-flight, las
+    peticiones unidas y las cancelaciones también viven en Redis para que varios nodos
+    (worker.py) compartan la misma cola. Una entrada single-flight solo cuenta mientras exista la
+    clave download:<id> de su trabajo principal, que put() mantiene y ack() borra; si el trabajo
+    nunca llegó a encolarse o ya se descartó, la siguiente petición idéntica lo sustituye y adopta
+    sus peticiones unidas.
+    """
+
+    FOLLOW_OR_REGISTER = """
+    local primary = redis.call('HGET', KEYS[1], ARGV[1])
+    if primary and redis.call('EXISTS', KEYS[3] .. primary) == 1 then
+        redis.call('RPUSH', KEYS[2] .. primary, ARGV[3])
+        redis.call('SET', KEYS[3] .. ARGV[2], ARGV[3], 'EX', 86400)
+        return primary
+    end
+    if primary then
+        local orphans = redis.call('LRANGE', KEYS[2] .. primary, 0, -1)
+        if #orphans > 0 then
+            redis.call('RPUSH', KEYS[2] .. ARGV[2], unpack(orphans))
+        end
+        redis.call('DEL', KEYS[2] .. primary)
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('SET', KEYS[3] .. ARGV[2], ARGV[3], 'EX', ARGV[4])
+    return false
+    """
+
+    FINISH = """
+    if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    local followers = redis.call('LRANGE', KEYS[2], 0, -1)
+    redis.call('DEL', KEYS[2])
+    return followers
+    """
+
+    def __init__(self, client):
+        self.redis = client
+        self.recovered = asyncio.Queue()
+        self.held = {}
+        self.delivery_attempts = {}
+        self.lease_task = None
+        self.inflight_key = f"{DOWNLOAD_STREAM}:inflight"
+        self.followers_prefix = f"{DOWNLOAD_STREAM}:followers:"
+        self.attempts_key = f"{DOWNLOAD_STREAM}:attempts"
+        self.cancel_prefix = f"{DOWNLOAD_STREAM}:cancel:"
+        self.counted_prefix = f"{DOWNLOAD_STREAM}:counted:"
+        self.dead_stream = f"{DOWNLOAD_STREAM}:dead"
+        self.follow_or_register_script = client.register_script(self.FOLLOW_OR_REGISTER)
+        self.finish_script = client.register_script(self.FINISH)
+
+    @staticmethod
+    def decode(fields):
+        if not fields:
+            return None
+        try:
+            return json.loads(fields[b'job'])
+        except (KeyError, ValueError) as e:
+            logger.error(f"Trabajo ilegible en la cola de Redis: {e}")
+            return None
 
-            logger.info("MongoDB deshabilitado, guardando en JSON")
-            await save_to_json(record_data)
-    except Exception as e:
-        logger.error(f"Error al guardar registro de descarga: {e}")
+    async def put(self, download_data):
+        payload = json.dumps(download_data)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"download:{download_data['download_id']}", payload, ex=86400)
+            pipe.xadd(DOWNLOAD_STREAM, {'job': payload})
+            await pipe.execute()
+
+    async def get(self):
+        while True:
+            if not self.recovered.empty():
+                entry_id, download_data = self.recovered.get_nowait()
+            else:
+                response = await self.redis.xreadgroup(
+                    DOWNLOAD_GROUP, QUEUE_CONSUMER, {DOWNLOAD_STREAM: '>'}, count=1, block=5000
+                )
+                if not response:
+                    continue
+                entry_id, fields = response[0][1][0]
+                download_data = self.decode(fields)
 
-        await save_to_json(record_data)
+            if download_data is None:
+                await self.discard(entry_id)
+                continue
 
-async def save_to_json(record_data):
-    try:
-        json_file = "download_records.json"
-        logger.info(f"Intentando guardar en {json_file}")
+            download_id = download_data['download_id']
+            self.held[download_id] = entry_id
+            self.delivery_attempts[download_id] = await self.redis.hincrby(self.attempts_key, download_id, 1)
+            return download_data
+
+    async def ack(self, download_data):
+        download_id = download_data['download_id']
+        self.delivery_attempts.pop(download_id, None)
+        entry_id = self.held.pop(download_id, None)
+        if entry_id is not None:
+            await self.discard(entry_id, download_id)
+
+    def release(self, download_data):
+        """Suelta el trabajo sin confirmarlo: sigue pendiente en el grupo y, al dejar de renovar su
+        concesión, recover() o XAUTOCLAIM lo volverán a entregar"""
+        download_id = download_data['download_id']
+        self.delivery_attempts.pop(download_id, None)
+        self.held.pop(download_id, None)
 
-        if os.path.exists(json_file):
-            logger.info(f"El archivo {json_file} existe")
+    def attempts(self, download_data):
+        return self.delivery_attempts.get(download_data['download_id'], 1)
 
-            logger.info(f"Permisos del archivo: {oct(os.stat(json_file).st_mode)}")
-        else:
-            logger.info(f"El archivo {json_file} no existe, creando...")
-            with open(json_file, "w") as f:
-                f.write("[]")
+    async def dead_letter(self, download_data, reason):
+        await self.redis.xadd(
+            self.dead_stream,
+            {'job': json.dumps(download_data), 'reason': reason, 'failed_at': datetime.utcnow().isoformat()},
+            maxlen=QUEUE_DEAD_LETTER_MAXLEN, approximate=True
+        )
+
+    async def discard(self, entry_id, download_id=None):
+        async with self.redis.pipeline() as pipe:
+            pipe.xack(DOWNLOAD_STREAM, DOWNLOAD_GROUP, entry_id)
+            pipe.xdel(DOWNLOAD_STREAM, entry_id)
+            if download_id:
+                pipe.hdel(self.attempts_key, download_id)
+                pipe.delete(f"download:{download_id}", f"{self.counted_prefix}{download_id}")
+            await pipe.execute()
 
-        records = []
+    async def qsize(self):
         try:
-            with open(json_file, "r") as f:
-                content = f.read()
-                logger.info(f"Contenido actual: {content[:100]}...")
-                records = json.loads(content)
-        except json.JSONDecodeError as e:
-            logger.error(f"Error al decodificar JSON: {e}")
-            records = []
+            async with self.redis.pipeline() as pipe:
+                pipe.xlen(DOWNLOAD_STREAM)
+                pipe.xpending(DOWNLOAD_STREAM, DOWNLOAD_GROUP)
+                length, pending = await pipe.execute()
+            return length - pending['pending'] + self.recovered.qsize()
         except Exception as e:
-            logger.error(f"Error al leer archivo JSON: {e}")
-            records = []
+            logger.error(f"Error al consultar el tamaño de la cola en Redis: {e}")
+            return 0
 
-        found = False
-        for i, record in enumerate(records):
-            if record.get('download_id') == record_data.get('download_id'):
+    async def active_count(self):
+        try:
+            pending = await self.redis.xpending(DOWNLOAD_STREAM, DOWNLOAD_GROUP)
+            return pending['pending'] - self.recovered.qsize()
+        except Exception as e:
+            logger.error(f"Error al consultar las descargas activas en Redis: {e}")
+            return len(active_downloads)
 
-                records[i] = record_data
-                found = True
-                break
+    async def recover(self, consume=True):
+        """Crea el grupo si hace falta, reprograma los trabajos interrumpidos y devuelve todos los que siguen en cola"""
+        try:
+            await self.redis.xgroup_create(DOWNLOAD_STREAM, DOWNLOAD_GROUP, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
 
-        if not found:
-            records.append(record_data)
+        if consume:
+            own = await self.redis.xreadgroup(DOWNLOAD_GROUP, QUEUE_CONSUMER, {DOWNLOAD_STREAM: '0'}, count=10000)
+            interrupted = list(own[0][1]) if own else []
+            interrupted.extend(await self.claim_stale_entries())
 
-        logger.info(f"Guardando {len(records)} registros en {json_file}")
-        with open(json_file, "w") as f:
-            json.dump(records, f, indent=2)
-        
-        logger.info(f"Registro guardado en JSON: {record_data.get('download_id', 'unknown')}")
-    except Exception as e:
-        logger.error(f"Error al guardar en JSON: {str(e)}")
+            for entry_id, fields in interrupted:
+                self.hold_recovered(entry_id, fields)
 
-class DownloadView(discord.ui.View):
-    def __init__(self, url, info, ctx):
-        super().__init__(timeout=None)
-        self.url = url
-        self.info = info
-        self.ctx = ctx
-        self.download_id = str(uuid.uuid4())
+            if interrupted:
+                logger.info(f"Se reanudarán {len(interrupted)} descargas interrumpidas")
 
-        self.is_playlist = 'entries' in info
-        if self.is_playlist:
-            self.playlist_size = len(info['entries'])
-            self.title = info.get('title', 'Playlist')
-        else:
-            self.title = info.get('title', 'Desconocido')
+            await self.reconcile_inflight()
 
-        video_options = [
-            ("Alta (720p+)", "720"),
-            ("Media (480p)", "480"),
-            ("Baja (360p-)", "360")
-        ]
-        
-        for label, value in video_options:
-            button = discord.ui.Button(label=label, style=discord.ButtonStyle.primary, custom_id=f"video_{value}")
-            button.callback = self.video_button_callback
-            self.add_item(button)
+            if self.lease_task is None:
+                self.lease_task = bot.loop.create_task(self.keep_leases())
 
-        audio_options = [
-            ("Audio Alta", "high"),
-            ("Audio Media", "medium"),
-            ("Audio Baja", "low")
-        ]
-        
-        for label, value in audio_options:
-            button = discord.ui.Button(label=label, style=discord.ButtonStyle.success, custom_id=f"audio_{value}")
-            button.callback = self.audio_button_callback
-            self.add_item(button)
+        entries = await self.redis.xrange(DOWNLOAD_STREAM)
+        return [job for job in (self.decode(fields) for _, fields in entries) if job]
 
-        if self.is_playlist:
-            playlist_button = discord.ui.Button(
-                label=f"Descargar Playlist ({self.playlist_size} videos)", 
-                style=discord.ButtonStyle.danger, 
-                custom_id="playlist"
+    async def claim_stale_entries(self, count=100):
+        claimed = []
+        start_id = '0-0'
+        while True:
+            result = await self.redis.xautoclaim(
+                DOWNLOAD_STREAM, DOWNLOAD_GROUP, QUEUE_CONSUMER,
+                min_idle_time=QUEUE_VISIBILITY_TIMEOUT * 1000, start_id=start_id, count=count
             )
-            playlist_button.callback = self.playlist_button_callback
-            self.add_item(playlist_button)
-    
-    async def video_button_callback(self, interaction):
-        quality = interaction.data["custom_id"].split("_")[1]
-        await interaction.response.defer(ephemeral=True)
+            next_id, entries = result[0], result[1]
+            claimed.extend(entry for entry in entries if entry[0] not in self.held.values())
+            if next_id in (b'0-0', '0-0'):
+                return claimed
+            start_id = next_id
+
+    def hold_recovered(self, entry_id, fields):
+        download_data = self.decode(fields)
+        if download_data is None:
+            self.recovered.put_nowait((entry_id, None))
+            return
+        self.held[download_data['download_id']] = entry_id
+        self.recovered.put_nowait((entry_id, download_data))
+
+    async def keep_leases(self):
+        """Renueva periódicamente los trabajos que tiene este consumidor, reclama los abandonados y
+        libera las entradas single-flight huérfanas"""
+        while True:
+            await asyncio.sleep(QUEUE_VISIBILITY_TIMEOUT / 3)
+            try:
+                entry_ids = list(self.held.values())
+                if entry_ids:
+                    await self.redis.xclaim(
+                        DOWNLOAD_STREAM, DOWNLOAD_GROUP, QUEUE_CONSUMER, 0, entry_ids, justid=True
+                    )
 
-        if quality == "720":
-            format_str = "bestvideo[height>=720]+bestaudio/best[height>=720]/best"
-        elif quality == "480":
-            format_str = "bestvideo[height>=480][height<720]+bestaudio/best[height>=480][height<720]/best"
-        else:
-            format_str = "bestvideo[height<480]+bestaudio/best[height<480]/best"
-        
-        await interaction.followup.send(f"Descarga de video en calidad {quality}p añadida a la cola.", ephemeral=True)
-        await self.queue_download(format_str, "video", interaction, single=True)
-    
-    async def audio_button_callback(self, interaction):
-        quality = interaction.data["custom_id"].split("_")[1]
-        await interaction.response.defer(ephemeral=True)
+                for entry_id, fields in await self.claim_stale_entries():
+                    logger.warning(f"Reclamado trabajo abandonado {entry_id} de otro consumidor")
+                    self.hold_recovered(entry_id, fields)
 
-        if quality == "high":
-            format_str = "bestaudio/best"
-        elif quality == "medium":
-            format_str = "bestaudio[abr<=160]/best"
-        else:
-            format_str = "bestaudio[abr<=96]/best"
-            
-        await interaction.followup.send(f"Descarga de audio en calidad {quality} añadida a la cola.", ephemeral=True)
-        await self.queue_download(format_str, "audio", interaction, single=True)
-    
-    async def playlist_button_callback(self, interaction):
-        await interaction.response.defer(ephemeral=True)
-        await interaction.followup.send(
-            f"Añadiendo a la cola la playlist completa ({self.playlist_size} videos)...", 
-            ephemeral=True
+                await self.reconcile_inflight()
+            except Exception as e:
+                logger.error(f"Error al renovar las concesiones de la cola: {e}")
+
+    async def lookup(self, download_id):
+        payload = await self.redis.get(f"download:{download_id}")
+        return json.loads(payload) if payload else None
+
+    async def follow_or_register(self, download_data):
+        primary_id = await self.follow_or_register_script(
+            keys=[self.inflight_key, self.followers_prefix, "download:"],
+            args=[delivery_key(download_data), download_data['download_id'], json.dumps(download_data), QUEUE_VISIBILITY_TIMEOUT]
         )
-        await self.queue_download("bestvideo[height>=480]+bestaudio/best", "video", interaction, single=False)
-    
-    async def queue_download(self, format_str, content_type, interaction, single=True):
+        return primary_id.decode() if primary_id else None
 
-        duration = None
-        if not self.is_playlist and 'duration' in self.info:
-            duration = self.info['duration']
-        elif self.is_playlist and len(self.info['entries']) > 0:
+    async def reconcile_inflight(self):
+        """Libera las entradas single-flight cuyo trabajo principal ya no existe y reencola sus peticiones unidas"""
+        inflight = await self.redis.hgetall(self.inflight_key)
+        if not inflight:
+            return
 
-            duration = 0
-            for entry in self.info['entries']:
-                if isinstance(entry, dict) and 'duration' in entry:
-                    duration += entry.get('duration', 0)
+        primary_ids = [primary_id.decode() for primary_id in inflight.values()]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for primary_id in primary_ids:
+                pipe.exists(f"download:{primary_id}")
+            alive = await pipe.execute()
+
+        orphaned = [(key.decode(), primary_id) for key, primary_id, exists in zip(inflight, primary_ids, alive) if not exists]
+        for key, primary_id in orphaned:
+            followers = await self.finish({'download_id': primary_id, 'delivery_key': key})
+            for follower in followers:
+                follower.pop('coalesced_into', None)
+                if await self.follow_or_register(follower) is None:
+                    await self.put(follower)
+
+        if orphaned:
+            logger.warning(f"Liberadas {len(orphaned)} entradas single-flight sin trabajo principal")
+
+    async def finish(self, download_data):
+        followers = await self.finish_script(
+            keys=[self.inflight_key, f"{self.followers_prefix}{download_data['download_id']}"],
+            args=[delivery_key(download_data) or '', download_data['download_id']]
+        )
+        followers = [json.loads(item) for item in followers]
+        if followers:
+            await self.redis.delete(*[f"download:{f['download_id']}" for f in followers])
+        return followers
+
+    async def request_cancel(self, download_id):
+        await self.redis.set(f"{self.cancel_prefix}{download_id}", 1, ex=86400)
+
+    async def consume_cancel(self, download_id):
+        return bool(await self.redis.delete(f"{self.cancel_prefix}{download_id}"))
+
+    async def pending_cancellations(self, download_ids):
+        if not download_ids:
+            return []
+        flags = await self.redis.mget([f"{self.cancel_prefix}{download_id}" for download_id in download_ids])
+        return [download_id for download_id, flag in zip(download_ids, flags) if flag]
+
+    async def remember_counted(self, download_data):
+        """Guarda junto al trabajo el último estado contado en !stats, visible para cualquier nodo"""
+        await self.redis.set(
+            f"{self.counted_prefix}{download_data['download_id']}", download_data['counted_status'], ex=86400
+        )
 
-        download_data = {
-            'url': self.url,
-            'format_str': format_str,
-            'content_type': content_type,
-            'user_id': interaction.user.id,
-            'user_name': interaction.user.name,
-            'channel_id': interaction.channel_id,
-            'download_id': self.download_id,
-            'timestamp': time.time(),
-            'datetime': datetime.utcnow().isoformat(),
-            'title': self.title,
-            'duration': duration,
-            'single': single,
-            'is_playlist': self.is_playlist,
-            'status': 'queued',
-            'server_id': interaction.guild_id if interaction.guild else None
-        }
+    async def counted_status(self, download_id):
+        status = await self.redis.get(f"{self.counted_prefix}{download_id}")
+        return status.decode() if status else None
 
-        if redis_client:
-            redis_key = f"download:{self.download_id}"
-            redis_client.set(redis_key, json.dumps(download_data))
-            redis_client.expire(redis_key, 86400)
+download_queue = MemoryDownloadQueue()
 
-        await save_download_record(download_data)
+async def setup_download_queue(consume=True):
+    """Usa la cola persistente de Redis si está disponible y recupera los trabajos pendientes"""
+    global download_queue
 
-        await download_queue.put(download_data)
+    if not redis_client:
+        logger.warning("Redis no disponible: la cola de descargas será en memoria y no sobrevivirá a reinicios")
+        return []
 
-        embed = discord.Embed(
-            title="📋 Descarga añadida a la cola",
-            description=(
-                f"{'Video' if content_type == 'video' else 'Audio'} "
-                f"{'individual' if single else f'(playlist con {self.playlist_size} elementos)'} "
-                f"añadido a la cola.\n\n"
-                f"Posición actual: {download_queue.qsize()}\n"
-                f"ID de descarga: `{self.download_id}`"
-            ),
-            color=discord.Color.blue()
-        )
+    try:
+        redis_queue = RedisDownloadQueue(redis_client)
+        queued_jobs = await redis_queue.recover(consume)
+    except Exception as e:
+        logger.error(f"Error al preparar la cola de descargas en Redis, se usará la cola en memoria: {e}")
+        return []
 
-        embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-        embed.timestamp = datetime.utcnow()
+    download_queue = redis_queue
+    logger.info(f"Cola de descargas persistente en Redis lista: {len(queued_jobs)} trabajos pendientes")
+    return queued_jobs
 
-        original_message = interaction.message
-        await original_message.edit(view=None)
+async def watch_cancellations():
+    """Aplica las cancelaciones pedidas desde otros nodos a las descargas que corren en este"""
+    while True:
+        await asyncio.sleep(QUEUE_CANCEL_POLL_INTERVAL)
+        try:
+            for download_id in await download_queue.pending_cancellations(list(running_jobs)):
+                running_job = running_jobs.get(download_id)
+                if running_job:
+                    cancel_requests.add(download_id)
+                    running_job['task'].cancel()
+        except Exception as e:
+            logger.error(f"Error al comprobar cancelaciones pendientes: {e}")
 
-        await interaction.channel.send(
-            content=f"<@{interaction.user.id}>",
-            embed=embed
+mongo_client = None
+db = None
+
+async def setup_mongodb():
+    global mongo_client, db
+
+    if not MONGODB_ENABLED:
+        logger.info("MongoDB está deshabilitado en la configuración. Usando almacenamiento SQLite local.")
+        return
+        
+    try:
+
+        logger.info(f"Intentando conectar a MongoDB: {MONGODB_URI}")
+
+        mongo_client = AsyncIOMotorClient(
+            MONGODB_URI,
+            serverSelectionTimeoutMS=5000
         )
 
-async def download_worker():
-    while True:
+        await mongo_client.admin.command('ping')
 
-        if len(active_downloads) >= MAX_DOWNLOADS:
-            await asyncio.sleep(5)
-            continue
+        db = mongo_client[MONGODB_DB]
+        logger.info(f"Conexión a MongoDB establecida correctamente. Base de datos: {MONGODB_DB}")
+
+        await migrate_mongodb()
+        await backfill_mongo_stats()
+            
+        logger.info("Configuración de MongoDB completada con éxito")
+    except Exception as e:
+        logger.error(f"Error configurando MongoDB: {e}")
+        mongo_client = None
+        db = None
 
+MONGO_INDEXES = {
+    "downloads": [
+        ([("download_id", 1)], {"unique": True}),
+        ([("status", 1), ("timestamp", -1)], {}),
+        ([("server_id", 1), ("timestamp", -1)], {}),
+        ([("user_id", 1), ("timestamp", -1)], {}),
+        ([("canonical_url", 1), ("format_str", 1)], {}),
+    ],
+    "user_stats": [
+        ([("count", -1)], {}),
+    ],
+    "usage_rollups": [
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+}
+
+async def migrate_to_v1():
+    """Los índices simples de user_id y status quedan cubiertos por los compuestos con timestamp"""
+    for name in ("user_id_1", "status_1"):
         try:
-            download_data = await asyncio.wait_for(download_queue.get(), timeout=5.0)
-        except asyncio.TimeoutError:
-            await asyncio.sleep(1)
-            continue
+            await db.downloads.drop_index(name)
+        except OperationFailure:
+            pass
 
-        active_downloads.append(download_data['download_id'])
+async def migrate_to_v2():
+    """Rellena created_at (fecha BSON) a partir de timestamp para poder aplicar la retención por TTL"""
+    result = await db.downloads.update_many(
+        {"created_at": {"$exists": False}, "timestamp": {"$type": "number"}},
+        [{"$set": {"created_at": {"$toDate": {"$multiply": ["$timestamp", 1000]}}}}]
+    )
+    if result.modified_count:
+        logger.info(f"Añadido created_at a {result.modified_count} registros existentes")
 
-        download_data['status'] = 'processing'
-        await save_download_record(download_data)
+MONGO_MIGRATIONS = [migrate_to_v1, migrate_to_v2]
 
-        video_duration = download_data.get('duration', 0)
-        if video_duration and isinstance(video_duration, (int, float)) and video_duration > 0:
+async def ensure_retention_index():
+    """Crea, ajusta o elimina el índice TTL de created_at según RECORD_RETENTION_DAYS"""
+    indexes = await db.downloads.index_information()
+    current = indexes.get("created_at_ttl")
+    expire_after = RECORD_RETENTION_DAYS * 86400
 
-            timeout = min(max(video_duration * 2, 120), 1800)
-            logger.info(f"Timeout dinámico para descarga {download_data['download_id']}: {timeout} segundos (duración del video: {video_duration} segundos)")
+    if RECORD_RETENTION_DAYS <= 0:
+        if current:
+            await db.downloads.drop_index("created_at_ttl")
+            logger.info("Retención de registros desactivada: índice TTL eliminado")
+        return
+
+    if current is None:
+        await db.downloads.create_index("created_at", name="created_at_ttl", expireAfterSeconds=expire_after)
+    elif current.get("expireAfterSeconds") != expire_after:
+        await db.command("collMod", "downloads", index={"name": "created_at_ttl", "expireAfterSeconds": expire_after})
+        logger.info(f"Retención de registros actualizada a {RECORD_RETENTION_DAYS} días")
+
+async def migrate_mongodb():
+    """Aplica las migraciones pendientes y asegura los índices; es seguro ejecutarlo en cada arranque"""
+    schema = await db.schema_migrations.find_one({"_id": "downloads"}) or {}
+    version = schema.get("version", 0)
+
+    for target, migration in enumerate(MONGO_MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Aplicando migración de MongoDB v{target}: {migration.__doc__}")
+        await migration()
+        await db.schema_migrations.update_one(
+            {"_id": "downloads"}, {"$set": {"version": target, "migrated_at": datetime.utcnow()}}, upsert=True
+        )
+
+    for collection, indexes in MONGO_INDEXES.items():
+        for keys, options in indexes:
+            try:
+                await db[collection].create_index(keys, **options)
+            except OperationFailure as e:
+                logger.error(f"No se pudo crear el índice {keys} en {collection}: {e}")
+
+    await ensure_retention_index()
+
+def rollup_bucket_id(granularity, timestamp):
+    moment = datetime.utcfromtimestamp(timestamp)
+    return f"{granularity}:{moment.strftime('%Y-%m-%dT%H' if granularity == 'h' else '%Y-%m-%d')}"
+
+def usage_buckets(timestamp):
+    return [rollup_bucket_id('h', timestamp), rollup_bucket_id('d', timestamp)]
+
+def rollup_bucket_fields(bucket):
+    """Campos fijos del documento de un bucket; los horarios caducan con el índice TTL de expires_at"""
+    granularity, label = bucket.split(':', 1)
+    start = datetime.strptime(label, '%Y-%m-%dT%H' if granularity == 'h' else '%Y-%m-%d')
+    fields = {"granularity": granularity, "start": start}
+    if granularity == 'h':
+        fields["expires_at"] = start + timedelta(days=USAGE_HOURLY_RETENTION_DAYS)
+    return fields
+
+def platform_key(url):
+    name = get_platform_name(url or '')
+    return USAGE_PLATFORM_KEYS.get(name, 'other')
+
+def usage_metrics(record_data):
+    """Métricas que aporta un trabajo terminado a los rollups de uso"""
+    outcome = {'completed': 'completed', 'error': 'failed', 'cancelled': 'cancelled'}[record_data['status']]
+    delivered = sum(
+        f.get('compressed_size') or f.get('size') or 0
+        for f in record_data.get('files') or [] if isinstance(f, dict) and f.get('attachment_url')
+    )
+
+    metrics = {'jobs': 1, outcome: 1, 'bytes': delivered}
+    dimensions = (
+        ('platform', platform_key(record_data.get('url'))),
+        ('guild', str(record_data.get('server_id') or 'dm')),
+        ('content_type', record_data.get('content_type') or 'unknown'),
+    )
+    for dimension, value in dimensions:
+        metrics[f"{dimension}.{value}.jobs"] = 1
+        metrics[f"{dimension}.{value}.{outcome}"] = 1
+        metrics[f"{dimension}.{value}.bytes"] = delivered
+
+    started_at = record_data.get('started_at')
+    if started_at:
+        elapsed = time.time() - started_at
+        bound = next((b for b in USAGE_DURATION_BOUNDS if elapsed <= b), None)
+        metrics[f"duration.{f'le_{bound}' if bound else 'inf'}"] = 1
+        metrics['duration_seconds'] = int(elapsed)
+    return {metric: value for metric, value in metrics.items() if value}
+
+def flatten_metrics(document, prefix=''):
+    flat = {}
+    for key, value in document.items():
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def window_buckets(hours):
+    """Buckets que cubren las últimas `hours` horas: horarios hasta 3 días, diarios a partir de ahí"""
+    now = time.time()
+    if hours <= 72:
+        return [rollup_bucket_id('h', now - i * 3600) for i in range(hours)]
+    return [rollup_bucket_id('d', now - i * 86400) for i in range((hours + 23) // 24)]
+
+async def get_usage(hours):
+    buckets = window_buckets(hours)
+    if MONGODB_ENABLED and db is not None:
+        totals = {}
+        async for document in db.usage_rollups.find({"_id": {"$in": buckets}}):
+            for metric, value in flatten_metrics(document).items():
+                totals[metric] = totals.get(metric, 0) + value
+        return totals
+    return await record_store.get_usage(buckets)
+
+def usage_percentile(metrics, fraction):
+    counts = [(bound, metrics.get(f"duration.le_{bound}", 0)) for bound in USAGE_DURATION_BOUNDS]
+    counts.append((None, metrics.get("duration.inf", 0)))
+    total = sum(count for _, count in counts)
+    if not total:
+        return None
+
+    seen = 0
+    for bound, count in counts:
+        seen += count
+        if seen >= fraction * total:
+            return f"≤ {bound}s" if bound else f"> {USAGE_DURATION_BOUNDS[-1]}s"
+
+def usage_breakdown(metrics, dimension, limit=5):
+    rows = {}
+    for metric, value in metrics.items():
+        parts = metric.split('.')
+        if len(parts) == 3 and parts[0] == dimension:
+            rows.setdefault(parts[1], {})[parts[2]] = value
+    return sorted(rows.items(), key=lambda item: item[1].get('jobs', 0), reverse=True)[:limit]
+
+class RecordSink:
+    """Buffer write-behind de registros de descarga.
+
+    Cada cambio de estado se anota en un journal local y se fusiona en memoria por download_id;
+    flush() los escribe en lote (bulk_write con upserts no ordenados en MongoDB, o una sola
+    transacción en el SQLite local). Junto con los registros viajan los incrementos de los
+    contadores de !stats, calculados al cambiar de estado con el campo counted_status. Si la
+    escritura falla todo vuelve al buffer, y lo que no llegó a escribirse se recupera del journal
+    al arrancar.
+
+    El journal se escribe desde un hilo propio para no bloquear el event loop; al ser un solo
+    hilo las escrituras y las rotaciones se aplican en el mismo orden en que se encolan.
+    """
+
+    def __init__(self, journal_file=RECORD_JOURNAL_FILE):
+        self.buffer = OrderedDict()
+        self.counters = {}
+        self.users = {}
+        self.rollups = {}
+        self.journal_file = journal_file
+        self.flushing_file = f"{journal_file}.flushing"
+        self.journal = None
+        self.journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="record-journal")
+        self.journal_load = ExecutorLoad(1)
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.stats = {'records': 0, 'flushes': 0, 'written': 0, 'failures': 0, 'spilled': 0}
+        self.spill_pending = False
+
+    def add(self, record_data):
+        delta = self.count_transition(record_data)
+
+        record = {k: v for k, v in record_data.items() if k != '_id'}
+        key = record.get('download_id') or uuid.uuid4().hex
+        lines = [json.dumps(record, default=str)]
+        if delta:
+            lines.append(json.dumps({'_stats': delta}))
+        self.journal_load.submit(self.journal_executor, self.write_journal, lines)
+
+        if key in self.buffer:
+            self.buffer[key].update(record)
         else:
-            timeout = DOWNLOAD_TIMEOUT
-            logger.info(f"Usando timeout predeterminado para descarga {download_data['download_id']}: {timeout} segundos")
+            self.buffer[key] = record
+        self.stats['records'] += 1
+
+        if len(self.buffer) >= RECORD_FLUSH_SIZE:
+            self.wakeup.set()
+        return delta
+
+    def count_transition(self, record_data):
+        """Traduce un cambio de estado en incrementos de contadores y lo marca como contado"""
+        status = record_data.get('status')
+        previous = record_data.get('counted_status')
+        if not status or status == previous:
+            return None
 
+        counters = {status: 1}
+        users = {}
+        if previous:
+            counters[previous] = -1
+        else:
+            counters['total'] = 1
+            if record_data.get('user_id') is not None:
+                users[str(record_data['user_id'])] = [record_data.get('user_name', 'Usuario'), 1]
+
+        rollups = {}
+        if status in TERMINAL_STATUSES and previous not in TERMINAL_STATUSES:
+            metrics = usage_metrics(record_data)
+            rollups = {bucket: metrics for bucket in usage_buckets(time.time())}
+
+        record_data['counted_status'] = status
+        delta = {'counters': counters, 'users': users, 'rollups': rollups}
+        self.merge_delta(delta)
+        return delta
+
+    async def restore_counted_status(self, record_data):
+        """En una reentrega, toma el último estado contado y no el de la copia de la cola.
+
+        La copia del stream conserva el counted_status del momento del put(), así que sin esto el
+        paso queued→processing se contaría otra vez en cada reentrega. La cola guarda ese estado
+        para que lo vea cualquier nodo; el registro guardado solo se consulta si no lo tiene.
+        """
+        download_id = record_data.get('download_id')
         try:
+            counted = await download_queue.counted_status(download_id)
+        except Exception as e:
+            logger.warning(f"No se pudo leer de la cola el estado contado de {download_id}: {e}")
+            counted = None
+        if counted:
+            record_data['counted_status'] = counted
+            return
 
-            task = asyncio.create_task(process_download(download_data))
-            await asyncio.wait_for(task, timeout=timeout)
-        except asyncio.TimeoutError:
+        buffered = self.buffer.get(download_id)
+        if buffered and buffered.get('counted_status'):
+            record_data['counted_status'] = buffered['counted_status']
+            return
 
-            logger.error(f"La descarga {download_data['download_id']} excedió el tiempo límite ({timeout} segundos)")
+        try:
+            if MONGODB_ENABLED and db is not None:
+                stored = await db.downloads.find_one({"download_id": download_id}, {"counted_status": 1})
+                if self.spill_pending:
+                    stored = (await record_store.find(download_id)) or stored
+            else:
+                stored = await record_store.find(download_id)
+        except Exception as e:
+            logger.warning(f"No se pudo leer el estado guardado de {download_id}: {e}")
+            return
 
-            channel = bot.get_channel(download_data['channel_id'])
-            if channel:
-                timeout_embed = discord.Embed(
-                    title="⏱️ Tiempo de descarga excedido",
+        if stored and stored.get('counted_status'):
+            record_data['counted_status'] = stored['counted_status']
+
+    def merge_delta(self, delta):
+        for name, value in delta['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for user_id, (name, count) in delta['users'].items():
+            entry = self.users.setdefault(user_id, [name, 0])
+            entry[0] = name
+            entry[1] += count
+        for bucket, metrics in delta.get('rollups', {}).items():
+            bucket_metrics = self.rollups.setdefault(bucket, {})
+            for metric, value in metrics.items():
+                bucket_metrics[metric] = bucket_metrics.get(metric, 0) + value
+
+    async def run_journal(self, func):
+        return await self.journal_load.run(self.journal_executor, func)
+
+    def write_journal(self, lines):
+        try:
+            if self.journal is None:
+                self.journal = open(self.journal_file, "a", encoding="utf-8")
+            self.journal.write("\n".join(lines) + "\n")
+            self.journal.flush()
+        except Exception as e:
+            logger.error(f"Error al escribir el journal de registros: {e}")
+
+    def rotate_journal(self):
+        """Pasa el journal actual al fichero del lote en curso.
+
+        Si quedó el de una escritura fallida anterior, el journal se añade a continuación para que
+        al reproducirlos los cambios mantengan su orden.
+        """
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if not os.path.exists(self.journal_file):
+            return
+        if os.path.exists(self.flushing_file):
+            with open(self.journal_file, "r", encoding="utf-8") as src, \
+                    open(self.flushing_file, "a", encoding="utf-8") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, self.flushing_file)
+
+    def discard_flushed(self):
+        if os.path.exists(self.flushing_file):
+            os.remove(self.flushing_file)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def replay_journal(self):
+        """Recupera los registros que quedaron sin escribir en una ejecución anterior"""
+        replayed = 0
+        for path in (self.flushing_file, self.journal_file):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if '_stats' in record:
+                        self.merge_delta(record['_stats'])
+                        continue
+                    key = record.get('download_id') or uuid.uuid4().hex
+                    self.buffer.setdefault(key, {}).update(record)
+                    replayed += 1
+        return replayed
+
+    def pending_delta(self):
+        if not self.counters and not self.users and not self.rollups:
+            return None
+        return {'counters': self.counters, 'users': self.users, 'rollups': self.rollups}
+
+    async def start(self):
+        if self.flush_task is not None:
+            return
+
+        replayed = await self.run_journal(self.replay_journal)
+        if replayed or self.pending_delta():
+            logger.info(f"Recuperados {replayed} cambios de registros del journal ({len(self.buffer)} registros)")
+
+        self.spill_pending = MONGODB_ENABLED and os.path.exists(record_store.path)
+        self.flush_task = bot.loop.create_task(self.run())
+
+    async def run(self):
+        delay = RECORD_FLUSH_INTERVAL
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            delay = RECORD_FLUSH_INTERVAL if await self.flush() else min(delay * 2, 60)
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.buffer and not self.pending_delta() and not self.spill_drainable():
+                return True
+
+            batch, counters, users, rollups = self.buffer, self.counters, self.users, self.rollups
+            self.buffer, self.counters, self.users, self.rollups = OrderedDict(), {}, {}, {}
+            await self.run_journal(self.rotate_journal)
+
+            try:
+                spilled = await self.take_spilled()
+                records = OrderedDict(spilled or {})
+                for key, record in batch.items():
+                    records.setdefault(key, {}).update(record)
+
+                await self.write_batch(list(records.values()), counters, users, rollups)
+                self.stats['flushes'] += 1
+                self.stats['written'] += len(records)
+                logger.debug(f"Escritos {len(records)} registros de descarga en lote")
+
+                if spilled is not None:
+                    await self.clear_spilled(spilled)
+            except Exception as e:
+                self.stats['failures'] += 1
+                logger.error(f"Error al escribir {len(batch)} registros de descarga, se reintentará: {e}")
+                for key, record in self.buffer.items():
+                    batch.setdefault(key, {}).update(record)
+                newer = {'counters': self.counters, 'users': self.users, 'rollups': self.rollups}
+                self.buffer, self.counters, self.users, self.rollups = batch, counters, users, rollups
+                self.merge_delta(newer)
+                await self.spill_overflow()
+                # El lote sigue en el fichero rotado y los cambios posteriores en el journal nuevo,
+                # así que no hace falta reescribir nada: la próxima rotación los junta en orden
+                return False
+
+            await self.run_journal(self.discard_flushed)
+            return True
+
+    async def write_batch(self, records, counters, users, rollups):
+        if MONGODB_ENABLED and db is not None:
+            if records:
+                await db.downloads.bulk_write([
+                    UpdateOne(
+                        {"download_id": record['download_id']},
+                        {"$set": record, "$setOnInsert": {"created_at": datetime.utcnow()}},
+                        upsert=True
+                    )
+                    if record.get('download_id') else InsertOne({**record, "created_at": datetime.utcnow()})
+                    for record in records
+                ], ordered=False)
+            if counters:
+                await db.download_stats.update_one({"_id": "totals"}, {"$inc": counters}, upsert=True)
+            if users:
+                await db.user_stats.bulk_write([
+                    UpdateOne(
+                        {"_id": int(user_id) if user_id.isdigit() else user_id},
+                        {"$set": {"name": name}, "$inc": {"count": count}},
+                        upsert=True
+                    )
+                    for user_id, (name, count) in users.items()
+                ], ordered=False)
+            if rollups:
+                await db.usage_rollups.bulk_write([
+                    UpdateOne({"_id": bucket}, {"$inc": metrics, "$setOnInsert": rollup_bucket_fields(bucket)}, upsert=True)
+                    for bucket, metrics in rollups.items()
+                ], ordered=False)
+        else:
+            await record_store.upsert(records, counters, users, rollups)
+
+    def spill_drainable(self):
+        return self.spill_pending and MONGODB_ENABLED and db is not None
+
+    async def take_spilled(self):
+        """Registros desviados al SQLite local que deben volver a MongoDB en esta escritura, o None"""
+        if not self.spill_drainable():
+            return None
+        try:
+            return await record_store.spilled()
+        except Exception as e:
+            logger.error(f"Error al leer los registros desviados al SQLite local: {e}")
+            return None
+
+    async def clear_spilled(self, spilled):
+        try:
+            if spilled:
+                await record_store.clear_spilled(list(spilled))
+                logger.info(f"Devueltos a MongoDB {len(spilled)} registros que se habían desviado al SQLite local")
+            self.spill_pending = False
+        except Exception as e:
+            logger.error(f"Error al limpiar los registros devueltos a MongoDB: {e}")
+
+    async def spill_overflow(self):
+        """Con el buffer lleno, manda los registros más antiguos al SQLite local para no crecer sin límite.
+
+        Si MongoDB es el almacén configurado quedan aparcados en una tabla aparte y vuelven a
+        MongoDB en la siguiente escritura que tenga éxito.
+        """
+        overflow = len(self.buffer) - RECORD_BUFFER_MAX
+        if overflow <= 0:
+            return
+
+        spilled = [self.buffer.popitem(last=False)[1] for _ in range(overflow)]
+        self.stats['spilled'] += len(spilled)
+        logger.warning(f"Buffer de registros lleno: {len(spilled)} registros enviados al SQLite local")
+        try:
+            if MONGODB_ENABLED and db is not None:
+                await record_store.spill(spilled)
+                self.spill_pending = True
+            else:
+                await record_store.upsert(spilled)
+        except Exception as e:
+            logger.error(f"Se descartaron {len(spilled)} registros de descarga: {e}")
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await self.run_journal(self.close_journal)
+
+record_sink = RecordSink()
+
+async def backfill_mongo_stats():
+    """Calcula una sola vez los contadores de !stats a partir de los registros existentes"""
+    if await db.download_stats.find_one({"_id": "totals"}) is not None:
+        return
+
+    counters = {"total": 0}
+    async for row in db.downloads.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+        counters["total"] += row["count"]
+        if row["_id"]:
+            counters[row["_id"]] = row["count"]
+
+    result = await db.download_stats.update_one({"_id": "totals"}, {"$setOnInsert": counters}, upsert=True)
+    if not result.upserted_id:
+        return
+
+    users = await db.downloads.aggregate([
+        {"$match": {"user_id": {"$ne": None}}},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}, "name": {"$first": "$user_name"}}}
+    ]).to_list(length=None)
+    if users:
+        await db.user_stats.bulk_write([
+            UpdateOne({"_id": user["_id"]}, {"$set": {"name": user["name"]}, "$inc": {"count": user["count"]}}, upsert=True)
+            for user in users
+        ], ordered=False)
+
+    logger.info(f"Contadores de estadísticas inicializados con {counters['total']} registros existentes")
+
+async def save_download_record(record_data):
+    try:
+        if record_sink.add(record_data):
+            await download_queue.remember_counted(record_data)
+    except Exception as e:
+        logger.error(f"Error al guardar registro de descarga: {e}")
+
+class SQLiteRecordStore:
+    """Respaldo local de registros en SQLite (modo WAL) cuando MongoDB no está disponible.
+
+    Todas las operaciones corren en un único hilo dedicado para no bloquear el event loop; cada
+    registro es una fila indexada por download_id con el documento completo en JSON.
+    """
+
+    def __init__(self, path=RECORDS_DB_FILE):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="records-db")
+        self.load = ExecutorLoad(1)
+        self.conn = None
+
+    async def run(self, fn, *args):
+        return await self.load.run(self.executor, fn, *args)
+
+    def connect(self):
+        if self.conn is not None:
+            return self.conn
+
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                download_id TEXT PRIMARY KEY,
+                status TEXT,
+                user_id TEXT,
+                user_name TEXT,
+                timestamp TEXT,
+                data TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_status ON downloads (status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_user ON downloads (user_id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS spilled_records (download_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS stats_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id TEXT PRIMARY KEY,
+                user_name TEXT,
+                count INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_count ON user_stats (count DESC)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_rollups (
+                bucket TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (bucket, metric)
+            ) WITHOUT ROWID
+        """)
+        conn.execute(
+            "DELETE FROM usage_rollups WHERE bucket >= 'h:' AND bucket < ?",
+            (rollup_bucket_id('h', time.time() - USAGE_HOURLY_RETENTION_DAYS * 86400),)
+        )
+        if RECORD_RETENTION_DAYS > 0:
+            purged = conn.execute(
+                "DELETE FROM downloads WHERE CAST(timestamp AS REAL) < ?",
+                (time.time() - RECORD_RETENTION_DAYS * 86400,)
+            ).rowcount
+            if purged:
+                logger.info(f"Eliminados {purged} registros con más de {RECORD_RETENTION_DAYS} días")
+        conn.commit()
+        self.conn = conn
+        self.migrate_json()
+        self.backfill_stats()
+        return conn
+
+    def backfill_stats(self):
+        """Inicializa los contadores a partir de los registros ya guardados si aún no existen"""
+        conn = self.conn
+        if conn.execute("SELECT 1 FROM stats_counters LIMIT 1").fetchone():
+            return
+
+        with conn:
+            statuses = conn.execute("SELECT status, COUNT(*) FROM downloads GROUP BY status").fetchall()
+            conn.execute(
+                "INSERT INTO stats_counters (name, value) VALUES ('total', ?)", (sum(count for _, count in statuses),)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)",
+                [(status, count) for status, count in statuses if status]
+            )
+            conn.execute("DELETE FROM user_stats")
+            conn.execute(
+                "INSERT INTO user_stats (user_id, user_name, count) "
+                "SELECT user_id, MIN(user_name), COUNT(*) FROM downloads WHERE user_id != '' GROUP BY user_id"
+            )
+
+    def migrate_json(self):
+        """Importa una sola vez el antiguo download_records.json y lo deja renombrado"""
+        if not os.path.exists(LEGACY_RECORDS_FILE):
+            return
+
+        try:
+            with open(LEGACY_RECORDS_FILE, "r") as f:
+                records = json.load(f)
+        except Exception as e:
+            logger.error(f"No se pudo leer {LEGACY_RECORDS_FILE} para migrarlo: {e}")
+            return
+
+        if isinstance(records, list) and records:
+            self.upsert_sync(records)
+            logger.info(f"Migrados {len(records)} registros de {LEGACY_RECORDS_FILE} a {self.path}")
+
+        os.replace(LEGACY_RECORDS_FILE, f"{LEGACY_RECORDS_FILE}.migrated")
+
+    def upsert_sync(self, records, counters=None, users=None, rollups=None):
+        conn = self.connect()
+        merged = OrderedDict()
+        for record in records:
+            key = record.get('download_id') or uuid.uuid4().hex
+            merged.setdefault(key, {}).update(record)
+
+        keys = list(merged)
+        stored = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT download_id, data FROM downloads WHERE download_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            stored.update({download_id: json.loads(data) for download_id, data in rows})
+
+        rows = []
+        for key, record in merged.items():
+            document = stored.get(key, {})
+            document.update(record)
+            rows.append((
+                key, document.get('status'), str(document.get('user_id') or ''), document.get('user_name'),
+                document.get('timestamp'), json.dumps(document, default=str)
+            ))
+
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO downloads (download_id, status, user_id, user_name, timestamp, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.executemany(
+                "INSERT INTO stats_counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                list((counters or {}).items())
+            )
+            conn.executemany(
+                "INSERT INTO user_stats (user_id, user_name, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET user_name = excluded.user_name, count = count + excluded.count",
+                [(user_id, name, count) for user_id, (name, count) in (users or {}).items()]
+            )
+            conn.executemany(
+                "INSERT INTO usage_rollups (bucket, metric, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(bucket, metric) DO UPDATE SET value = value + excluded.value",
+                [(bucket, metric, value) for bucket, metrics in (rollups or {}).items() for metric, value in metrics.items()]
+            )
+
+    def find_sync(self, download_id):
+        conn = self.connect()
+        row = (
+            conn.execute("SELECT data FROM spilled_records WHERE download_id = ?", (download_id,)).fetchone()
+            or conn.execute("SELECT data FROM downloads WHERE download_id = ?", (download_id,)).fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    async def find(self, download_id):
+        return await self.run(self.find_sync, download_id)
+
+    def spill_sync(self, records):
+        """Aparca registros que MongoDB no pudo recibir hasta que vuelva a estar disponible"""
+        conn = self.connect()
+        with conn:
+            for record in records:
+                key = record.get('download_id') or uuid.uuid4().hex
+                row = conn.execute("SELECT data FROM spilled_records WHERE download_id = ?", (key,)).fetchone()
+                document = json.loads(row[0]) if row else {}
+                document.update(record)
+                conn.execute(
+                    "INSERT OR REPLACE INTO spilled_records (download_id, data) VALUES (?, ?)",
+                    (key, json.dumps(document, default=str))
+                )
+
+    def spilled_sync(self):
+        conn = self.connect()
+        return OrderedDict((key, json.loads(data)) for key, data in conn.execute("SELECT download_id, data FROM spilled_records"))
+
+    def clear_spilled_sync(self, keys):
+        conn = self.connect()
+        with conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                conn.execute(f"DELETE FROM spilled_records WHERE download_id IN ({','.join('?' * len(chunk))})", chunk)
+
+    async def spill(self, records):
+        await self.run(self.spill_sync, records)
+
+    async def spilled(self):
+        return await self.run(self.spilled_sync)
+
+    async def clear_spilled(self, keys):
+        await self.run(self.clear_spilled_sync, keys)
+
+    def stats_sync(self):
+        conn = self.connect()
+        counts = dict(conn.execute("SELECT name, value FROM stats_counters").fetchall())
+        top_users = [
+            {"_id": user_id, "count": count, "name": user_name or "Usuario"}
+            for user_id, user_name, count in conn.execute(
+                "SELECT user_id, user_name, count FROM user_stats ORDER BY count DESC LIMIT 5"
+            )
+        ]
+        return {
+            "total": counts.get("total", 0),
+            "completed": counts.get("completed", 0),
+            "errors": counts.get("error", 0),
+            "in_progress": max(counts.get("queued", 0) + counts.get("processing", 0), 0),
+            "top_users": top_users
+        }
+
+    async def upsert(self, records, counters=None, users=None, rollups=None):
+        await self.run(self.upsert_sync, records, counters, users, rollups)
+
+    def usage_sync(self, buckets):
+        conn = self.connect()
+        return dict(conn.execute(
+            f"SELECT metric, SUM(value) FROM usage_rollups WHERE bucket IN ({','.join('?' * len(buckets))}) GROUP BY metric",
+            buckets
+        ).fetchall())
+
+    async def get_usage(self, buckets):
+        return await self.run(self.usage_sync, buckets)
+
+    async def get_stats(self):
+        try:
+            return await self.run(self.stats_sync)
+        except Exception as e:
+            logger.error(f"Error al obtener estadísticas locales: {e}")
+            return {"total": 0, "completed": 0, "errors": 0, "in_progress": 0, "top_users": []}
+
+    async def close(self):
+        def close_connection():
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+        await self.run(close_connection)
+
+record_store = SQLiteRecordStore()
+
+def sanitize_info_for_download(info):
+    """Devuelve una copia serializable de la metadata sin la selección de formatos previa"""
+    def strip_selection(obj):
+        if isinstance(obj, dict):
+            return {k: strip_selection(v) for k, v in obj.items() if k not in INFO_SELECTION_KEYS}
+        elif isinstance(obj, list):
+            return [strip_selection(v) for v in obj]
+        return obj
+
+    return strip_selection(yt_dlp.YoutubeDL.sanitize_info(dict(info)))
+
+def write_info_file(download_id, info):
+    """Guarda la metadata ya extraída para que la descarga no tenga que volver a extraerla"""
+    download_path = f"{DOWNLOAD_DIR}/{download_id}"
+    os.makedirs(download_path, exist_ok=True)
+
+    info_file = os.path.join(download_path, INFO_FILE_NAME)
+    with open(info_file, "w", encoding="utf-8") as f:
+        json.dump(sanitize_info_for_download(info), f)
+    return info_file
+
+attachment_cache = OrderedDict()
+
+attachment_cache_stats = {'hits': 0, 'refreshed': 0, 'misses': 0}
+
+def record_attachment(file_info, message, index=0):
+    """Anota en el registro la URL y el mensaje del adjunto que Discord ya aloja"""
+    if message and len(message.attachments) > index:
+        file_info['attachment_url'] = message.attachments[index].url
+        file_info['attachment_name'] = message.attachments[index].filename
+        file_info['message_id'] = message.id
+        file_info['message_channel_id'] = message.channel.id
+
+def attachment_url_expired(url, margin=300):
+    """Las URLs firmadas del CDN de Discord llevan su caducidad en hexadecimal en el parámetro ex"""
+    expires = dict(parse_qsl(urlsplit(url).query)).get('ex')
+    if not expires:
+        return False
+    try:
+        return int(expires, 16) <= time.time() + margin
+    except ValueError:
+        return True
+
+def attachments_from_files(files_info):
+    return [
+        {
+            'name': f['attachment_name'],
+            'url': f['attachment_url'],
+            'message_id': f['message_id'],
+            'channel_id': f['message_channel_id']
+        }
+        for f in files_info
+    ]
+
+def cache_attachments_locally(cache_key, attachments):
+    attachment_cache[cache_key] = (time.time() + ATTACHMENT_CACHE_TTL, attachments)
+    attachment_cache.move_to_end(cache_key)
+    while len(attachment_cache) > ATTACHMENT_CACHE_SIZE:
+        attachment_cache.popitem(last=False)
+
+async def remember_attachments(cache_key, attachments):
+    if not ATTACHMENT_CACHE_ENABLED or not cache_key:
+        return
+
+    cache_attachments_locally(cache_key, attachments)
+
+    if redis_client:
+        try:
+            payload = json.dumps(attachments)
+            await redis_client.set(f"attachments:{cache_key}", payload, ex=ATTACHMENT_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Error al guardar adjuntos en Redis: {e}")
+
+async def forget_attachments(cache_key):
+    attachment_cache.pop(cache_key, None)
+    if redis_client:
+        try:
+            await redis_client.delete(f"attachments:{cache_key}")
+        except Exception as e:
+            logger.warning(f"Error al borrar adjuntos de Redis: {e}")
+
+async def get_cached_attachments(cache_key):
+    """Devuelve adjuntos válidos para la clave, renovando las URLs caducadas desde el mensaje original"""
+    attachments = None
+
+    cached = attachment_cache.get(cache_key)
+    if cached and cached[0] > time.time():
+        attachments = cached[1]
+    elif redis_client:
+        try:
+            payload = await redis_client.get(f"attachments:{cache_key}")
+            if payload:
+                attachments = json.loads(payload)
+                cache_attachments_locally(cache_key, attachments)
+        except Exception as e:
+            logger.warning(f"Error al leer adjuntos de Redis: {e}")
+
+    if not attachments:
+        return None
+
+    if any(attachment_url_expired(a['url']) for a in attachments):
+        try:
+            messages = {}
+            for attachment in attachments:
+                message_id = attachment['message_id']
+                if message_id not in messages:
+                    channel = await resolve_channel(attachment['channel_id'])
+                    messages[message_id] = await channel.fetch_message(message_id)
+                fresh = next(a for a in messages[message_id].attachments if a.filename == attachment['name'])
+                attachment['url'] = fresh.url
+            attachment_cache_stats['refreshed'] += 1
+            await remember_attachments(cache_key, attachments)
+        except Exception as e:
+            logger.info(f"Adjuntos cacheados no disponibles, se volverá a subir el archivo: {e}")
+            await forget_attachments(cache_key)
+            return None
+
+    return attachments
+
+def pack_links(urls, header="", limit=MESSAGE_CONTENT_LIMIT):
+    """Reparte los enlaces, uno por línea y tras la cabecera, en mensajes que no superen el límite de caracteres"""
+    messages = []
+    content = header
+    for url in urls:
+        if content and len(content) + 1 + len(url) > limit:
+            messages.append(content)
+            content = url
+        else:
+            content = f"{content}\n{url}" if content else url
+    if content:
+        messages.append(content)
+    return messages
+
+def delivery_key(download_data):
+    """Clave de lo que se entrega en Discord: el resultado más el límite de subida, que decide si se recodificó o dividió"""
+    if download_data.get('delivery_key'):
+        return download_data['delivery_key']
+    if not download_data.get('cache_key'):
+        return None
+    return f"{download_data['cache_key']}:{download_data.get('upload_limit') or UPLOAD_LIMIT}"
+
+def links_embed(download_data, names, intro):
+    content_type = download_data['content_type']
+    lines = [intro, f"Tipo: {'Audio' if content_type == 'audio' else 'Video'}"]
+    if len(names) > 1:
+        lines.append(f"Archivos: {len(names)}")
+    lines.extend(f"• {name}" for name in names[:SUMMARY_MAX_NAMES])
+    if len(names) > SUMMARY_MAX_NAMES:
+        lines.append(f"• … y {len(names) - SUMMARY_MAX_NAMES} más")
+
+    embed = discord.Embed(
+        title="✅ Descarga Completada",
+        description="\n".join(lines)[:4000],
+        color=discord.Color.green()
+    )
+    embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+    embed.timestamp = datetime.utcnow()
+    return embed
+
+async def send_attachment_links(download_data, channel, urls, embed):
+    """Envía los enlaces, repartidos en mensajes dentro del límite; devuelve False solo si no salió ninguno.
+
+    Si falla a mitad de camino el usuario ya tiene parte de la entrega, así que volver a descargar
+    solo la duplicaría.
+    """
+    messages = pack_links(urls, header=f"<@{download_data['user_id']}>")
+    for index, content in enumerate(messages):
+        try:
+            await channel.send(content=content, embed=embed if index == 0 else None)
+        except discord.HTTPException as e:
+            if index == 0:
+                logger.warning(f"No se pudieron enviar los enlaces de {download_data['download_id']}: {e}")
+                return False
+            logger.error(f"Enviados {index} de {len(messages)} mensajes de enlaces de {download_data['download_id']}: {e}")
+            break
+    return True
+
+async def serve_from_attachment_cache(download_data, channel):
+    """Responde con los enlaces de adjuntos ya subidos si el mismo contenido se envió antes con el mismo límite"""
+    if not ATTACHMENT_CACHE_ENABLED or not download_data.get('cache_key') or channel is None:
+        return False
+
+    attachments = await get_cached_attachments(delivery_key(download_data))
+    if not attachments:
+        attachment_cache_stats['misses'] += 1
+        return False
+
+    embed = links_embed(download_data, [a['name'] for a in attachments], "Este contenido ya se había descargado, aquí lo tienes:")
+    if not await send_attachment_links(download_data, channel, [a['url'] for a in attachments], embed):
+        attachment_cache_stats['misses'] += 1
+        return False
+
+    attachment_cache_stats['hits'] += 1
+
+    download_data['status'] = 'completed'
+    download_data['delivery'] = 'attachment_link'
+    download_data['files'] = [{'name': a['name'], 'attachment_url': a['url']} for a in attachments]
+    download_data['completed_at'] = datetime.utcnow().isoformat()
+    download_data['files_count'] = len(attachments)
+    download_data['files_sent'] = len(attachments)
+    await save_download_record(download_data)
+
+    logger.info(f"Descarga {download_data['download_id']} servida con adjuntos ya alojados en Discord")
+    return True
+
+VIDEO_FORMATS = {
+    '720': "bestvideo[height>=720]+bestaudio/best[height>=720]/best",
+    '480': "bestvideo[height>=480][height<720]+bestaudio/best[height>=480][height<720]/best",
+    '360': "bestvideo[height<480]+bestaudio/best[height<480]/best",
+}
+
+VIDEO_HEIGHT_RANGES = {'720': (720, None), '480': (480, 720), '360': (0, 480)}
+
+AUDIO_FORMATS = {
+    'high': "bestaudio/best",
+    'medium': "bestaudio[abr<=160]/best",
+    'low': "bestaudio[abr<=96]/best",
+}
+
+AUDIO_OUTPUT_KBPS = 192
+
+AUDIO_CONTAINERS = {'mp4': 'm4a', 'webm': 'webm'}
+
+def estimate_format_size(fmt, duration):
+    """Tamaño de un formato según yt-dlp (filesize, filesize_approx) o, si falta, tbr por duración"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return int(size) if size else None
+
+def select_video_format(info, quality, limit):
+    """Elige la combinación concreta de formatos del rango de calidad con mejor resolución que cabe en el límite.
+
+    Devuelve (format_str, tamaño estimado). Si nada cabe se elige la más pequeña del rango, que luego se
+    recodificará; el selector genérico del rango queda como alternativa por si los IDs dejan de existir.
+    """
+    duration = info.get('duration')
+    low, high = VIDEO_HEIGHT_RANGES[quality]
+    formats = info.get('formats') or []
+
+    audios = []
+    for fmt in formats:
+        size = estimate_format_size(fmt, duration)
+        if fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none' and size:
+            audios.append((fmt, size))
+
+    candidates = []
+    for fmt in formats:
+        height = fmt.get('height')
+        if fmt.get('vcodec') == 'none' or not height or height < low or (high is not None and height >= high):
+            continue
+        size = estimate_format_size(fmt, duration)
+        if not size:
+            continue
+
+        if fmt.get('acodec') != 'none':
+            candidates.append((fmt['format_id'], size, fmt))
+        elif audios:
+            container = AUDIO_CONTAINERS.get(fmt.get('ext'))
+            audio, audio_size = max(audios, key=lambda a: (a[0].get('ext') == container, a[0].get('abr') or a[0].get('tbr') or 0))
+            candidates.append((f"{fmt['format_id']}+{audio['format_id']}", size + audio_size, fmt))
+
+    if not candidates:
+        return VIDEO_FORMATS[quality], None
+
+    fitting = [c for c in candidates if c[1] <= limit]
+    if fitting:
+        format_id, size, _ = max(fitting, key=lambda c: (c[2].get('height') or 0, c[2].get('tbr') or 0))
+    else:
+        format_id, size, _ = min(candidates, key=lambda c: c[1])
+
+    return f"{format_id}/{VIDEO_FORMATS[quality]}", size
+
+def estimate_audio_size(info):
+    """El audio siempre se convierte a mp3 a AUDIO_OUTPUT_KBPS, así que su tamaño solo depende de la duración"""
+    duration = info.get('duration')
+    return int(duration * AUDIO_OUTPUT_KBPS * 1000 / 8) if duration else None
+
+def upload_limit_for(guild):
+    """Límite de subida real del servidor de destino según su nivel de boost; UPLOAD_LIMIT en mensajes directos"""
+    if guild is None:
+        return UPLOAD_LIMIT
+    return guild.filesize_limit
+
+def size_label(size, limit):
+    if not size:
+        return ""
+    return f" · ~{size/(1024*1024):.0f} MB{' ⚠️' if size > limit else ''}"
+
+class DownloadView(discord.ui.View):
+    def __init__(self, url, info, ctx, extract_seconds=None):
+        super().__init__(timeout=None)
+        self.url = url
+        self.info = info
+        self.ctx = ctx
+        self.extract_seconds = extract_seconds
+        self.download_id = str(uuid.uuid4())
+
+        self.is_playlist = 'entries' in info
+        if self.is_playlist:
+            self.playlist_size = len(info['entries'])
+            self.title = info.get('title', 'Playlist')
+        else:
+            self.title = info.get('title', 'Desconocido')
+
+        self.upload_limit = upload_limit_for(ctx.guild)
+        self.formats = {}
+        self.estimates = {}
+        if not self.is_playlist:
+            for quality in VIDEO_FORMATS:
+                self.formats[f"video_{quality}"], self.estimates[f"video_{quality}"] = select_video_format(info, quality, self.upload_limit)
+            for quality in AUDIO_FORMATS:
+                self.estimates[f"audio_{quality}"] = estimate_audio_size(info)
+
+        video_options = [
+            ("Alta (720p+)", "720"),
+            ("Media (480p)", "480"),
+            ("Baja (360p-)", "360")
+        ]
+        
+        for label, value in video_options:
+            button = discord.ui.Button(
+                label=label + size_label(self.estimates.get(f"video_{value}"), self.upload_limit),
+                style=discord.ButtonStyle.primary,
+                custom_id=f"video_{value}"
+            )
+            button.callback = self.video_button_callback
+            self.add_item(button)
+
+        audio_options = [
+            ("Audio Alta", "high"),
+            ("Audio Media", "medium"),
+            ("Audio Baja", "low")
+        ]
+        
+        for label, value in audio_options:
+            button = discord.ui.Button(
+                label=label + size_label(self.estimates.get(f"audio_{value}"), self.upload_limit),
+                style=discord.ButtonStyle.success,
+                custom_id=f"audio_{value}"
+            )
+            button.callback = self.audio_button_callback
+            self.add_item(button)
+
+        if self.is_playlist:
+            playlist_button = discord.ui.Button(
+                label=f"Descargar Playlist ({self.playlist_size} videos)", 
+                style=discord.ButtonStyle.danger, 
+                custom_id="playlist"
+            )
+            playlist_button.callback = self.playlist_button_callback
+            self.add_item(playlist_button)
+    
+    async def video_button_callback(self, interaction):
+        custom_id = interaction.data["custom_id"]
+        quality = custom_id.split("_")[1]
+        await interaction.response.defer(ephemeral=True)
+
+        format_str = self.formats.get(custom_id, VIDEO_FORMATS[quality])
+        
+        await interaction.followup.send(f"Descarga de video en calidad {quality}p añadida a la cola.", ephemeral=True)
+        await self.queue_download(format_str, "video", interaction, single=True, estimated_size=self.estimates.get(custom_id))
+    
+    async def audio_button_callback(self, interaction):
+        custom_id = interaction.data["custom_id"]
+        quality = custom_id.split("_")[1]
+        await interaction.response.defer(ephemeral=True)
+
+        format_str = AUDIO_FORMATS[quality]
+            
+        await interaction.followup.send(f"Descarga de audio en calidad {quality} añadida a la cola.", ephemeral=True)
+        await self.queue_download(format_str, "audio", interaction, single=True, estimated_size=self.estimates.get(custom_id))
+    
+    async def playlist_button_callback(self, interaction):
+        await interaction.response.defer(ephemeral=True)
+        await interaction.followup.send(
+            f"Añadiendo a la cola la playlist completa ({self.playlist_size} videos)...", 
+            ephemeral=True
+        )
+        await self.queue_download("bestvideo[height>=480]+bestaudio/best", "video", interaction, single=False)
+    
+    async def queue_download(self, format_str, content_type, interaction, single=True, estimated_size=None):
+
+        duration = None
+        if not self.is_playlist and 'duration' in self.info:
+            duration = self.info['duration']
+        elif self.is_playlist and len(self.info['entries']) > 0:
+
+            duration = 0
+            for entry in self.info['entries']:
+                if isinstance(entry, dict) and 'duration' in entry:
+                    duration += entry.get('duration', 0)
+
+        download_data = {
+            'url': self.url,
+            'format_str': format_str,
+            'content_type': content_type,
+            'user_id': interaction.user.id,
+            'user_name': interaction.user.name,
+            'channel_id': interaction.channel_id,
+            'download_id': self.download_id,
+            'timestamp': time.time(),
+            'datetime': datetime.utcnow().isoformat(),
+            'title': self.title,
+            'duration': duration,
+            'single': single,
+            'is_playlist': self.is_playlist,
+            'status': 'queued',
+            'server_id': interaction.guild_id if interaction.guild else None,
+            'upload_limit': self.upload_limit
+        }
+
+        if self.extract_seconds is not None:
+            download_data['timings'] = {'extract': round(self.extract_seconds, 3)}
+
+        if estimated_size:
+            download_data['estimated_size'] = estimated_size
+
+        download_data['canonical_url'] = canonicalize_url(self.url)
+        download_data['cache_key'] = result_cache_key(download_data)
+        download_data['delivery_key'] = delivery_key(download_data)
+
+        if await serve_from_attachment_cache(download_data, interaction.channel):
+            await interaction.message.edit(view=None)
+            return
+
+        await save_download_record(download_data)
+
+        primary_id = await download_queue.follow_or_register(download_data)
+        if primary_id is not None:
+            await self.join_inflight_download(primary_id, download_data, interaction)
+            return
+
+        if EMBEDDED_WORKERS and self.info.get('extractor') != 'spotify' and single != self.is_playlist:
+            try:
+                download_data['info_file'] = await bot.loop.run_in_executor(None, write_info_file, self.download_id, self.info)
+            except Exception as e:
+                logger.warning(f"No se pudo guardar la metadata de {self.download_id}, se extraerá de nuevo: {e}")
+
+        await download_queue.put(download_data)
+
+        embed = discord.Embed(
+            title="📋 Descarga añadida a la cola",
+            description=(
+                f"{'Video' if content_type == 'video' else 'Audio'} "
+                f"{'individual' if single else f'(playlist con {self.playlist_size} elementos)'} "
+                f"añadido a la cola.\n\n"
+                f"Posición actual: {await download_queue.qsize()}\n"
+                f"ID de descarga: `{self.download_id}`"
+            ),
+            color=discord.Color.blue()
+        )
+
+        embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+        embed.timestamp = datetime.utcnow()
+
+        original_message = interaction.message
+        await original_message.edit(view=None)
+
+        await interaction.channel.send(
+            content=f"<@{interaction.user.id}>",
+            embed=embed
+        )
+
+    async def join_inflight_download(self, primary_id, download_data, interaction):
+        """Notifica que la petición quedó unida a un trabajo idéntico ya en cola o en curso"""
+        download_data['coalesced_into'] = primary_id
+        await save_download_record(download_data)
+
+        logger.info(f"Descarga {download_data['download_id']} unida a la descarga en curso {primary_id}")
+
+        embed = discord.Embed(
+            title="🔗 Unido a una descarga en curso",
+            description=(
+                f"Este mismo contenido ya se está descargando para otra petición, así que recibirás el resultado "
+                f"en cuanto termine.\n\n"
+                f"ID de descarga: `{download_data['download_id']}`"
+            ),
+            color=discord.Color.blue()
+        )
+        embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+        embed.timestamp = datetime.utcnow()
+
+        await interaction.message.edit(view=None)
+        await interaction.channel.send(content=f"<@{interaction.user.id}>", embed=embed)
+
+async def finish_inflight_download(download_data):
+    """Libera la clave single-flight del trabajo y resuelve las peticiones unidas que siguen esperando.
+
+    Si el trabajo produjo archivos ya se repartieron con deliver_to_followers(); aquí solo llegan
+    las de trabajos fallidos, cancelados o sin nada que entregar.
+    """
+    followers = await download_queue.finish(download_data)
+    for follower in followers:
+        try:
+            await settle_follower(download_data, follower)
+        except Exception as e:
+            logger.error(f"Error al entregar la descarga unida {follower['download_id']}: {str(e)}")
+
+async def deliver_to_followers(download_data, files_info):
+    """Reparte el resultado del trabajo principal entre las peticiones unidas mientras sus archivos siguen en disco.
+
+    Los archivos que el principal ya subió se reenvían como enlaces y el resto se vuelve a subir
+    desde disco, así que no depende de la caché de adjuntos ni de que la subida del principal
+    saliera entera.
+    """
+    followers = await download_queue.finish(download_data)
+    for follower in followers:
+        try:
+            await deliver_to_follower(follower, files_info)
+        except Exception as e:
+            logger.error(f"Error al entregar la descarga unida {follower['download_id']}: {str(e)}")
+
+async def deliver_to_follower(follower, files_info):
+    if await download_queue.consume_cancel(follower['download_id']):
+        follower['status'] = 'cancelled'
+        await save_download_record(follower)
+        return
+
+    channel = await resolve_channel(follower['channel_id'])
+    if channel is None:
+        follower['status'] = 'error'
+        follower['error'] = 'Canal de destino no disponible'
+        await save_download_record(follower)
+        return
+
+    files = [dict(f) for f in files_info]
+    linked = [f for f in files if 'attachment_url' in f]
+    embed = links_embed(follower, [f.get('upload_name', f['name']) for f in files], "Otra petición descargó este mismo contenido, aquí lo tienes:")
+
+    sent_links = bool(linked) and await send_attachment_links(follower, channel, [f['attachment_url'] for f in linked], embed)
+    pending = [f for f in files if 'attachment_url' not in f] if sent_links else files
+    if pending:
+        await deliver_files(follower, channel, pending, None if sent_links else embed)
+
+    follower['status'] = 'completed'
+    follower['delivery'] = 'coalesced'
+    follower['files'] = files
+    follower['completed_at'] = datetime.utcnow().isoformat()
+    follower['files_count'] = len(files)
+    follower['files_sent'] = sum(1 for f in files if 'attachment_url' in f)
+    await save_download_record(follower)
+
+    logger.info(f"Descarga unida {follower['download_id']} entregada con el resultado de {follower.get('coalesced_into')}")
+
+async def settle_follower(download_data, follower):
+    if await download_queue.consume_cancel(follower['download_id']):
+        follower['status'] = 'cancelled'
+        await save_download_record(follower)
+        return
+
+    channel = await resolve_channel(follower['channel_id'])
+
+    if download_data['status'] == 'completed':
+        if await serve_from_attachment_cache(follower, channel):
+            return
+
+    if download_data['status'] == 'error':
+        if channel:
+            error_embed = discord.Embed(
+                title="❌ Error en la descarga",
+                description=f"No se pudo completar la descarga: {download_data.get('error', 'Error desconocido')[:1500]}",
+                color=discord.Color.red()
+            )
+            error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+            error_embed.timestamp = datetime.utcnow()
+
+            await channel.send(content=f"<@{follower['user_id']}>", embed=error_embed)
+
+        follower['status'] = 'error'
+        follower['error'] = download_data.get('error')
+        await save_download_record(follower)
+        return
+
+    follower.pop('coalesced_into', None)
+    if await download_queue.follow_or_register(follower) is None:
+        await download_queue.put(follower)
+
+async def download_worker(worker_id):
+    """Consume trabajos de la cola esperando bloqueado en ella, sin sondeos"""
+    while True:
+        download_data = await download_queue.get()
+        attempts = download_queue.attempts(download_data)
+        try:
+            if attempts > 1:
+                await record_sink.restore_counted_status(download_data)
+
+            if await download_queue.consume_cancel(download_data['download_id']):
+                download_data['status'] = 'cancelled'
+                await save_download_record(download_data)
+                await finish_inflight_download(download_data)
+            elif download_data.get('counted_status') in TERMINAL_STATUSES:
+                logger.info(f"La descarga {download_data['download_id']} ya había terminado antes de la interrupción: se descarta la reentrega")
+                download_data['status'] = download_data['counted_status']
+                await finish_inflight_download(download_data)
+            elif attempts > QUEUE_MAX_ATTEMPTS:
+                await dead_letter_download(download_data, attempts)
+            else:
+                await run_download_job(download_data)
+        except asyncio.CancelledError:
+            logger.info(f"Worker {worker_id} detenido con la descarga {download_data['download_id']} sin terminar: queda pendiente para reanudarse")
+            download_queue.release(download_data)
+            raise
+        except Exception as e:
+            logger.error(f"Error no controlado en el worker {worker_id}: {str(e)}")
+            download_queue.release(download_data)
+            continue
+
+        await download_queue.ack(download_data)
+
+async def dead_letter_download(download_data, attempts):
+    """Aparta un trabajo que ha fallado repetidamente para que no bloquee a los workers"""
+    reason = f"Descartada tras {attempts - 1} intentos interrumpidos"
+    logger.error(f"Descarga {download_data['download_id']} enviada a la cola de fallidos: {reason}")
+
+    await download_queue.dead_letter(download_data, reason)
+
+    channel = await resolve_channel(download_data['channel_id'])
+    if channel:
+        error_embed = discord.Embed(
+            title="❌ Error en la descarga",
+            description=f"La descarga con ID `{download_data['download_id']}` falló repetidamente y fue descartada.",
+            color=discord.Color.red()
+        )
+        error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+        error_embed.timestamp = datetime.utcnow()
+
+        await channel.send(content=f"<@{download_data['user_id']}>", embed=error_embed)
+
+    download_data['status'] = 'error'
+    download_data['error'] = reason
+    await save_download_record(download_data)
+    await finish_inflight_download(download_data)
+
+async def resolve_channel(channel_id):
+    """Obtiene el canal de la caché del gateway o, en los nodos sin gateway, por la API HTTP"""
+    channel = bot.get_channel(channel_id)
+    if channel is not None:
+        return channel
+
+    try:
+        return await bot.fetch_channel(channel_id)
+    except discord.HTTPException as e:
+        logger.warning(f"No se pudo obtener el canal {channel_id}: {e}")
+        return None
+
+async def run_download_job(download_data):
+    download_id = download_data['download_id']
+    active_downloads.append(download_id)
+    processing_started = time.monotonic()
+    interrupted = False
+
+    try:
+        download_data['status'] = 'processing'
+        download_data['started_at'] = time.time()
+        download_data.setdefault('timings', {})['queue_wait'] = round(max(time.time() - download_data['timestamp'], 0), 3)
+        await save_download_record(download_data)
+
+        video_duration = download_data.get('duration', 0)
+        if video_duration and isinstance(video_duration, (int, float)) and video_duration > 0:
+
+            timeout = min(max(video_duration * 2, 120), 1800)
+            logger.info(f"Timeout dinámico para descarga {download_id}: {timeout} segundos (duración del video: {video_duration} segundos)")
+        else:
+            timeout = DOWNLOAD_TIMEOUT
+            logger.info(f"Usando timeout predeterminado para descarga {download_id}: {timeout} segundos")
+
+        task = asyncio.create_task(process_download(download_data))
+        running_jobs[download_id] = {'task': task, 'data': download_data}
+        try:
+            await asyncio.wait_for(task, timeout=timeout)
+        except asyncio.CancelledError:
+            if download_id not in cancel_requests:
+                raise
+
+            logger.info(f"Descarga {download_id} cancelada por el usuario")
+            download_data['status'] = 'cancelled'
+            await save_download_record(download_data)
+        except asyncio.TimeoutError:
+
+            logger.error(f"La descarga {download_id} excedió el tiempo límite ({timeout} segundos)")
+
+            channel = await resolve_channel(download_data['channel_id'])
+            if channel:
+                timeout_embed = discord.Embed(
+                    title="⏱️ Tiempo de descarga excedido",
                     description=(
-                        f"La descarga con ID `{download_data['download_id']}` fue cancelada porque excedió el tiempo límite de {timeout//60} minutos.\n"
+                        f"La descarga con ID `{download_id}` fue cancelada porque excedió el tiempo límite de {timeout//60} minutos.\n"
                         f"Título: **{download_data.get('title', 'Desconocido')}**\n"
                         f"Esto suele ocurrir con videos muy largos o conexiones lentas."
                     ),
@@ -405,31 +2280,828 @@ async def download_worker():
                 
                 await channel.send(content=f"<@{download_data['user_id']}>", embed=timeout_embed)
 
-            download_data['status'] = 'error'
-            download_data['error'] = f'Tiempo de descarga excedido ({timeout//60} minutos)'
-            await save_download_record(download_data)
+            download_data['status'] = 'error'
+            download_data['error'] = f'Tiempo de descarga excedido ({timeout//60} minutos)'
+            await save_download_record(download_data)
+
+            try:
+                download_path = f"{DOWNLOAD_DIR}/{download_id}"
+                if os.path.exists(download_path):
+                    shutil.rmtree(download_path)
+            except Exception as e:
+                logger.error(f"Error al limpiar tras timeout: {str(e)}")
+
+        add_stage_time(download_data, 'processing', time.monotonic() - processing_started)
+        log_job_timings(download_data)
+        observe_job_metrics(download_data)
+        await save_download_record(download_data)
+    except asyncio.CancelledError:
+        interrupted = True
+        raise
+    finally:
+        running_jobs.pop(download_id, None)
+        cancel_requests.discard(download_id)
+        if not interrupted:
+            await finish_inflight_download(download_data)
+        if download_id in active_downloads:
+            active_downloads.remove(download_id)
+
+async def kill_process_group(proc):
+    """Termina un proceso hijo junto con todo su grupo (ffmpeg incluido) y lo recoge"""
+    if proc.returncode is not None:
+        return
+
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=PROCESS_KILL_GRACE)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+async def run_killable_process(cmd, input_data=None):
+    """Ejecuta un comando en su propio grupo de procesos, matándolo si la tarea se cancela"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=subprocess.PIPE if input_data is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    child_process_stats['running'] += 1
+    child_process_stats['started'] += 1
+
+    try:
+        stdout, stderr = await proc.communicate(input_data)
+    except asyncio.CancelledError:
+        await asyncio.shield(kill_process_group(proc))
+        raise
+    finally:
+        child_process_stats['running'] -= 1
+
+    return proc.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+
+async def run_ytdlp(url, ydl_opts, info_file=None):
+    """Ejecuta yt-dlp según DOWNLOAD_ISOLATION: en un proceso hijo terminable o en el pool de hilos"""
+    if DOWNLOAD_ISOLATION == "thread":
+        return await download_executor_load.run(download_executor, run_download, url, ydl_opts, info_file)
+
+    job = json.dumps({'url': url, 'ydl_opts': ydl_opts, 'info_file': info_file}).encode()
+    runner_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ytdlp_runner.py")
+
+    returncode, stdout, stderr = await run_killable_process([sys.executable, runner_path], input_data=job)
+
+    for line in reversed(stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+            return result['success'], result['error'], result.get('stats') or {}
+
+    return False, f"El proceso de descarga terminó inesperadamente (código {returncode}): {stderr[-500:]}", {}
+
+async def probe_media(file_path):
+    """Obtiene con ffprobe la duración del archivo y la altura de su pista de vídeo, si la tiene"""
+    returncode, stdout, stderr = await run_killable_process([
+        "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", file_path
+    ])
+    if returncode != 0:
+        raise RuntimeError(f"ffprobe terminó con código {returncode}: {stderr[-300:]}")
+
+    probe = json.loads(stdout)
+    video = next(
+        (s for s in probe.get('streams', [])
+         if s.get('codec_type') == 'video' and not s.get('disposition', {}).get('attached_pic')),
+        None
+    )
+    return {
+        'duration': float(probe.get('format', {}).get('duration') or 0),
+        'height': video.get('height') if video else None,
+        'has_video': video is not None,
+    }
+
+def transcode_plan(duration, limit, media, attempt):
+    """Reparte el presupuesto de bits del límite entre audio y vídeo; cada reintento baja un escalón de resolución"""
+    total_kbps = limit * 8 * TRANSCODE_HEADROOM / duration / 1000
+
+    if not media['has_video']:
+        audio_kbps = int(min(total_kbps, 192) * (0.9 ** attempt))
+        return {'audio_kbps': audio_kbps} if audio_kbps >= TRANSCODE_MIN_AUDIO_KBPS else None
+
+    audio_kbps = 128 if total_kbps >= 1500 else 96 if total_kbps >= 600 else 64 if total_kbps >= 300 else 48
+    video_kbps = int((total_kbps - audio_kbps) * (0.9 ** attempt))
+    if video_kbps < TRANSCODE_MIN_VIDEO_KBPS:
+        return None
+
+    step = next(i for i, (min_kbps, _) in enumerate(TRANSCODE_HEIGHTS) if video_kbps >= min_kbps)
+    height = TRANSCODE_HEIGHTS[min(step + attempt, len(TRANSCODE_HEIGHTS) - 1)][1]
+    if media['height'] and height >= media['height']:
+        height = None
+
+    return {'audio_kbps': audio_kbps, 'video_kbps': video_kbps, 'height': height}
+
+def transcode_commands(file_path, output_path, plan):
+    if 'video_kbps' not in plan:
+        return [[
+            "ffmpeg", "-y", "-v", "error", "-i", file_path, "-map", "0:a:0", "-vn",
+            "-c:a", "libmp3lame", "-b:a", f"{plan['audio_kbps']}k", output_path
+        ]]
+
+    passlog = f"{output_path}.passlog"
+    video_args = ["-c:v", "libx264", "-preset", TRANSCODE_PRESET, "-b:v", f"{plan['video_kbps']}k"]
+    if plan['height']:
+        video_args += ["-vf", f"scale=-2:{plan['height']}"]
+
+    return [
+        ["ffmpeg", "-y", "-v", "error", "-i", file_path, "-map", "0:v:0", *video_args,
+         "-pass", "1", "-passlogfile", passlog, "-an", "-f", "null", os.devnull],
+        ["ffmpeg", "-y", "-v", "error", "-i", file_path, "-map", "0:v:0", "-map", "0:a:0?", *video_args,
+         "-pass", "2", "-passlogfile", passlog, "-c:a", "aac", "-b:a", f"{plan['audio_kbps']}k",
+         "-movflags", "+faststart", output_path],
+    ]
+
+async def fit_to_limit(download_data, file_path, download_path, limit):
+    """Recodifica en ffmpeg un archivo que supera el límite de subida con una tasa de bits calculada a partir de su duración.
+
+    El vídeo va en dos pasadas con libx264 y el audio a una tasa escalada al presupuesto; si el resultado
+    aún no cabe se reintenta con menos resolución. Devuelve (ruta, tamaño, plan) o None si no es posible.
+    """
+    if not TRANSCODE_ENABLED:
+        return None
+
+    try:
+        media = await probe_media(file_path)
+    except Exception as e:
+        logger.error(f"No se pudo analizar {file_path} para recodificarlo: {e}")
+        return None
+
+    duration = media['duration'] or (download_data.get('duration') if download_data.get('single') else None)
+    if not duration:
+        logger.warning(f"Duración desconocida para {file_path}: no se puede calcular la tasa de bits objetivo")
+        return None
+
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    output_path = os.path.join(download_path, f"{stem}.fit.{'mp4' if media['has_video'] else 'mp3'}")
+
+    for attempt in range(TRANSCODE_ATTEMPTS):
+        plan = transcode_plan(duration, limit, media, attempt)
+        if plan is None:
+            logger.info(f"{file_path} ({duration:.0f} s) no cabe en {limit} bytes ni con la calidad mínima")
+            return None
+
+        logger.info(f"Recodificando {file_path} para ajustarlo a {limit} bytes: {plan}")
+        for cmd in transcode_commands(file_path, output_path, plan):
+            returncode, _, stderr = await run_killable_process(cmd)
+            if returncode != 0:
+                logger.error(f"ffmpeg terminó con código {returncode} al recodificar {file_path}: {stderr[-500:]}")
+                return None
+
+        output_size = os.path.getsize(output_path)
+        if output_size <= limit:
+            return output_path, output_size, plan
+
+        logger.info(f"La recodificación de {file_path} ocupa {output_size} bytes, reintentando con menos resolución")
+
+    return None
+
+async def split_to_limit(file_path, download_path, limit):
+    """Parte un archivo en segmentos consecutivos con el muxer segment de ffmpeg en modo copia, sin recodificar.
+
+    La duración de cada segmento sale de la tasa media del archivo; como los cortes caen en keyframes,
+    si alguna parte supera el límite se repite con segmentos más cortos. Devuelve [(ruta, tamaño)] o None.
+    """
+    try:
+        media = await probe_media(file_path)
+    except Exception as e:
+        logger.error(f"No se pudo analizar {file_path} para dividirlo: {e}")
+        return None
+
+    file_size = os.path.getsize(file_path)
+    if not media['duration']:
+        logger.warning(f"Duración desconocida para {file_path}: no se puede dividir")
+        return None
+
+    extension = os.path.splitext(file_path)[1]
+    parts_dir = os.path.join(download_path, f"parts-{uuid.uuid4().hex[:8]}")
+    streams = ["-map", "0:v:0", "-map", "0:a:0?"] if media['has_video'] else ["-map", "0:a:0"]
+    segment_time = media['duration'] * limit * SPLIT_HEADROOM / file_size
+
+    for attempt in range(SPLIT_ATTEMPTS):
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+
+        returncode, _, stderr = await run_killable_process([
+            "ffmpeg", "-y", "-v", "error", "-i", file_path, *streams, "-c", "copy",
+            "-f", "segment", "-segment_time", f"{segment_time:.3f}", "-reset_timestamps", "1",
+            os.path.join(parts_dir, f"part%03d{extension}")
+        ])
+        if returncode != 0:
+            logger.error(f"ffmpeg terminó con código {returncode} al dividir {file_path}: {stderr[-500:]}")
+            return None
+
+        parts = [os.path.join(parts_dir, name) for name in sorted(os.listdir(parts_dir))]
+        if len(parts) > SPLIT_MAX_PARTS:
+            logger.info(f"{file_path} necesitaría {len(parts)} partes, más que SPLIT_MAX_PARTS ({SPLIT_MAX_PARTS})")
+            return None
+
+        sizes = [os.path.getsize(part) for part in parts]
+        if parts and max(sizes) <= limit:
+            return list(zip(parts, sizes))
+
+        logger.info(f"Alguna parte de {file_path} supera el límite, reintentando con segmentos más cortos")
+        segment_time *= 0.7
+
+    return None
+
+def oversize_strategies(content_type):
+    """Orden en que se prueban las estrategias para archivos que superan el límite; en auto el audio se divide primero"""
+    if OVERSIZE_STRATEGY == "auto":
+        return ("split", "transcode") if content_type == "audio" else ("transcode", "split")
+    return (OVERSIZE_STRATEGY,)
+
+async def prepare_upload(download_data, file_path, download_path, upload_limit):
+    """Devuelve los adjuntos en que se entrega un archivo (tal cual, recodificado o en partes), o None si no cabe"""
+    file_size = os.path.getsize(file_path)
+    file_name = os.path.basename(file_path)
+    stem, extension = os.path.splitext(file_name)
+
+    file_info = {
+        'name': file_name,
+        'size': file_size,
+        'path': file_path,
+        'compressed': False
+    }
+
+    if file_size <= upload_limit:
+        return [file_info]
+
+    for strategy in oversize_strategies(download_data['content_type']):
+        if strategy == "transcode":
+            with timed_stage(download_data, 'transcode'):
+                fitted = await fit_to_limit(download_data, file_path, download_path, upload_limit)
+            if fitted:
+                compressed_path, compressed_size, plan = fitted
+                file_info['upload_name'] = stem + os.path.splitext(compressed_path)[1]
+                file_info['compressed'] = True
+                file_info['compressed_size'] = compressed_size
+                file_info['compressed_path'] = compressed_path
+                file_info['transcode'] = plan
+                return [file_info]
+
+        elif strategy == "split":
+            with timed_stage(download_data, 'split'):
+                parts = await split_to_limit(file_path, download_path, upload_limit)
+            if parts:
+                return [
+                    {
+                        'name': f"{stem} - Parte {index} de {len(parts)}{extension}",
+                        'size': part_size,
+                        'path': part_path,
+                        'compressed': False,
+                        'part': index,
+                        'parts': len(parts),
+                        'source_name': file_name
+                    }
+                    for index, (part_path, part_size) in enumerate(parts, start=1)
+                ]
+
+    return None
+
+MAX_ATTACHMENTS_PER_MESSAGE = 10
+
+SUMMARY_MAX_NAMES = 15
+
+def upload_size(file_info):
+    return file_info.get('compressed_size', file_info['size'])
+
+def pack_attachments(files_info, limit):
+    """Agrupa los adjuntos, en orden, en mensajes de hasta MAX_ATTACHMENTS_PER_MESSAGE archivos sin superar el límite total"""
+    batches = []
+    batch = []
+    batch_size = 0
+    for file_info in files_info:
+        size = upload_size(file_info)
+        if batch and (len(batch) >= MAX_ATTACHMENTS_PER_MESSAGE or batch_size + size > limit):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(file_info)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def delivery_summary(title, download_data, files_info, notes=()):
+    """Embed único que acompaña a la entrega con la lista de archivos y los avisos del procesado"""
+    names = [f.get('upload_name', f['name']) for f in files_info]
+    lines = [f"Tipo: {'Audio' if download_data['content_type'] == 'audio' else 'Video'}"]
+
+    if len(names) == 1:
+        lines.insert(0, f"Archivo: **{names[0]}**")
+    else:
+        lines.append(f"Archivos: {len(names)}")
+        lines.extend(f"• {name}" for name in names[:SUMMARY_MAX_NAMES])
+        if len(names) > SUMMARY_MAX_NAMES:
+            lines.append(f"• … y {len(names) - SUMMARY_MAX_NAMES} más")
+
+    if any(f['compressed'] for f in files_info):
+        lines.append("⚠️ *Algunos archivos se recodificaron a menor calidad para ajustarse al límite de subida*" if len(names) > 1 else "⚠️ *El archivo se recodificó a menor calidad para ajustarse al límite de subida*")
+    if any('part' in f for f in files_info):
+        lines.append("✂️ *Los archivos que superaban el límite de subida se dividieron en partes*")
+    lines.extend(notes)
+
+    embed = discord.Embed(title=title, description="\n".join(lines)[:4000], color=discord.Color.green())
+    embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+    embed.timestamp = datetime.utcnow()
+    return embed
+
+async def send_attachment_batch(download_data, channel, batch, embed=None):
+    """Sube un lote de adjuntos en un solo mensaje; si Discord lo rechaza, reintenta los archivos uno a uno"""
+    user_id = download_data['user_id']
+    try:
+        files = [discord.File(f.get('compressed_path', f['path']), filename=f.get('upload_name', f['name'])) for f in batch]
+
+        upload_started = time.monotonic()
+        message = await channel.send(content=f"<@{user_id}>" if embed else None, embed=embed, files=files)
+        record_upload(
+            download_data, [f.get('upload_name', f['name']) for f in batch],
+            sum(upload_size(f) for f in batch), time.monotonic() - upload_started
+        )
+        for index, file_info in enumerate(batch):
+            record_attachment(file_info, message, index)
+    except Exception as e:
+        if len(batch) > 1:
+            logger.warning(f"Error al enviar un lote de {len(batch)} archivos, se enviarán por separado: {str(e)}")
+            for index, file_info in enumerate(batch):
+                await send_attachment_batch(download_data, channel, [file_info], embed if index == 0 else None)
+            return
+
+        logger.error(f"Error al enviar archivo: {str(e)}")
+        error_embed = discord.Embed(
+            title="❌ Error al enviar archivo",
+            description=f"No se pudo enviar el archivo: {str(e)}",
+            color=discord.Color.red()
+        )
+        error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+        error_embed.timestamp = datetime.utcnow()
+
+        await channel.send(content=f"<@{user_id}>", embed=error_embed)
+
+async def deliver_files(download_data, channel, files_info, summary_embed):
+    """Entrega los archivos en el menor número de mensajes posible; solo el primero lleva el embed resumen"""
+    upload_limit = download_data.get('upload_limit') or UPLOAD_LIMIT
+    for index, batch in enumerate(pack_attachments(files_info, upload_limit)):
+        await send_attachment_batch(download_data, channel, batch, summary_embed if index == 0 else None)
+
+def add_stage_time(download_data, stage, seconds):
+    timings = download_data.setdefault('timings', {})
+    timings[stage] = round(timings.get(stage, 0) + seconds, 3)
+
+@contextmanager
+def timed_stage(download_data, stage):
+    """Suma al registro el tiempo monotónico que pasa dentro del bloque como la etapa `stage`"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        add_stage_time(download_data, stage, time.monotonic() - started)
+
+def record_upload(download_data, file_names, size, seconds):
+    add_stage_time(download_data, 'upload', seconds)
+    download_data.setdefault('uploads', []).append({'names': file_names, 'bytes': size, 'seconds': round(seconds, 3)})
+    download_data['bytes_uploaded'] = download_data.get('bytes_uploaded', 0) + size
+
+def log_job_timings(download_data):
+    """Emite los tiempos por etapa de un trabajo como una línea JSON para poder agregarlos desde los logs"""
+    logger.info("job_timings " + json.dumps({
+        'download_id': download_data['download_id'],
+        'status': download_data.get('status'),
+        'platform': platform_key(download_data.get('url')),
+        'content_type': download_data.get('content_type'),
+        'cache_hit': download_data.get('cache_hit', False),
+        'timings': download_data.get('timings', {}),
+        'bytes_downloaded': download_data.get('bytes_downloaded', 0),
+        'bytes_uploaded': download_data.get('bytes_uploaded', 0),
+        'uploads': len(download_data.get('uploads', [])),
+    }))
+
+def error_category(error):
+    """Agrupa los mensajes de error de un trabajo en pocas categorías estables para las métricas"""
+    text = (error or '').lower()
+    if 'tiempo de descarga excedido' in text:
+        return 'timeout'
+    if 'privado' in text or 'private' in text or 'sign in' in text:
+        return 'private'
+    if 'spotdl' in text:
+        return 'spotdl'
+    if 'demasiado grande' in text or 'too large' in text or 'request entity' in text:
+        return 'too_large'
+    if 'terminó inesperadamente' in text:
+        return 'crash'
+    if 'discord' in text or 'http' in text:
+        return 'discord'
+    if text.startswith('error:') or 'unsupported url' in text or 'unable to' in text:
+        return 'extractor'
+    return 'other'
+
+def observe_job_metrics(download_data):
+    platform = platform_key(download_data.get('url'))
+    status = download_data.get('status')
+    metrics_registry.inc("yadb_jobs_total", platform=platform, status=status)
+    if status == 'error':
+        metrics_registry.inc("yadb_job_errors_total", category=error_category(download_data.get('error')))
+
+    for stage, seconds in download_data.get('timings', {}).items():
+        metrics_registry.observe("yadb_job_stage_seconds", seconds, platform=platform, stage=stage)
+
+    metrics_registry.inc("yadb_bytes_downloaded_total", download_data.get('bytes_downloaded', 0), platform=platform)
+    metrics_registry.inc("yadb_bytes_uploaded_total", download_data.get('bytes_uploaded', 0), platform=platform)
+
+def start_download_workers():
+    """Arranca MAX_DOWNLOADS consumidores supervisados de la cola"""
+    for worker_id in range(MAX_DOWNLOADS):
+        if worker_id not in download_workers or download_workers[worker_id].done():
+            spawn_download_worker(worker_id)
+
+async def stop_download_workers():
+    """Cancela los workers y espera a que terminen: sus trabajos quedan pendientes en la cola para reanudarse"""
+    tasks = [task for task in download_workers.values() if not task.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def spawn_download_worker(worker_id):
+    task = bot.loop.create_task(download_worker(worker_id), name=f"download-worker-{worker_id}")
+    download_workers[worker_id] = task
+    task.add_done_callback(lambda t: on_download_worker_done(worker_id, t))
+
+def on_download_worker_done(worker_id, task):
+    if task.cancelled() or bot.is_closed():
+        return
+
+    logger.error(f"El worker de descargas {worker_id} terminó inesperadamente: {task.exception()}. Reiniciándolo")
+    spawn_download_worker(worker_id)
+
+result_cache_index = OrderedDict()
+
+result_cache_pins = {}
+
+result_cache_retired = set()
+
+result_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def result_cache_key(download_data):
+    """Clave de contenido de un resultado: URL canónica, formato, tipo y modo playlist"""
+    raw = "|".join([
+        download_data['canonical_url'],
+        download_data['format_str'],
+        download_data['content_type'],
+        'single' if download_data['single'] else 'playlist'
+    ])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def result_entry_dir(key, entry):
+    """Directorio de una entrada; las entradas antiguas del índice usan la propia clave"""
+    return os.path.join(RESULT_CACHE_DIR, entry.get('dir', key))
+
+def load_result_cache_index():
+    """Lee el índice de la caché de resultados y descarta entradas incompletas o huérfanas"""
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    index_path = os.path.join(RESULT_CACHE_DIR, "index.json")
+
+    entries = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r") as f:
+                entries = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"Índice de caché de resultados ilegible, se reconstruye vacío: {e}")
+
+    valid = {
+        key: entry for key, entry in entries.items()
+        if all(os.path.exists(os.path.join(result_entry_dir(key, entry), name)) for name in entry['files'])
+    }
+    valid_dirs = {os.path.basename(result_entry_dir(key, entry)) for key, entry in valid.items()}
+
+    for item in os.listdir(RESULT_CACHE_DIR):
+        item_path = os.path.join(RESULT_CACHE_DIR, item)
+        if os.path.isdir(item_path) and item not in valid_dirs:
+            shutil.rmtree(item_path, ignore_errors=True)
+
+    return OrderedDict(sorted(valid.items(), key=lambda kv: kv[1]['last_used']))
+
+def write_result_cache_index(entries):
+    index_path = os.path.join(RESULT_CACHE_DIR, "index.json")
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, index_path)
+
+async def setup_result_cache():
+    global result_cache_index
+    try:
+        result_cache_index = await bot.loop.run_in_executor(None, load_result_cache_index)
+        total = sum(entry['size'] for entry in result_cache_index.values())
+        logger.info(f"Caché de resultados cargada: {len(result_cache_index)} entradas, {total/(1024*1024):.1f} MB")
+    except Exception as e:
+        logger.error(f"Error al cargar la caché de resultados: {e}")
+
+async def persist_result_cache_index():
+    try:
+        await bot.loop.run_in_executor(None, write_result_cache_index, dict(result_cache_index))
+    except Exception as e:
+        logger.error(f"Error al guardar el índice de la caché de resultados: {e}")
+
+def pin_result_dir(entry_dir):
+    result_cache_pins[entry_dir] = result_cache_pins.get(entry_dir, 0) + 1
+    return entry_dir
+
+def retire_result_dir(entry_dir):
+    """Borra el directorio de una entrada sustituida o expulsada, o lo aparta hasta que nadie lo use"""
+    if result_cache_pins.get(entry_dir):
+        result_cache_retired.add(entry_dir)
+    else:
+        bot.loop.run_in_executor(None, lambda: shutil.rmtree(entry_dir, ignore_errors=True))
+
+async def acquire_cached_result(key):
+    """Devuelve (pin, rutas) de un resultado cacheado, fijando su directorio para que no se borre mientras se usa"""
+    entry = result_cache_index.get(key)
+    if entry is None:
+        result_cache_stats['misses'] += 1
+        return None, None
+
+    entry_dir = result_entry_dir(key, entry)
+    paths = [os.path.join(entry_dir, name) for name in entry['files']]
+    if not all(await bot.loop.run_in_executor(None, lambda: [os.path.exists(p) for p in paths])):
+        del result_cache_index[key]
+        result_cache_stats['misses'] += 1
+        return None, None
+
+    pin = pin_result_dir(entry_dir)
+    entry['last_used'] = time.time()
+    entry['hits'] = entry.get('hits', 0) + 1
+    result_cache_index.move_to_end(key)
+    result_cache_stats['hits'] += 1
+
+    await persist_result_cache_index()
+    return pin, paths
+
+def release_cached_result(pin):
+    remaining = result_cache_pins.get(pin, 0) - 1
+    if remaining > 0:
+        result_cache_pins[pin] = remaining
+        return
+
+    result_cache_pins.pop(pin, None)
+    if pin in result_cache_retired:
+        result_cache_retired.discard(pin)
+        retire_result_dir(pin)
+
+async def store_cached_result(key, files, download_path):
+    """Mueve los archivos descargados a una entrada nueva de la caché y la fija para el envío en curso.
+
+    Los archivos conservan su ruta relativa a download_path (las playlists recursivas pueden
+    repetir nombres en subcarpetas) y la entrada se prepara en un directorio temporal que se
+    publica entero con un rename, así que nunca se tocan los archivos de una entrada que otro
+    trabajo esté subiendo.
+    """
+    budget = RESULT_CACHE_MAX_MB * 1024 * 1024
+    entry_name = f"{key}.{uuid.uuid4().hex[:8]}"
+    entry_dir = os.path.join(RESULT_CACHE_DIR, entry_name)
+
+    def move_into_cache():
+        size = sum(os.path.getsize(f) for f in files)
+        if size > budget:
+            return None, size
+
+        staging_dir = f"{entry_dir}.tmp"
+        names = []
+        for file_path in files:
+            name = os.path.relpath(file_path, download_path)
+            if name.startswith(os.pardir):
+                name = os.path.basename(file_path)
+            target = os.path.join(staging_dir, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(file_path, target)
+            names.append(name)
+        os.rename(staging_dir, entry_dir)
+        return names, size
+
+    try:
+        names, size = await bot.loop.run_in_executor(None, move_into_cache)
+    except Exception as e:
+        logger.error(f"Error al guardar el resultado en caché: {e}")
+        return None, None
+
+    if names is None:
+        return None, None
+
+    previous = result_cache_index.get(key)
+    result_cache_index[key] = {'dir': entry_name, 'files': names, 'size': size, 'last_used': time.time(), 'hits': 0}
+    result_cache_index.move_to_end(key)
+    pin = pin_result_dir(entry_dir)
+    if previous is not None:
+        retire_result_dir(result_entry_dir(key, previous))
+
+    await evict_result_cache()
+    await persist_result_cache_index()
+
+    return pin, [os.path.join(entry_dir, name) for name in names]
+
+async def evict_result_cache():
+    """Expulsa las entradas menos usadas recientemente hasta respetar RESULT_CACHE_MAX_MB"""
+    budget = RESULT_CACHE_MAX_MB * 1024 * 1024
+    total = sum(entry['size'] for entry in result_cache_index.values())
+
+    victims = []
+    for key, entry in list(result_cache_index.items()):
+        if total <= budget:
+            break
+        if result_cache_pins.get(result_entry_dir(key, entry)):
+            continue
+        victims.append(result_entry_dir(key, entry))
+        total -= entry['size']
+        del result_cache_index[key]
+
+    if victims:
+        result_cache_stats['evictions'] += len(victims)
+        await bot.loop.run_in_executor(
+            None,
+            lambda: [shutil.rmtree(entry_dir, ignore_errors=True) for entry_dir in victims]
+        )
+
+async def load_shared_info_file(download_data):
+    """En nodos remotos sin el info.json local, recupera la metadata de la caché compartida de Redis"""
+    if re.search(r'(spotify\.com)', download_data['url']):
+        return None
+
+    info = await get_cached_metadata(download_data['url'], count_stats=False)
+    if not info or ('entries' in info) == download_data['single']:
+        return None
+
+    try:
+        return await bot.loop.run_in_executor(None, write_info_file, download_data['download_id'], info)
+    except Exception as e:
+        logger.warning(f"No se pudo preparar la metadata compartida de {download_data['download_id']}: {e}")
+        return None
+
+async def fetch_media(download_data, download_path, channel):
+    """Descarga el contenido con yt-dlp y devuelve los archivos obtenidos, o None si falló"""
+    url = download_data['url']
+    format_str = download_data['format_str']
+    content_type = download_data['content_type']
+    user_id = download_data['user_id']
+    single = download_data['single']
+
+    ydl_opts = {
+        'paths': {'home': download_path},
+        'outtmpl': {'default': '%(title)s.%(ext)s'},
+        'format': format_str,
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 60,
+    }
+
+    if re.search(r'(facebook\.com|fb\.com|fb\.watch)', url):
+
+        ydl_opts['extract_flat'] = False
+
+    elif re.search(r'(instagram\.com|instagr\.am)', url):
+
+        ydl_opts['extract_flat'] = False
+
+    elif re.search(r'(twitter\.com|x\.com)', url):
+
+        ydl_opts['retries'] = 5
+
+        if "best" in format_str and "+" in format_str:
+            ydl_opts['format'] = 'best'
+
+    if content_type == "audio":
+        ydl_opts['postprocessors'] = [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        }]
+
+    if not single:
+        ydl_opts['playlist_items'] = 'all'
+    else:
+        ydl_opts['noplaylist'] = True
+
+    info_file = download_data.get('info_file')
+    if not (info_file and os.path.exists(info_file)):
+        info_file = await load_shared_info_file(download_data)
+
+    if info_file:
+        ydl_opts['clean_infojson'] = False
+        logger.info(f"Descargando con yt-dlp reutilizando la metadata extraída: {url}")
+    else:
+        logger.info(f"Descargando con yt-dlp: {url}")
+
+    success = False
+    try:
+
+        with timed_stage(download_data, 'ytdlp'):
+            success, error, stats = await run_ytdlp(url, ydl_opts, info_file)
+
+        add_stage_time(download_data, 'download', stats.get('download', 0))
+        add_stage_time(download_data, 'postprocess', stats.get('postprocess', 0))
+        download_data['bytes_downloaded'] = download_data.get('bytes_downloaded', 0) + stats.get('bytes_downloaded', 0)
+
+        if not success:
+            logger.error(f"Error con yt-dlp: {error}")
+            if channel:
+
+                if "privado" in error or "private" in error:
+                    error_embed = discord.Embed(
+                        title="🔒 Contenido privado o protegido",
+                        description=(
+                            f"No se pudo descargar este contenido porque está configurado como privado o protegido.\n\n"
+                            f"Esto suele ocurrir con:\n"
+                            f"• Cuentas privadas de Instagram/Facebook\n"
+                            f"• Videos privados o restringidos\n"
+                            f"• Contenido que requiere inicio de sesión\n\n"
+                            f"Error: {error[:500]}"
+                        ),
+                        color=discord.Color.red()
+                    )
+                else:
+                    error_embed = discord.Embed(
+                        title="❌ Error en la descarga",
+                        description=f"No se pudo completar la descarga: {error[:1500]}",
+                        color=discord.Color.red()
+                    )
+
+                error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+                error_embed.timestamp = datetime.utcnow()
+
+                await channel.send(content=f"<@{user_id}>", embed=error_embed)
+
+            download_data['status'] = 'error'
+            download_data['error'] = error[:500]
+            await save_download_record(download_data)
+            return None
+
+    except Exception as ydl_error:
+        logger.error(f"Error con yt-dlp: {str(ydl_error)}")
+        if channel:
+            error_embed = discord.Embed(
+                title="❌ Error en la descarga",
+                description=f"No se pudo completar la descarga: {str(ydl_error)[:1500]}",
+                color=discord.Color.red()
+            )
+            error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+            error_embed.timestamp = datetime.utcnow()
+
+            await channel.send(content=f"<@{user_id}>", embed=error_embed)
+
+        download_data['status'] = 'error'
+        download_data['error'] = str(ydl_error)[:500]
+        await save_download_record(download_data)
+        return None
+
+    if not success:
+        return None
+
+    downloaded_files = []
+    for root, _, files in os.walk(download_path):
+        for file in files:
+            if file.endswith(('.mp4', '.webm', '.mp3', '.ogg', '.m4a')):
+                file_path = os.path.join(root, file)
+                downloaded_files.append(file_path)
+
+    if not downloaded_files:
+        if channel:
+            error_embed = discord.Embed(
+                title="❌ Error en la descarga",
+                description="No se encontraron archivos descargados.",
+                color=discord.Color.red()
+            )
+            error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+            error_embed.timestamp = datetime.utcnow()
+
+            await channel.send(content=f"<@{user_id}>", embed=error_embed)
 
-            try:
-                download_path = f"{DOWNLOAD_DIR}/{download_data['download_id']}"
-                if os.path.exists(download_path):
-                    shutil.rmtree(download_path)
-                if download_data['download_id'] in active_downloads:
-                    active_downloads.remove(download_data['download_id'])
-            except Exception as e:
-                logger.error(f"Error al limpiar tras timeout: {str(e)}")
+        download_data['status'] = 'error'
+        download_data['error'] = 'No se encontraron archivos descargados'
+        await save_download_record(download_data)
+        return None
 
-        download_queue.task_done()
+    return downloaded_files
 
 async def process_download(download_data):
+    cache_pin = None
     try:
 
         url = download_data['url']
-        format_str = download_data['format_str']
-        content_type = download_data['content_type']
         user_id = download_data['user_id']
         channel_id = download_data['channel_id']
         download_id = download_data['download_id']
-        single = download_data['single']
         title = download_data.get('title', 'Desconocido')
 
         is_spotify = re.search(r'(spotify\.com)', url) is not None
@@ -437,7 +3109,7 @@ async def process_download(download_data):
         download_path = f"{DOWNLOAD_DIR}/{download_id}"
         os.makedirs(download_path, exist_ok=True)
 
-        channel = bot.get_channel(channel_id)
+        channel = await resolve_channel(channel_id)
         if channel:
             start_embed = discord.Embed(
                 title="⏱️ Descarga iniciada",
@@ -457,244 +3129,68 @@ async def process_download(download_data):
         if is_spotify:
             return await process_spotify_download(download_data, download_path)
 
-        ydl_opts = {
-            'paths': {'home': download_path},
-            'outtmpl': {'default': '%(title)s.%(ext)s'},
-            'format': format_str,
-            'quiet': True,
-            'no_warnings': True,
-            'socket_timeout': 60,
-        }
-
-        if re.search(r'(facebook\.com|fb\.com|fb\.watch)', url):
-
-            ydl_opts['extract_flat'] = False
-            
-        elif re.search(r'(instagram\.com|instagr\.am)', url):
-
-            ydl_opts['extract_flat'] = False
-            
-        elif re.search(r'(twitter\.com|x\.com)', url):
-
-            ydl_opts['retries'] = 5
-
-            if "best" in format_str and "+" in format_str:
-                ydl_opts['format'] = 'best'
-
-        if content_type == "audio":
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
+        cache_key = download_data.get('cache_key') if RESULT_CACHE_ENABLED else None
+        cache_pin, downloaded_files = await acquire_cached_result(cache_key) if cache_key else (None, None)
 
-        if not single:
-            ydl_opts['playlist_items'] = 'all'
+        if downloaded_files:
+            logger.info(f"Resultado servido desde la caché local: {download_id}")
+            download_data['cache_hit'] = True
         else:
-            ydl_opts['noplaylist'] = True
-        
-        logger.info(f"Descargando con yt-dlp: {url}")
-
-        def download_in_thread():
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-                return True, None
-            except Exception as e:
-                error_msg = str(e)
-
-                if "is private" in error_msg or "This content is not available" in error_msg or "sign in" in error_msg:
-                    return False, f"El contenido es privado o requiere inicio de sesión: {error_msg}"
-                return False, error_msg
-
-        success = False
-        try:
-
-            if not hasattr(bot, 'download_executor'):
-                bot.download_executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOADS)
-
-            success, error = await bot.loop.run_in_executor(bot.download_executor, download_in_thread)
-            
-            if not success:
-                logger.error(f"Error con yt-dlp: {error}")
-                if channel:
-
-                    if "privado" in error or "private" in error:
-                        error_embed = discord.Embed(
-                            title="🔒 Contenido privado o protegido",
-                            description=(
-                                f"No se pudo descargar este contenido porque está configurado como privado o protegido.\n\n"
-                                f"Esto suele ocurrir con:\n"
-                                f"• Cuentas privadas de Instagram/Facebook\n"
-                                f"• Videos privados o restringidos\n"
-                                f"• Contenido que requiere inicio de sesión\n\n"
-                                f"Error: {error[:500]}"
-                            ),
-                            color=discord.Color.red()
-                        )
-                    else:
-                        error_embed = discord.Embed(
-                            title="❌ Error en la descarga",
-                            description=f"No se pudo completar la descarga: {error[:1500]}",
-                            color=discord.Color.red()
-                        )
-                    
-                    error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                    error_embed.timestamp = datetime.utcnow()
-                    
-                    await channel.send(content=f"<@{user_id}>", embed=error_embed)
-
-                download_data['status'] = 'error'
-                download_data['error'] = error[:500]
-                await save_download_record(download_data)
+            downloaded_files = await fetch_media(download_data, download_path, channel)
+            if downloaded_files is None:
                 return
-                
-        except Exception as ydl_error:
-            logger.error(f"Error con yt-dlp: {str(ydl_error)}")
-            if channel:
-                error_embed = discord.Embed(
-                    title="❌ Error en la descarga",
-                    description=f"No se pudo completar la descarga: {str(ydl_error)[:1500]}",
-                    color=discord.Color.red()
-                )
-                error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                error_embed.timestamp = datetime.utcnow()
-                
-                await channel.send(content=f"<@{user_id}>", embed=error_embed)
-
-            download_data['status'] = 'error'
-            download_data['error'] = str(ydl_error)[:500]
-            await save_download_record(download_data)
-            return
-            
-        if not success:
-            return
-
-        downloaded_files = []
-        for root, _, files in os.walk(download_path):
-            for file in files:
-                if file.endswith(('.mp4', '.webm', '.mp3', '.ogg', '.m4a')):
-                    file_path = os.path.join(root, file)
-                    downloaded_files.append(file_path)
-
-        if not downloaded_files:
-            if channel:
-                error_embed = discord.Embed(
-                    title="❌ Error en la descarga",
-                    description="No se encontraron archivos descargados.",
-                    color=discord.Color.red()
-                )
-                error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                error_embed.timestamp = datetime.utcnow()
-                
-                await channel.send(content=f"<@{user_id}>", embed=error_embed)
 
-            download_data['status'] = 'error'
-            download_data['error'] = 'No se encontraron archivos descargados'
-            await save_download_record(download_data)
-            return
+            if cache_key:
+                cache_pin, cached_files = await store_cached_result(cache_key, downloaded_files, download_path)
+                if cached_files:
+                    downloaded_files = cached_files
 
         files_info = []
+        oversized = 0
+        upload_limit = download_data.get('upload_limit') or UPLOAD_LIMIT
 
-        for file_path in downloaded_files[:10]:
-            file_size = os.path.getsize(file_path)
-            file_name = os.path.basename(file_path)
-
-            file_info = {
-                'name': file_name,
-                'size': file_size,
-                'path': file_path,
-                'compressed': False
-            }
-
-            if file_size > 25 * 1024 * 1024:
-                compressed_path = f"{file_path}.zip"
-
-                import zipfile
-                with zipfile.ZipFile(compressed_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    zipf.write(file_path, arcname=os.path.basename(file_path))
-
-                compressed_size = os.path.getsize(compressed_path)
-                if os.path.exists(compressed_path) and compressed_size < 25 * 1024 * 1024:
-                    file_path = compressed_path
-                    file_name = os.path.basename(file_path)
-                    is_compressed = True
-
-                    file_info['compressed'] = True
-                    file_info['compressed_size'] = compressed_size
-                    file_info['compressed_path'] = compressed_path
-                else:
-
-                    if channel:
-                        error_embed = discord.Embed(
-                            title="⚠️ Archivo demasiado grande",
-                            description=f"El archivo '{file_name}' es demasiado grande incluso comprimido ({file_size/(1024*1024):.2f} MB).",
-                            color=discord.Color.orange()
-                        )
-                        error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                        error_embed.timestamp = datetime.utcnow()
-                        
-                        await channel.send(content=f"<@{user_id}>", embed=error_embed)
-                    continue
-            else:
-                is_compressed = False
-
-            files_info.append(file_info)
+        for file_path in downloaded_files:
+            prepared = await prepare_upload(download_data, file_path, download_path, upload_limit)
 
-            if channel:
-                try:
-                    success_embed = discord.Embed(
-                        title="✅ Descarga Completada",
+            if prepared is None:
+                oversized += 1
+                if channel:
+                    error_embed = discord.Embed(
+                        title="⚠️ Archivo demasiado grande",
                         description=(
-                            f"Archivo: **{file_name}**\n"
-                            f"Tipo: {'Audio' if content_type == 'audio' else 'Video'}\n"
-                            f"{'⚠️ *El archivo fue comprimido debido a su tamaño*' if is_compressed else ''}"
+                            f"El archivo '{os.path.basename(file_path)}' ({os.path.getsize(file_path)/(1024*1024):.2f} MB) supera el límite de "
+                            f"{upload_limit/(1024*1024):.0f} MB del servidor y no se pudo recodificar ni dividir para que quepa."
                         ),
-                        color=discord.Color.green()
-                    )
-
-                    success_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                    success_embed.timestamp = datetime.utcnow()
-
-                    await channel.send(
-                        content=f"<@{user_id}>",
-                        embed=success_embed,
-                        file=discord.File(file_path, filename=file_name)
-                    )
-                except Exception as e:
-                    logger.error(f"Error al enviar archivo: {str(e)}")
-                    error_embed = discord.Embed(
-                        title="❌ Error al enviar archivo",
-                        description=f"No se pudo enviar el archivo: {str(e)}",
-                        color=discord.Color.red()
+                        color=discord.Color.orange()
                     )
                     error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
                     error_embed.timestamp = datetime.utcnow()
                     
                     await channel.send(content=f"<@{user_id}>", embed=error_embed)
+                continue
 
-        if len(downloaded_files) > 10:
-            if channel:
-                info_embed = discord.Embed(
-                    title="ℹ️ Información",
-                    description=f"Se descargaron {len(downloaded_files)} archivos, pero solo se enviaron los primeros 10 debido a limitaciones de Discord.",
-                    color=discord.Color.blue()
-                )
-                info_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                info_embed.timestamp = datetime.utcnow()
-                
-                await channel.send(content=f"<@{user_id}>", embed=info_embed)
+            files_info.extend(prepared)
+
+        if channel and files_info:
+            summary_embed = delivery_summary("✅ Descarga Completada", download_data, files_info)
+            await deliver_files(download_data, channel, files_info, summary_embed)
+
+        if files_info and not oversized and all('attachment_url' in f for f in files_info):
+            await remember_attachments(delivery_key(download_data), attachments_from_files(files_info))
 
         download_data['status'] = 'completed'
         download_data['files'] = files_info
         download_data['completed_at'] = datetime.utcnow().isoformat()
         download_data['files_count'] = len(downloaded_files)
-        download_data['files_sent'] = min(len(downloaded_files), 10)
+        download_data['files_sent'] = len(downloaded_files) - oversized
         await save_download_record(download_data)
+
+        if files_info:
+            await deliver_to_followers(download_data, files_info)
     
     except Exception as e:
         logger.error(f"Error en process_download: {str(e)}")
-        channel = bot.get_channel(download_data['channel_id'])
+        channel = await resolve_channel(download_data['channel_id'])
         if channel:
             error_embed = discord.Embed(
                 title="❌ Error inesperado",
@@ -719,11 +3215,8 @@ async def process_download(download_data):
         except Exception as e:
             logger.error(f"Error al limpiar archivos: {str(e)}")
 
-        try:
-            if download_data['download_id'] in active_downloads:
-                active_downloads.remove(download_data['download_id'])
-        except:
-            pass
+        if cache_pin:
+            release_cached_result(cache_pin)
 
 async def process_spotify_download(download_data, download_path):
     """Procesa descargas de Spotify utilizando spotDL"""
@@ -731,7 +3224,7 @@ async def process_spotify_download(download_data, download_path):
     user_id = download_data['user_id']
     channel_id = download_data['channel_id']
     content_type = download_data['content_type']
-    channel = bot.get_channel(channel_id)
+    channel = await resolve_channel(channel_id)
 
     def check_spotdl_installed():
         try:
@@ -769,24 +3262,19 @@ async def process_spotify_download(download_data, download_path):
     elif "show" in url or "episode" in url:
         spotify_type = "podcast"
 
-    def run_spotdl():
+    async def run_spotdl():
         try:
 
             limit_arg = ["--limit", "10"] if "track" not in url else []
 
             cmd = ["spotdl", url, "--output", f"{download_path}/%(title)s.%(ext)s"] + limit_arg
 
-            process = subprocess.run(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True
-            )
+            with timed_stage(download_data, 'download'):
+                returncode, stdout, stderr = await run_killable_process(cmd)
+            if returncode != 0:
+                return False, f"Error de spotDL: {stderr}"
             
-            return True, process.stdout
-        except subprocess.CalledProcessError as e:
-            return False, f"Error de spotDL: {e.stderr}"
+            return True, stdout
         except Exception as e:
             return False, f"Error: {str(e)}"
 
@@ -803,7 +3291,7 @@ async def process_spotify_download(download_data, download_path):
         info_embed.timestamp = datetime.utcnow()
         await channel.send(content=f"<@{user_id}>", embed=info_embed)
 
-    success, result = await bot.loop.run_in_executor(None, run_spotdl)
+    success, result = await run_spotdl()
     
     if not success:
         if channel:
@@ -828,6 +3316,8 @@ async def process_spotify_download(download_data, download_path):
                 file_path = os.path.join(root, file)
                 downloaded_files.append(file_path)
 
+    download_data['bytes_downloaded'] = sum(os.path.getsize(f) for f in downloaded_files)
+
     if not downloaded_files:
         if channel:
             error_embed = discord.Embed(
@@ -851,68 +3341,174 @@ async def process_spotify_download(download_data, download_path):
         return
 
     files_info = []
+    oversized = 0
+    upload_limit = download_data.get('upload_limit') or UPLOAD_LIMIT
+
+    for file_path in downloaded_files:
+        prepared = await prepare_upload(download_data, file_path, download_path, upload_limit)
+        if prepared is None:
+            logger.warning(f"La canción {file_path} supera el límite de subida y no se pudo ajustar")
+            oversized += 1
+            continue
 
-    for file_path in downloaded_files[:10]:
-        file_size = os.path.getsize(file_path)
-        file_name = os.path.basename(file_path)
-
-        file_info = {
-            'name': file_name,
-            'size': file_size,
-            'path': file_path,
-            'compressed': False,
-            'source': 'spotify'
-        }
-
-        files_info.append(file_info)
-
-        if channel:
-            try:
-                success_embed = discord.Embed(
-                    title="✅ Descarga Spotify Completada",
-                    description=f"Canción: **{file_name}**",
-                    color=discord.Color.green()
-                )
-
-                success_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                success_embed.timestamp = datetime.utcnow()
+        for file_info in prepared:
+            file_info['source'] = 'spotify'
+        files_info.extend(prepared)
 
-                await channel.send(
-                    content=f"<@{user_id}>",
-                    embed=success_embed,
-                    file=discord.File(file_path, filename=file_name)
-                )
-            except Exception as e:
-                logger.error(f"Error al enviar archivo: {str(e)}")
-                error_embed = discord.Embed(
-                    title="❌ Error al enviar archivo",
-                    description=f"No se pudo enviar el archivo: {str(e)}",
-                    color=discord.Color.red()
-                )
-                error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-                error_embed.timestamp = datetime.utcnow()
-                
-                await channel.send(content=f"<@{user_id}>", embed=error_embed)
+    if channel and files_info:
+        notes = []
+        if oversized:
+            notes.append(f"⚠️ {oversized} canciones superaban el límite de {upload_limit/(1024*1024):.0f} MB y no se pudieron enviar.")
+        summary_embed = delivery_summary("✅ Descarga Spotify Completada", download_data, files_info, notes)
+        await deliver_files(download_data, channel, files_info, summary_embed)
 
-    if len(downloaded_files) > 10:
-        if channel:
-            info_embed = discord.Embed(
-                title="ℹ️ Información",
-                description=f"Se encontraron {len(downloaded_files)} canciones, pero solo se enviaron las primeras 10 debido a limitaciones de Discord.",
-                color=discord.Color.blue()
-            )
-            info_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
-            info_embed.timestamp = datetime.utcnow()
-            
-            await channel.send(content=f"<@{user_id}>", embed=info_embed)
+    if files_info and not oversized and all('attachment_url' in f for f in files_info):
+        await remember_attachments(delivery_key(download_data), attachments_from_files(files_info))
 
     download_data['status'] = 'completed'
     download_data['files'] = files_info
     download_data['completed_at'] = datetime.utcnow().isoformat()
     download_data['files_count'] = len(downloaded_files)
-    download_data['files_sent'] = min(len(downloaded_files), 10)
+    download_data['files_sent'] = len(downloaded_files) - oversized
     await save_download_record(download_data)
 
+    if files_info:
+        await deliver_to_followers(download_data, files_info)
+
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'igshid', 'igsh', 'si', 'feature', 'ref', 'ref_src', 'ref_url', 'share_id',
+    'is_from_webapp', 'sender_device', 'sender_web_id', 'mibextid', 'pp', 'ab_channel', 'rdid', '_r'
+}
+
+HOST_ALIASES = {
+    'youtu.be': 'youtube.com',
+    'm.youtube.com': 'youtube.com',
+    'music.youtube.com': 'youtube.com',
+    'x.com': 'twitter.com',
+    'mobile.twitter.com': 'twitter.com',
+    'mobile.x.com': 'twitter.com',
+    'instagr.am': 'instagram.com',
+    'm.facebook.com': 'facebook.com',
+    'm.tiktok.com': 'tiktok.com',
+    'fb.com': 'facebook.com',
+}
+
+def host_in_domain(host, domain):
+    """Indica si host es domain o un subdominio suyo (notyoutube.com no es youtube.com)"""
+    return host == domain or host.endswith(f".{domain}")
+
+def canonicalize_url(url):
+    """Normaliza una URL para que distintas variantes del mismo contenido compartan clave de caché"""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    path = parts.path.rstrip('/') or '/'
+
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=False)
+        if not k.startswith('utm_') and k not in TRACKING_PARAMS
+    ]
+
+    if host == 'youtu.be':
+        query = [('v', path.lstrip('/'))] + [(k, v) for k, v in query if k == 'list']
+        path = '/watch'
+    elif host_in_domain(host, 'youtube.com'):
+        shorts = re.match(r'^/(?:shorts|live|embed)/([\w-]+)', path)
+        if shorts:
+            query = [('v', shorts.group(1))] + query
+            path = '/watch'
+        query = [(k, v) for k, v in query if k in ('v', 'list')]
+
+    host = HOST_ALIASES.get(host, host)
+
+    if host_in_domain(host, 'twitter.com'):
+        status = re.match(r'^/[^/]+/status(?:es)?/(\d+)', path)
+        if status:
+            path = f"/i/status/{status.group(1)}"
+        query = []
+    elif host_in_domain(host, 'instagram.com') or host_in_domain(host, 'tiktok.com'):
+        query = []
+
+    return urlunsplit(('https', host, path, urlencode(sorted(query)), ''))
+
+metadata_cache = OrderedDict()
+
+metadata_cache_stats = {'memory_hits': 0, 'redis_hits': 0, 'misses': 0}
+
+def get_metadata_ttl(url):
+    return METADATA_CACHE_TTLS.get(get_platform_name(url), METADATA_CACHE_DEFAULT_TTL)
+
+def remember_metadata(key, info, ttl):
+    metadata_cache[key] = (time.time() + ttl, info)
+    metadata_cache.move_to_end(key)
+    while len(metadata_cache) > METADATA_CACHE_SIZE:
+        metadata_cache.popitem(last=False)
+
+async def get_cached_metadata(url, count_stats=True):
+    """Busca la metadata de una URL en la caché en memoria y después en Redis.
+
+    Con count_stats=False no toca los contadores de aciertos, que solo deben reflejar las
+    búsquedas de extracción hechas por los usuarios.
+    """
+    if not METADATA_CACHE_ENABLED:
+        return None
+
+    key = canonicalize_url(url)
+
+    cached = metadata_cache.get(key)
+    if cached:
+        expires_at, info = cached
+        if expires_at > time.time():
+            metadata_cache.move_to_end(key)
+            if count_stats:
+                metadata_cache_stats['memory_hits'] += 1
+            return info
+        del metadata_cache[key]
+
+    if redis_client:
+        try:
+            redis_key = f"metadata:{key}"
+            async with redis_client.pipeline() as pipe:
+                pipe.get(redis_key)
+                pipe.ttl(redis_key)
+                payload, ttl = await pipe.execute()
+            if payload:
+                info = json.loads(zlib.decompress(payload))
+                remember_metadata(key, info, max(ttl, 1))
+                if count_stats:
+                    metadata_cache_stats['redis_hits'] += 1
+                return info
+        except Exception as e:
+            logger.warning(f"Error al leer la caché de metadata en Redis: {e}")
+
+    if count_stats:
+        metadata_cache_stats['misses'] += 1
+    return None
+
+async def store_cached_metadata(url, info):
+    """Guarda la metadata extraída en ambas capas de caché con el TTL de su plataforma"""
+    if not METADATA_CACHE_ENABLED:
+        return
+
+    key = canonicalize_url(url)
+    ttl = get_metadata_ttl(url)
+
+    try:
+        info = await bot.loop.run_in_executor(None, sanitize_info_for_download, info)
+    except Exception as e:
+        logger.warning(f"No se pudo serializar la metadata de {url} para la caché: {e}")
+        return
+
+    remember_metadata(key, info, ttl)
+
+    if redis_client:
+        try:
+            payload = zlib.compress(json.dumps(info).encode())
+            await redis_client.set(f"metadata:{key}", payload, ex=ttl)
+        except Exception as e:
+            logger.warning(f"Error al guardar la caché de metadata en Redis: {e}")
+
 async def extract_with_platform_options(url, ctx):
     """Extrae información con opciones específicas para cada plataforma"""
 
@@ -921,6 +3517,12 @@ async def extract_with_platform_options(url, ctx):
     is_twitter = re.search(r'(twitter\.com|x\.com)', url) is not None
     is_spotify = re.search(r'(spotify\.com)', url) is not None
 
+    if not is_spotify:
+        cached_info = await get_cached_metadata(url)
+        if cached_info:
+            logger.info(f"Metadata obtenida de la caché: {url}")
+            return cached_info
+
     processing_embed = discord.Embed(
         title="⏳ Procesando URL",
         description=f"Analizando contenido de {get_platform_name(url)}...",
@@ -1060,6 +3662,7 @@ async def extract_with_platform_options(url, ctx):
             return None
 
         await processing_msg.delete()
+        await store_cached_metadata(url, info)
         return info
         
     except Exception as e:
@@ -1118,7 +3721,9 @@ async def download(ctx, url: str):
     
     try:
 
+        extract_started = time.monotonic()
         info = await extract_with_platform_options(url, ctx)
+        extract_seconds = time.monotonic() - extract_started
 
         if not info:
             return
@@ -1145,7 +3750,7 @@ async def download(ctx, url: str):
             embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
             embed.timestamp = datetime.utcnow()
 
-            view = DownloadView(url, info, ctx)
+            view = DownloadView(url, info, ctx, extract_seconds=extract_seconds)
             await ctx.send(embed=embed, view=view)
             
         else:
@@ -1195,7 +3800,7 @@ async def download(ctx, url: str):
             embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
             embed.timestamp = datetime.utcnow()
 
-            view = DownloadView(url, info, ctx)
+            view = DownloadView(url, info, ctx, extract_seconds=extract_seconds)
             await ctx.send(embed=embed, view=view)
     
     except Exception as e:
@@ -1213,15 +3818,15 @@ async def download(ctx, url: str):
 async def queue(ctx):
     """Muestra el estado actual de la cola de descargas"""
 
-    queue_size = download_queue.qsize()
+    queue_size = await download_queue.qsize()
 
-    active_count = len(active_downloads)
+    active_count = await download_queue.active_count()
     
     embed = discord.Embed(
         title="📋 Estado de la Cola de Descargas",
         description=(
             f"**Descargas en cola:** {queue_size}\n"
-            f"**Descargas activas:** {active_count}/{MAX_DOWNLOADS}\n\n"
+            f"**Descargas activas:** {active_count}{f'/{MAX_DOWNLOADS}' if EMBEDDED_WORKERS else ''}\n\n"
             f"El tiempo de espera dependerá del tamaño y cantidad de archivos en la cola."
         ),
         color=discord.Color.blue()
@@ -1231,6 +3836,91 @@ async def queue(ctx):
     
     await ctx.reply(embed=embed)
 
+@bot.command()
+async def cancel(ctx, download_id: str):
+    """Cancela una descarga en cola o en curso"""
+
+    running_job = running_jobs.get(download_id)
+    download_data = running_job['data'] if running_job else await download_queue.lookup(download_id)
+
+    if download_data is None:
+        embed = discord.Embed(
+            title="❌ Descarga no encontrada",
+            description=f"No hay ninguna descarga en cola o en curso con ID `{download_id}`.",
+            color=discord.Color.red()
+        )
+    else:
+        can_manage = ctx.guild is not None and ctx.author.guild_permissions.manage_messages
+
+        if download_data['user_id'] != ctx.author.id and not can_manage:
+            embed = discord.Embed(
+                title="⛔ Sin permisos",
+                description="Solo quien solicitó la descarga o un moderador puede cancelarla.",
+                color=discord.Color.red()
+            )
+        else:
+            if running_job:
+                cancel_requests.add(download_id)
+                running_job['task'].cancel()
+            else:
+                await download_queue.request_cancel(download_id)
+
+            embed = discord.Embed(
+                title="🛑 Descarga cancelada",
+                description=f"La descarga con ID `{download_id}` fue cancelada.",
+                color=discord.Color.orange()
+            )
+
+    embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+    embed.timestamp = datetime.utcnow()
+
+    await ctx.reply(embed=embed)
+
+@bot.command()
+async def cache(ctx):
+    """Muestra los aciertos y fallos de las cachés de metadata, resultados y adjuntos"""
+
+    lookups = sum(metadata_cache_stats.values())
+    hits = metadata_cache_stats['memory_hits'] + metadata_cache_stats['redis_hits']
+    hit_rate = (hits / lookups * 100) if lookups else 0
+
+    embed = discord.Embed(
+        title="🗃️ Caché de metadata",
+        description=(
+            f"**Aciertos en memoria:** {metadata_cache_stats['memory_hits']}\n"
+            f"**Aciertos en Redis:** {metadata_cache_stats['redis_hits']}\n"
+            f"**Fallos:** {metadata_cache_stats['misses']}\n"
+            f"**Tasa de aciertos:** {hit_rate:.1f}%\n"
+            f"**Entradas en memoria:** {len(metadata_cache)}/{METADATA_CACHE_SIZE}"
+        ),
+        color=discord.Color.blue()
+    )
+
+    result_lookups = result_cache_stats['hits'] + result_cache_stats['misses']
+    result_hit_rate = (result_cache_stats['hits'] / result_lookups * 100) if result_lookups else 0
+    result_size = sum(entry['size'] for entry in result_cache_index.values())
+    embed.add_field(
+        name="📦 Caché de resultados",
+        value=(
+            f"Aciertos: {result_cache_stats['hits']} · Fallos: {result_cache_stats['misses']} ({result_hit_rate:.1f}%)\n"
+            f"Expulsiones: {result_cache_stats['evictions']}\n"
+            f"Ocupado: {result_size/(1024*1024):.1f}/{RESULT_CACHE_MAX_MB} MB en {len(result_cache_index)} entradas"
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="📎 Adjuntos reutilizados",
+        value=(
+            f"Aciertos: {attachment_cache_stats['hits']} · Renovados: {attachment_cache_stats['refreshed']} · "
+            f"Fallos: {attachment_cache_stats['misses']}"
+        ),
+        inline=False
+    )
+    embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+    embed.timestamp = datetime.utcnow()
+
+    await ctx.reply(embed=embed)
+
 @bot.command()
 async def stats(ctx):
     """Muestra estadísticas de las descargas realizadas"""
@@ -1239,33 +3929,24 @@ async def stats(ctx):
 
         if MONGODB_ENABLED and db is not None:
             try:
-                total_downloads = await db.downloads.count_documents({})
-                completed = await db.downloads.count_documents({"status": "completed"})
-                errors = await db.downloads.count_documents({"status": "error"})
-                in_progress = await db.downloads.count_documents({"status": {"$in": ["queued", "processing"]}})
-
-                pipeline = [
-                    {"$group": {"_id": "$user_id", "count": {"$sum": 1}, "name": {"$first": "$user_name"}}},
-                    {"$sort": {"count": -1}},
-                    {"$limit": 5}
-                ]
-                top_users = await db.downloads.aggregate(pipeline).to_list(length=5)
-                
+                counters = await db.download_stats.find_one({"_id": "totals"}) or {}
+                top_users = await db.user_stats.find().sort("count", -1).limit(5).to_list(length=5)
+
                 stats_data = {
-                    "total": total_downloads,
-                    "completed": completed,
-                    "errors": errors,
-                    "in_progress": in_progress,
+                    "total": counters.get("total", 0),
+                    "completed": counters.get("completed", 0),
+                    "errors": counters.get("error", 0),
+                    "in_progress": max(counters.get("queued", 0) + counters.get("processing", 0), 0),
                     "top_users": top_users
                 }
                 logger.info("Estadísticas obtenidas desde MongoDB")
             except Exception as mongo_err:
                 logger.error(f"Error al obtener estadísticas de MongoDB: {mongo_err}")
 
-                stats_data = get_stats_from_json()
+                stats_data = await record_store.get_stats()
         else:
 
-            stats_data = get_stats_from_json()
+            stats_data = await record_store.get_stats()
 
         embed = discord.Embed(
             title="📊 Estadísticas de Descargas",
@@ -1285,7 +3966,7 @@ async def stats(ctx):
             ])
             embed.add_field(name="👑 Usuarios más activos", value=top_users_text or "No hay datos")
 
-        storage_type = "MongoDB" if MONGODB_ENABLED and db is not None else "JSON local"
+        storage_type = "MongoDB" if MONGODB_ENABLED and db is not None else "SQLite local"
         embed.add_field(name="💾 Almacenamiento", value=storage_type, inline=False)
         
         embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
@@ -1305,68 +3986,265 @@ async def stats(ctx):
         
         await ctx.reply(embed=error_embed)
 
-def get_stats_from_json():
+@bot.command()
+async def usage(ctx, window: str = "24h"):
+    """Muestra el uso agregado de una ventana de tiempo reciente, por ejemplo 24h o 7d"""
+    match = re.fullmatch(r'(\d+)([hd])', window.strip().lower())
+    hours = (int(match.group(1)) * (24 if match.group(2) == 'd' else 1)) if match else 0
+    if not 0 < hours <= 90 * 24:
+        await ctx.reply("Ventana no válida. Usa por ejemplo `24h` o `7d` (máximo 90d).")
+        return
+
     try:
-        json_file = "download_records.json"
-        if os.path.exists(json_file):
-            with open(json_file, "r") as f:
-                try:
-                    records = json.load(f)
-
-                    total_downloads = len(records)
-                    completed = sum(1 for r in records if r.get("status") == "completed")
-                    errors = sum(1 for r in records if r.get("status") == "error")
-                    in_progress = sum(1 for r in records if r.get("status") in ["queued", "processing"])
-
-                    user_counts = {}
-                    for record in records:
-                        user_id = record.get("user_id")
-                        user_name = record.get("user_name", "Usuario")
-                        if user_id:
-                            if user_id not in user_counts:
-                                user_counts[user_id] = {"count": 0, "name": user_name}
-                            user_counts[user_id]["count"] += 1
-
-                    top_users = [{"_id": uid, "count": data["count"], "name": data["name"]} 
-                                for uid, data in sorted(user_counts.items(), key=lambda x: x[1]["count"], reverse=True)[:5]]
-                    
-                    return {
-                        "total": total_downloads,
-                        "completed": completed,
-                        "errors": errors,
-                        "in_progress": in_progress,
-                        "top_users": top_users
-                    }
-                except json.JSONDecodeError:
-                    return {
-                        "total": 0, "completed": 0, "errors": 0, "in_progress": 0, "top_users": []
-                    }
-        else:
-            return {
-                "total": 0, "completed": 0, "errors": 0, "in_progress": 0, "top_users": []
-            }
+        metrics = await get_usage(hours)
+
+        jobs = metrics.get('jobs', 0)
+        failed = metrics.get('failed', 0)
+        failure_rate = (failed / jobs * 100) if jobs else 0
+
+        embed = discord.Embed(
+            title=f"📈 Uso en las últimas {window}",
+            description=(
+                f"**Trabajos terminados:** {jobs}\n"
+                f"**Completados:** {metrics.get('completed', 0)}\n"
+                f"**Fallidos:** {failed} ({failure_rate:.1f}%)\n"
+                f"**Cancelados:** {metrics.get('cancelled', 0)}\n"
+                f"**Enviado:** {metrics.get('bytes', 0)/(1024*1024):.1f} MB\n"
+                f"**Duración p50 / p95:** {usage_percentile(metrics, 0.5) or '-'} / {usage_percentile(metrics, 0.95) or '-'}"
+            ),
+            color=discord.Color.blue()
+        )
+
+        for dimension, title in (('platform', "🌐 Plataformas"), ('content_type', "🎞️ Tipo"), ('guild', "🏠 Servidores")):
+            rows = usage_breakdown(metrics, dimension)
+            if not rows:
+                continue
+            lines = []
+            for key, values in rows:
+                if dimension == 'guild':
+                    guild = bot.get_guild(int(key)) if key.isdigit() else None
+                    key = guild.name if guild else ('DM' if key == 'dm' else key)
+                lines.append(
+                    f"{key}: {values.get('jobs', 0)} · {values.get('failed', 0)} fallos · "
+                    f"{values.get('bytes', 0)/(1024*1024):.1f} MB"
+                )
+            embed.add_field(name=title, value="\n".join(lines), inline=False)
+
+        embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+        embed.timestamp = datetime.utcnow()
+
+        await ctx.reply(embed=embed)
+
     except Exception as e:
-        logger.error(f"Error al obtener estadísticas de JSON: {e}")
-        return {
-            "total": 0, "completed": 0, "errors": 0, "in_progress": 0, "top_users": []
-        }
+        logger.error(f"Error al obtener el uso: {e}")
+        error_embed = discord.Embed(
+            title="❌ Error",
+            description=f"No se pudo obtener el uso: {str(e)}",
+            color=discord.Color.red()
+        )
+        error_embed.set_footer(text=f"{BOT_NAME} v{BOT_VERSION}", icon_url=bot.user.display_avatar.url if bot.user.display_avatar else None)
+        error_embed.timestamp = datetime.utcnow()
+
+        await ctx.reply(embed=error_embed)
+
+@metrics_registry.collector
+async def collect_runtime_metrics():
+    metrics_registry.set("yadb_queue_depth", await download_queue.qsize())
+    metrics_registry.set("yadb_active_downloads", len(active_downloads))
+
+    cache_counts = {
+        'metadata': {
+            'memory_hit': metadata_cache_stats['memory_hits'],
+            'redis_hit': metadata_cache_stats['redis_hits'],
+            'miss': metadata_cache_stats['misses'],
+        },
+        'result': {'hit': result_cache_stats['hits'], 'miss': result_cache_stats['misses']},
+        'attachment': {
+            'hit': attachment_cache_stats['hits'],
+            'refreshed': attachment_cache_stats['refreshed'],
+            'miss': attachment_cache_stats['misses'],
+        },
+    }
+    for cache_name, results in cache_counts.items():
+        for result, count in results.items():
+            metrics_registry.set("yadb_cache_lookups_total", count, cache=cache_name, result=result)
+
+    executors = {
+        'download': download_executor_load,
+        'records': record_store.load,
+        'journal': record_sink.journal_load,
+    }
+    for name, load in executors.items():
+        metrics_registry.set("yadb_executor_running_tasks", load.running, executor=name)
+        metrics_registry.set("yadb_executor_max_threads", load.max_workers, executor=name)
+        metrics_registry.set("yadb_executor_queued_tasks", load.queued, executor=name)
+
+    metrics_registry.set("yadb_child_processes", child_process_stats['running'])
+    metrics_registry.set("yadb_child_processes_started_total", child_process_stats['started'])
+
+class LoopWatchdog:
+    """Vigila el event loop desde un hilo aparte.
+
+    Una corrutina de latido duerme LOOP_LAG_INTERVAL y mide cuánto tarde se despierta (el retraso
+    es tiempo en que el loop estuvo bloqueado). Si el latido se retrasa más de LOOP_STALL_THRESHOLD,
+    el hilo toma una muestra de la pila del hilo del loop con sys._current_frames() mientras sigue
+    bloqueado, así el log señala la llamada culpable y no solo el síntoma.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.expected = time.monotonic() + LOOP_LAG_INTERVAL
+        self.sampled_stall = None
+        self.last_report = 0
+        self.heartbeat_task = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+
+    def start(self):
+        self.heartbeat_task = self.loop.create_task(self.heartbeat())
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    async def heartbeat(self):
+        while True:
+            self.expected = time.monotonic() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(time.monotonic() - self.expected, 0)
+            metrics_registry.observe("yadb_event_loop_lag_seconds", lag)
+            if lag > LOOP_STALL_THRESHOLD:
+                metrics_registry.observe("yadb_event_loop_stall_seconds", lag)
+                logger.warning(f"El event loop estuvo bloqueado {lag*1000:.0f} ms")
+
+    def watch(self):
+        while not self.stopped.wait(LOOP_STALL_THRESHOLD / 2):
+            expected = self.expected
+            overdue = time.monotonic() - expected
+            if overdue <= LOOP_STALL_THRESHOLD or self.sampled_stall == expected:
+                continue
+
+            self.sampled_stall = expected
+            if time.monotonic() - self.last_report < LOOP_STALL_LOG_INTERVAL:
+                continue
+            self.last_report = time.monotonic()
+
+            try:
+                self.report_stall(overdue)
+            except Exception as e:
+                logger.error(f"No se pudo muestrear el event loop bloqueado: {e}")
+
+    def report_stall(self, overdue):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+
+        task = asyncio.current_task(self.loop)
+        task_name = f"{task.get_name()} ({task.get_coro().__qualname__})" if task else "callback fuera de una tarea"
+        stack = "".join(traceback.format_stack(frame)[-LOOP_STALL_STACK_DEPTH:])
+        logger.warning(
+            f"Event loop bloqueado más de {overdue*1000:.0f} ms en {task_name}. Pila del hilo del loop:\n{stack}"
+        )
+
+loop_watchdog = None
+
+def start_loop_watchdog():
+    global loop_watchdog
+    if not LOOP_WATCHDOG_ENABLED or loop_watchdog is not None:
+        return
+    loop_watchdog = LoopWatchdog(bot.loop)
+    loop_watchdog.start()
+
+def stop_loop_watchdog():
+    global loop_watchdog
+    if loop_watchdog is not None:
+        loop_watchdog.stop()
+        loop_watchdog = None
+
+async def start_metrics_server():
+    """Expone /metrics en formato Prometheus si METRICS_ENABLED está activo"""
+    if not METRICS_ENABLED:
+        return
+
+    async def handle_metrics(request):
+        return web.Response(
+            body=(await metrics_registry.render()).encode(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logger.error(f"No se pudo abrir el endpoint de métricas en {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return
+
+    logger.info(f"Métricas disponibles en http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+startup_completed = False
 
 @bot.event
 async def on_ready():
+    global startup_completed
     logger.info(f"Bot iniciado como {bot.user}")
 
+    await setup_rich_presence()
+
+    if startup_completed:
+        return
+    startup_completed = True
+
+    await setup_download_node(start_workers=EMBEDDED_WORKERS)
+
+async def setup_download_node(start_workers=True):
+    """Prepara almacenamiento y cola; si start_workers, también los workers que procesan descargas"""
+    start_loop_watchdog()
+
     await setup_mongodb()
+    await record_sink.start()
 
-    await setup_rich_presence()
+    await setup_redis()
 
-    bot.loop.create_task(download_worker())
+    queued_jobs = await setup_download_queue(consume=start_workers)
+
+    await start_metrics_server()
+
+    if not start_workers and not isinstance(download_queue, RedisDownloadQueue):
+        logger.warning("Sin cola compartida en Redis ningún nodo worker puede procesar descargas: se usarán los workers integrados")
+        start_workers = True
+
+    if not start_workers:
+        logger.info("Workers integrados deshabilitados: las descargas las procesarán los nodos worker.py")
+        return
+
+    keep_dirs = {download_data['download_id'] for download_data in queued_jobs}
 
     try:
         for item in os.listdir(DOWNLOAD_DIR):
             item_path = os.path.join(DOWNLOAD_DIR, item)
+            if item in keep_dirs or os.path.abspath(item_path) == os.path.abspath(RESULT_CACHE_DIR):
+                continue
             if os.path.isdir(item_path):
                 shutil.rmtree(item_path)
     except Exception as e:
         logger.error(f"Error al limpiar directorio de descargas: {str(e)}")
 
-bot.run(os.getenv("DISCORD_TOKEN"))
+    if RESULT_CACHE_ENABLED and not result_cache_index:
+        await setup_result_cache()
+
+    start_download_workers()
+
+    if isinstance(download_queue, RedisDownloadQueue):
+        bot.loop.create_task(watch_cancellations())
+
+if __name__ == "__main__":
+    bot.run(os.getenv("DISCORD_TOKEN"))
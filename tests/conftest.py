@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("MONGODB_ENABLED", "false")
+os.environ.setdefault("METRICS_ENABLED", "false")
+os.environ.setdefault("LOOP_WATCHDOG_ENABLED", "false")
@@ -0,0 +1,44 @@
+import pytest
+
+import bot
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=abc123&t=42",
+    "http://m.youtube.com/watch?v=dQw4w9WgXcQ&feature=share",
+    "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+    "https://music.youtube.com/watch?v=dQw4w9WgXcQ&utm_source=x",
+    "  https://YouTube.com/watch/?v=dQw4w9WgXcQ  ",
+])
+def test_youtube_variants_share_a_key(url):
+    assert bot.canonicalize_url(url) == "https://youtube.com/watch?v=dQw4w9WgXcQ"
+
+def test_youtube_keeps_playlist():
+    assert bot.canonicalize_url("https://youtu.be/abc?list=PL1&si=x") == "https://youtube.com/watch?list=PL1&v=abc"
+    assert bot.canonicalize_url("https://www.youtube.com/playlist?list=PL1&index=3") == "https://youtube.com/playlist?list=PL1"
+
+@pytest.mark.parametrize("url", [
+    "https://x.com/someone/status/123456?s=20",
+    "https://mobile.twitter.com/other/statuses/123456",
+    "https://twitter.com/i/status/123456",
+])
+def test_twitter_status_is_user_independent(url):
+    assert bot.canonicalize_url(url) == "https://twitter.com/i/status/123456"
+
+def test_instagram_and_tiktok_drop_the_query():
+    assert bot.canonicalize_url("https://www.instagram.com/reel/Cxyz/?igsh=abc&foo=1") == "https://instagram.com/reel/Cxyz"
+    assert bot.canonicalize_url("https://m.tiktok.com/@u/video/1?lang=es") == "https://tiktok.com/@u/video/1"
+
+def test_other_hosts_keep_meaningful_params_sorted():
+    assert bot.canonicalize_url("https://vimeo.com/123/?b=2&utm_campaign=x&a=1&fbclid=z") == "https://vimeo.com/123?a=1&b=2"
+
+def test_different_videos_do_not_collide():
+    assert bot.canonicalize_url("https://youtu.be/aaa") != bot.canonicalize_url("https://youtu.be/bbb")
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://notyoutube.com/watch?v=abc&x=1", "https://notyoutube.com/watch?v=abc&x=1"),
+    ("https://www.faketiktok.com/@u/video/1?lang=es", "https://faketiktok.com/@u/video/1?lang=es"),
+])
+def test_lookalike_hosts_are_not_treated_as_known_platforms(url, expected):
+    assert bot.canonicalize_url(url) == expected
@@ -0,0 +1,34 @@
+import asyncio
+
+import fakeredis
+
+import bot
+
+def test_redelivery_on_another_node_sees_counted_status(monkeypatch, tmp_path):
+    """Un nodo sin el registro en su buffer toma de Redis el último estado contado"""
+    async def scenario():
+        bot.bot.loop = asyncio.get_running_loop()
+        monkeypatch.setattr(bot, 'MONGODB_ENABLED', False)
+        monkeypatch.setattr(bot, 'record_store', bot.SQLiteRecordStore(str(tmp_path / "other_node.db")))
+        monkeypatch.setattr(bot, 'download_queue', bot.RedisDownloadQueue(fakeredis.FakeAsyncRedis()))
+        await bot.download_queue.recover(consume=False)
+
+        first_node = bot.RecordSink(str(tmp_path / "first.journal"))
+        monkeypatch.setattr(bot, 'record_sink', first_node)
+        download_data = {'download_id': 'd1', 'user_id': 1, 'status': 'queued'}
+        await bot.save_download_record(download_data)
+        await bot.download_queue.put(download_data)
+        stale_copy = dict(download_data)
+
+        download_data['status'] = 'processing'
+        await bot.save_download_record(download_data)
+
+        second_node = bot.RecordSink(str(tmp_path / "second.journal"))
+        await second_node.restore_counted_status(stale_copy)
+        assert stale_copy['counted_status'] == 'processing'
+
+        job = await bot.download_queue.get()
+        await bot.download_queue.ack(job)
+        assert await bot.download_queue.counted_status('d1') is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import bot
+
+MB = 1024 * 1024
+
+def files(*sizes):
+    return [{'name': f"{index}.mp4", 'size': size} for index, size in enumerate(sizes)]
+
+def names(batches):
+    return [[f['name'] for f in batch] for batch in batches]
+
+def test_pack_fills_up_to_the_byte_limit_inclusive():
+    assert names(bot.pack_attachments(files(10 * MB, 15 * MB, 1), 25 * MB)) == [['0.mp4', '1.mp4'], ['2.mp4']]
+
+def test_pack_caps_attachments_per_message():
+    batches = bot.pack_attachments(files(*[1] * 25), 25 * MB)
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+
+def test_pack_keeps_order_and_isolates_oversized_file():
+    assert names(bot.pack_attachments(files(MB, 30 * MB, MB), 25 * MB)) == [['0.mp4'], ['1.mp4'], ['2.mp4']]
+
+def test_pack_uses_compressed_size():
+    batch = files(20 * MB, 20 * MB)
+    batch[0]['compressed_size'] = 4 * MB
+    assert names(bot.pack_attachments(batch, 25 * MB)) == [['0.mp4', '1.mp4']]
+
+def test_pack_empty():
+    assert bot.pack_attachments([], 25 * MB) == []
+
+def test_links_respect_the_message_limit():
+    urls = [f"https://cdn.discordapp.com/attachments/1/2/{index:03d}.mp4?ex={'f' * 180}" for index in range(20)]
+    messages = bot.pack_links(urls, header="<@1>")
+    assert all(len(message) <= bot.MESSAGE_CONTENT_LIMIT for message in messages)
+    assert messages[0].startswith("<@1>\n")
+    assert "\n".join(messages).split("\n")[1:] == urls
+
+def test_links_exactly_at_the_limit_stay_together():
+    url = "x" * 999
+    assert bot.pack_links([url, url], limit=1999) == [f"{url}\n{url}"]
+    assert bot.pack_links([url, url], limit=1998) == [url, url]
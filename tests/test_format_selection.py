@@ -0,0 +1,59 @@
+import bot
+
+MB = 1024 * 1024
+
+def video(format_id, height, size=None, tbr=None, acodec='none', ext='mp4'):
+    return {'format_id': format_id, 'height': height, 'vcodec': 'avc1', 'acodec': acodec, 'ext': ext, 'filesize': size, 'tbr': tbr}
+
+def audio(format_id, size=None, abr=128, ext='m4a'):
+    return {'format_id': format_id, 'vcodec': 'none', 'acodec': 'mp4a', 'ext': ext, 'abr': abr, 'filesize': size}
+
+def test_estimate_prefers_filesize_then_approx_then_tbr():
+    assert bot.estimate_format_size({'filesize': 1000, 'filesize_approx': 5, 'tbr': 1}, 10) == 1000
+    assert bot.estimate_format_size({'filesize_approx': 2000.7}, 10) == 2000
+    assert bot.estimate_format_size({'tbr': 800}, 10) == 1_000_000
+
+def test_estimate_unknown_without_size_or_duration():
+    assert bot.estimate_format_size({'tbr': 800}, None) is None
+    assert bot.estimate_format_size({}, 60) is None
+
+def test_pairs_video_only_with_audio_of_matching_container():
+    info = {'duration': 60, 'formats': [
+        audio('140', size=1 * MB, abr=128, ext='m4a'),
+        audio('251', size=1 * MB, abr=160, ext='webm'),
+        video('136', 720, size=10 * MB, ext='mp4'),
+    ]}
+    format_str, size = bot.select_video_format(info, '720', 25 * MB)
+    assert format_str == f"136+140/{bot.VIDEO_FORMATS['720']}"
+    assert size == 11 * MB
+
+def test_picks_highest_resolution_that_fits():
+    info = {'duration': 60, 'formats': [
+        audio('140', size=1 * MB),
+        video('137', 1080, size=30 * MB),
+        video('136', 720, size=12 * MB),
+    ]}
+    format_str, size = bot.select_video_format(info, '720', 25 * MB)
+    assert format_str.startswith("136+140/")
+    assert size == 13 * MB
+
+def test_limit_boundary_is_inclusive():
+    info = {'duration': 60, 'formats': [video('22', 720, size=25 * MB, acodec='mp4a', tbr=3000), video('18', 720, size=5 * MB, acodec='mp4a', tbr=700)]}
+    assert bot.select_video_format(info, '720', 25 * MB) == (f"22/{bot.VIDEO_FORMATS['720']}", 25 * MB)
+    assert bot.select_video_format(info, '720', 25 * MB - 1) == (f"18/{bot.VIDEO_FORMATS['720']}", 5 * MB)
+
+def test_smallest_candidate_when_nothing_fits():
+    info = {'duration': 60, 'formats': [video('22', 720, size=40 * MB, acodec='mp4a'), video('45', 1080, size=30 * MB, acodec='mp4a')]}
+    assert bot.select_video_format(info, '720', 25 * MB) == (f"45/{bot.VIDEO_FORMATS['720']}", 30 * MB)
+
+def test_height_range_upper_bound_is_exclusive():
+    info = {'duration': 60, 'formats': [video('720p', 720, size=MB, acodec='mp4a'), video('480p', 480, size=MB, acodec='mp4a')]}
+    assert bot.select_video_format(info, '480', 25 * MB)[0].startswith("480p/")
+
+def test_falls_back_to_generic_selector_without_sizes():
+    info = {'duration': None, 'formats': [video('136', 720, tbr=2000), audio('140')]}
+    assert bot.select_video_format(info, '720', 25 * MB) == (bot.VIDEO_FORMATS['720'], None)
+
+def test_video_only_formats_are_skipped_without_sized_audio():
+    info = {'duration': 60, 'formats': [video('136', 720, size=MB), audio('140', size=None)]}
+    assert bot.select_video_format(info, '720', 25 * MB) == (bot.VIDEO_FORMATS['720'], None)
@@ -0,0 +1,89 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sends = []
+
+    async def send(self, content=None, embed=None, file=None, files=None, **kwargs):
+        files = [file] if file else list(files or [])
+        for attachment in files:
+            attachment.close()
+        self.sends.append({'content': content, 'embed': embed, 'files': [f.filename for f in files]})
+        attachments = [SimpleNamespace(filename=f.filename, url=f"https://cdn.discordapp.invalid/{self.id}/{f.filename}") for f in files]
+        return SimpleNamespace(id=len(self.sends), channel=self, attachments=attachments)
+
+def job(download_id, channel_id, user_id):
+    download_data = {
+        'url': "https://www.youtube.com/watch?v=abc",
+        'format_str': 'best',
+        'content_type': 'video',
+        'user_id': user_id,
+        'channel_id': channel_id,
+        'download_id': download_id,
+        'timestamp': 0,
+        'title': 'abc',
+        'single': True,
+        'status': 'queued',
+        'canonical_url': "https://youtube.com/watch?v=abc",
+    }
+    download_data['cache_key'] = bot.result_cache_key(download_data)
+    return download_data
+
+@pytest.fixture
+def node(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(bot.DOWNLOAD_DIR)
+    monkeypatch.setattr(bot, 'ATTACHMENT_CACHE_ENABLED', False)
+    monkeypatch.setattr(bot, 'RESULT_CACHE_ENABLED', False)
+    monkeypatch.setattr(bot, 'download_queue', bot.MemoryDownloadQueue())
+    monkeypatch.setattr(bot, 'record_sink', bot.RecordSink(str(tmp_path / "journal")))
+    monkeypatch.setattr(bot.bot._connection, 'user', SimpleNamespace(display_avatar=None))
+
+    channels = {}
+
+    async def resolve_channel(channel_id):
+        return channels.setdefault(channel_id, FakeChannel(channel_id)) if channel_id else None
+
+    fetches = []
+
+    async def fetch_media(download_data, download_path, channel):
+        fetches.append(download_data['download_id'])
+        file_path = os.path.join(download_path, "abc.mp4")
+        with open(file_path, "wb") as f:
+            f.write(b"0" * 1024)
+        return [file_path]
+
+    monkeypatch.setattr(bot, 'resolve_channel', resolve_channel)
+    monkeypatch.setattr(bot, 'fetch_media', fetch_media)
+    return SimpleNamespace(channels=channels, fetches=fetches)
+
+async def run_coalesced(primary, follower):
+    bot.bot.loop = asyncio.get_running_loop()
+    assert await bot.download_queue.follow_or_register(primary) is None
+    assert await bot.download_queue.follow_or_register(follower) == primary['download_id']
+    await bot.run_download_job(primary)
+
+def test_follower_gets_links_without_attachment_cache(node):
+    primary, follower = job('p1', 1, 10), job('f1', 2, 20)
+    asyncio.run(run_coalesced(primary, follower))
+
+    assert node.fetches == ['p1']
+    assert follower['status'] == 'completed'
+    sends = node.channels[2].sends
+    assert len(sends) == 1 and not sends[0]['files']
+    assert sends[0]['content'] == "<@20>\nhttps://cdn.discordapp.invalid/1/abc.mp4"
+
+def test_follower_gets_files_when_primary_upload_missing(node):
+    primary, follower = job('p2', 0, 10), job('f2', 2, 20)
+    asyncio.run(run_coalesced(primary, follower))
+
+    assert node.fetches == ['p2']
+    assert follower['status'] == 'completed'
+    assert node.channels[2].sends[0]['files'] == ['abc.mp4']
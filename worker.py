@@ -0,0 +1,36 @@
+"""Nodo worker: consume la cola compartida de Redis y entrega los resultados por la API HTTP de Discord"""
+import asyncio
+import os
+import signal
+import socket
+
+os.environ.setdefault("QUEUE_CONSUMER", socket.gethostname())
+
+import bot as node
+
+async def main():
+    await node.bot.login(os.getenv("DISCORD_TOKEN"))
+
+    await node.setup_download_node(start_workers=True)
+
+    if not isinstance(node.download_queue, node.RedisDownloadQueue):
+        node.logger.error("worker.py necesita Redis: sin una cola compartida no hay trabajo que repartir")
+        await node.bot.close()
+        return
+
+    node.logger.info(f"Nodo worker {node.QUEUE_CONSUMER} listo con {node.MAX_DOWNLOADS} workers")
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+
+    await stop.wait()
+
+    node.logger.info(f"Deteniendo el nodo worker {node.QUEUE_CONSUMER}")
+    await node.stop_download_workers()
+    await node.bot.close()
+    if node.redis_client:
+        await node.redis_client.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+"""Ejecuta una descarga de yt-dlp, en el proceso actual o como proceso hijo aislado"""
+import json
+import sys
+import time
+
+import yt_dlp
+
+RESULT_PREFIX = "YTDLP_RESULT "
+
+def stage_hooks(stats):
+    """Hooks de progreso y postprocesado que acumulan tiempos de red, de ffmpeg y bytes descargados"""
+    downloads = {}
+    postprocessors = {}
+
+    def progress_hook(d):
+        key = d.get('filename')
+        if d['status'] == 'downloading':
+            downloads.setdefault(key, time.monotonic())
+        elif d['status'] == 'finished':
+            started = downloads.pop(key, None)
+            stats['download'] += d.get('elapsed') or (time.monotonic() - started if started else 0)
+            stats['bytes_downloaded'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+
+    def postprocessor_hook(d):
+        key = d.get('postprocessor')
+        if d['status'] == 'started':
+            postprocessors[key] = time.monotonic()
+        elif d['status'] == 'finished' and key in postprocessors:
+            stats['postprocess'] += time.monotonic() - postprocessors.pop(key)
+
+    return progress_hook, postprocessor_hook
+
+def run_download(url, ydl_opts, info_file=None):
+    stats = {'download': 0.0, 'postprocess': 0.0, 'bytes_downloaded': 0}
+    progress_hook, postprocessor_hook = stage_hooks(stats)
+    ydl_opts = dict(ydl_opts)
+    ydl_opts['progress_hooks'] = list(ydl_opts.get('progress_hooks', [])) + [progress_hook]
+    ydl_opts['postprocessor_hooks'] = list(ydl_opts.get('postprocessor_hooks', [])) + [postprocessor_hook]
+
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            if info_file:
+                ydl.download_with_info_file(info_file)
+            else:
+                ydl.download([url])
+        return True, None, stats
+    except Exception as e:
+        error_msg = str(e)
+
+        if "is private" in error_msg or "This content is not available" in error_msg or "sign in" in error_msg:
+            return False, f"El contenido es privado o requiere inicio de sesión: {error_msg}", stats
+        return False, error_msg, stats
+
+def main():
+    job = json.loads(sys.stdin.read())
+
+    success, error, stats = run_download(job['url'], job['ydl_opts'], job.get('info_file'))
+
+    sys.stdout.write("\n" + RESULT_PREFIX + json.dumps({'success': success, 'error': error, 'stats': stats}) + "\n")
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()